@@ -0,0 +1,309 @@
+import argparse, ast, concurrent.futures, contextlib, datetime, json, multiprocessing, os, re, sys, time, traceback, types, typing
+
+from constants import *
+
+# Region config of an input MPF file next to it, e.g. part.regions.json for part.mpf
+REGIONS_SIDECAR_SUFFIX = '.regions.json'
+
+# Output filenames of any MPF_OUTPUT_SUFFIX values, skipped when a directory is read so earlier outputs are not processed again
+MPF_OUTPUT_NAME_PATTERN = re.compile(r'-[0-9-]+mul-[0-9-]+inset-s\d+k\d+r-c\d+k\d+r\.mpf$', re.IGNORECASE)
+
+'''
+Job config keys. A region config file is a job config without input.
+  input: MPF file path
+  output: output MPF file path. Defaults to the input filename followed by MPF_OUTPUT_SUFFIX in outputDirectory or the input directory.
+  outputDirectory: directory of the default output path
+  regions: density regions replacing boundingBoxes of mpf_post_process.py, e.g.
+    {"origin": [-12, -12, 1], "size": [24, 24, 7], "density": 0.1}
+    {"stl": "modifier.stl", "density": 0.2, "offset": [0, 0, 0], "densityField": "field.edf"}
+  constants: values replacing constants.py values for the job, e.g. {"DROPLET_EXTRUSION_MULTIPLIER": 0.8}
+  seed: placement seed
+'''
+
+def constantsNamespace(overrides: dict, namespace: dict = None) -> dict:
+  """
+  Run constants.py with the assignments of the overridden constants replaced. Constants derived from them such as MPF_OUTPUT_SUFFIX use the new values.
+
+  :param overrides: Constant values by name
+  :type overrides: dict
+  :param namespace: Namespace to run constants.py in, a new dict by default
+  :type namespace: dict
+  :return: Constants by name
+  :rtype: dict
+  """
+  filepath = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'constants.py')
+  with open(filepath, mode='r') as constantsFile:
+    tree = ast.parse(constantsFile.read(), filename=filepath)
+
+  unknown = set(overrides)
+  for node in tree.body:
+    if isinstance(node, ast.Assign) and len(node.targets) == 1 and isinstance(node.targets[0], ast.Name) and node.targets[0].id in overrides:
+      node.value = ast.parse(repr(overrides[node.targets[0].id]), mode='eval').body
+      unknown.discard(node.targets[0].id)
+  if unknown:
+    raise ValueError(f"Unknown constants {', '.join(sorted(unknown))}")
+
+  namespace = {} if namespace is None else namespace
+  exec(compile(ast.fix_missing_locations(tree), filepath, 'exec'), namespace)
+  return namespace
+
+def loadConstants(overrides: dict) -> types.ModuleType:
+  """
+  Load constants.py with overridden constants as the constants module. Modules imported after this see the new values. It must run before any other module of the post processor is imported.
+
+  :param overrides: Constant values by name
+  :type overrides: dict
+  :return: Constants module
+  :rtype: types.ModuleType
+  """
+  module = types.ModuleType('constants')
+  module.__file__ = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'constants.py')
+  constantsNamespace(overrides=overrides, namespace=module.__dict__)
+  sys.modules['constants'] = module
+  return module
+
+def regionFromConfig(region: dict):
+  """
+  Create the bounding box of a region config.
+
+  :param region: Region config with origin and size, or stl and an optional offset. density and densityField are optional.
+  :type region: dict
+  :return: Bounding box
+  :rtype: BoundingBox
+  """
+  # imported here after the job constants are loaded
+  from printing_classes import BoundingBox, Position
+  from mesh_region import MeshBoundingBox
+  from density_field import readDensityField
+
+  if 'stl' in region:
+    bb = MeshBoundingBox.fromSTL(region['stl'], density=region.get('density', 1), offset=Position(*region['offset']) if 'offset' in region else None)
+  else:
+    bb = BoundingBox(origin=Position(*region['origin']), size=Position(*region['size']), density=region.get('density', 1))
+  if 'densityField' in region:
+    bb.densityField = readDensityField(region['densityField'])
+  return bb
+
+def jobOutputFilepath(job: dict, suffix: str) -> str:
+  if job.get('output'):
+    return job['output']
+  stem = os.path.splitext(os.path.basename(job['input']))[0]
+  return os.path.join(job.get('outputDirectory') or os.path.dirname(job['input']), f"{stem}-{suffix}.mpf")
+
+def jobResult(job: dict) -> dict:
+  return {'inputFilepath': job['input'], 'outputFilepath': job.get('output'), 'islands': 0, 'dropletsOriginal': 0, 'dropletsNeeded': 0, 'dropletsPlaced': 0, 'elapsed': 0, 'timings': [], 'error': None, 'jobElapsed': 0}
+
+def checkJobFilepaths(jobs: list[dict]):
+  """
+  Raise ValueError if a job writes the input of a job or the output of another job.
+
+  :param jobs: Job configs
+  :type jobs: list[dict]
+  """
+  inputFilepaths = {os.path.realpath(job['input']): job['input'] for job in jobs}
+  outputFilepaths: dict[str, str] = {}
+  for job in jobs:
+    outputFilepath = jobOutputFilepath(job=job, suffix=constantsNamespace(overrides=job.get('constants', {}))['MPF_OUTPUT_SUFFIX'])
+    path = os.path.realpath(outputFilepath)
+    if path in inputFilepaths:
+      raise ValueError(f"{job['input']} is written to {outputFilepath} which is the input {inputFilepaths[path]}")
+    if path in outputFilepaths:
+      raise ValueError(f"{outputFilepaths[path]} and {job['input']} are both written to {outputFilepath}")
+    outputFilepaths[path] = job['input']
+
+def runJob(job: dict, parsedPrintFilepath: str = None) -> dict:
+  """
+  Worker task that post processes one MPF file. Each job runs in a new worker process so the constants, bounding boxes and droplet rasters of a job are not seen by other jobs.
+  Output printed by process() is written to a log file next to the output file.
+
+  :param job: Job config
+  :type job: dict
+  :param parsedPrintFilepath: Saved ParsedPrint of the job input to emit instead of processing the input. Its bounding boxes replace the job regions.
+  :type parsedPrintFilepath: str
+  :return: Input and output file paths, ProcessStats values, job time including setup, and the error traceback of a failed job
+  :rtype: dict
+  """
+  startTime = time.monotonic()
+  result = jobResult(job)
+  try:
+    # worker processes of the pool can not start the island placement pool
+    constants = loadConstants({**job.get('constants', {}), 'PARALLEL_ISLAND_WORKERS': 0})
+    result['outputFilepath'] = jobOutputFilepath(job=job, suffix=constants.MPF_OUTPUT_SUFFIX)
+
+    import mpf_post_process
+    parsedPrint = None
+    if parsedPrintFilepath:
+      parsedPrint = mpf_post_process.ParsedPrint.load(parsedPrintFilepath)
+      mpf_post_process.boundingBoxes = parsedPrint.boundingBoxes
+    elif job.get('regions'):
+      mpf_post_process.boundingBoxes = [regionFromConfig(region) for region in job['regions']]
+      mpf_post_process.testBoundingBox = mpf_post_process.boundingBoxes[0]
+
+    with open(f"{result['outputFilepath']}.log", mode='w') as log, contextlib.redirect_stdout(log):
+      if parsedPrint:
+        stats = mpf_post_process.emitParsedPrint(parsedPrint=parsedPrint, outputFilepath=result['outputFilepath'])
+      else:
+        stats = mpf_post_process.process(inputFilepath=job['input'], outputFilepath=result['outputFilepath'], seed=job.get('seed', constants.PLACEMENT_SEED))
+    result.update(vars(stats))
+  except Exception:
+    result['error'] = traceback.format_exc()
+  result['jobElapsed'] = time.monotonic() - startTime
+  return result
+
+def runBatch(jobs: list[dict], workers: int = BATCH_WORKERS, parsedPrintFilepath: str = None) -> list[dict]:
+  """
+  Run jobs concurrently in a pool of worker processes. Every job gets a newly started worker process.
+  A job whose worker process exits without a result, e.g. when it is killed, is a failed job. The jobs still running or waiting then fail as well since the pool can not run them.
+
+  :param jobs: Job configs
+  :type jobs: list[dict]
+  :param workers: Worker processes. 0 uses the CPU count.
+  :type workers: int
+  :param parsedPrintFilepath: Saved ParsedPrint that every job emits instead of processing its input
+  :type parsedPrintFilepath: str
+  :return: Results of runJob() in job order
+  :rtype: list[dict]
+  """
+  if not jobs:
+    return []
+  workers = min(workers or os.cpu_count() or 1, len(jobs))
+
+  results: list[dict] = [None] * len(jobs)
+  # spawned workers import the post processor fresh for the job constants
+  with concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'), max_tasks_per_child=1) as pool:
+    futures = {pool.submit(runJob, job=job, parsedPrintFilepath=parsedPrintFilepath): i for i, job in enumerate(jobs)}
+    for done, future in enumerate(concurrent.futures.as_completed(futures), start=1):
+      i = futures[future]
+      try:
+        result = future.result()
+      except concurrent.futures.process.BrokenProcessPool:
+        # a worker process exited without returning a result
+        result = {**jobResult(jobs[i]), 'error': traceback.format_exc()}
+      results[i] = result
+      print(f"[{done}/{len(jobs)}] {'failed' if result['error'] else 'finished'} {result['inputFilepath']} -> {result['outputFilepath']} in {result['jobElapsed']:.2f}s")
+  return results
+
+def printSummary(results: list[dict], wallTime: float):
+  print(f"{'Job':<48} {'Islands':>8} {'Placed/Needed':>19} {'Placed':>7} {'Time':>9}")
+  for result in results:
+    placed = f"{result['dropletsPlaced']}/{result['dropletsNeeded']}"
+    percentage = f"{100*result['dropletsPlaced']/result['dropletsNeeded']:.1f}%" if result['dropletsNeeded'] else '-'
+    print(f"{os.path.basename(result['outputFilepath'] or result['inputFilepath']):<48} {result['islands']:>8} {placed:>19} {percentage:>7} {result['jobElapsed']:>8.2f}s{' FAILED' if result['error'] else ''}")
+
+  failed = [result for result in results if result['error']]
+  placed = sum(result['dropletsPlaced'] for result in results)
+  needed = sum(result['dropletsNeeded'] for result in results)
+  jobTime = sum(result['jobElapsed'] for result in results)
+  processTime = sum(result['elapsed'] for result in results)
+  print(f"{len(results)} jobs, {len(failed)} failed, {sum(result['islands'] for result in results)} infill islands")
+  print(f"Placed {placed}/{needed} droplets needed for density{f' ({100*placed/needed:.1f}%)' if needed else ''}")
+  print(f"Job time {jobTime:.2f}s ({processTime:.2f}s processing), wall time {wallTime:.2f}s, {jobTime/wallTime if wallTime else 0:.2f} jobs running on average")
+
+  for result in failed:
+    print(f"\n{result['inputFilepath']} failed:\n{result['error']}")
+
+def readConfig(filepath: str) -> dict|list:
+  """
+  Read a job or region config JSON file. Relative input, output, stl and density field paths are relative to the file.
+  """
+  with open(filepath, mode='r') as configFile:
+    config = json.load(configFile)
+
+  directory = os.path.dirname(os.path.abspath(filepath))
+  for job in (config if isinstance(config, list) else [config]):
+    for key in ('input', 'output', 'outputDirectory'):
+      if job.get(key):
+        job[key] = os.path.join(directory, job[key])
+    for region in job.get('regions', []):
+      for key in ('stl', 'densityField'):
+        if key in region:
+          region[key] = os.path.join(directory, region[key])
+  return config
+
+def buildJobs(inputs: list[str], jobsFilepath: str = None, regionsFilepath: str = None, outputDirectory: str = None, seed: int = None, overrides: dict = None) -> list[dict]:
+  """
+  Build job configs from input MPF files and directories of MPF files, and a jobs file.
+  MPF files in directories named like outputs (MPF_OUTPUT_NAME_PATTERN) are skipped.
+  Input files use the region config next to them (REGIONS_SIDECAR_SUFFIX) if there is one, otherwise the default region config.
+
+  :param inputs: MPF file and directory paths
+  :type inputs: list[str]
+  :param jobsFilepath: JSON file with a list of job configs
+  :type jobsFilepath: str
+  :param regionsFilepath: Default region config JSON file
+  :type regionsFilepath: str
+  :param outputDirectory: Directory of output files without an output path
+  :type outputDirectory: str
+  :param seed: Placement seed of jobs without a seed
+  :type seed: int
+  :param overrides: Constant values of jobs that do not set them
+  :type overrides: dict
+  :return: Job configs
+  :rtype: list[dict]
+  """
+  defaults = {'constants': dict(overrides or {})}
+  if seed is not None:
+    defaults['seed'] = seed
+  if outputDirectory:
+    defaults['outputDirectory'] = outputDirectory
+
+  def job(config: dict) -> dict:
+    return {**defaults, **config, 'constants': {**defaults['constants'], **config.get('constants', {})}}
+
+  default = readConfig(regionsFilepath) if regionsFilepath else {}
+
+  filepaths: list[str] = []
+  for path in inputs:
+    if os.path.isdir(path):
+      filepaths += sorted(os.path.join(path, name) for name in os.listdir(path) if name.lower().endswith('.mpf') and not MPF_OUTPUT_NAME_PATTERN.search(name))
+    else:
+      filepaths.append(path)
+
+  jobs = []
+  for filepath in filepaths:
+    sidecar = os.path.splitext(filepath)[0] + REGIONS_SIDECAR_SUFFIX
+    jobs.append(job({**(readConfig(sidecar) if os.path.exists(sidecar) else default), 'input': filepath}))
+  if jobsFilepath:
+    jobs += [job({**default, **config}) for config in readConfig(jobsFilepath)]
+  return jobs
+
+def parseValue(s: str) -> typing.Any:
+  try:
+    return ast.literal_eval(s)
+  except (ValueError, SyntaxError):
+    return s
+
+def parseOverride(s: str) -> tuple[str, typing.Any]:
+  name, _, value = s.partition('=')
+  return name, parseValue(value)
+
+def main():
+  parser = argparse.ArgumentParser(description='Post process MPF files concurrently in a pool of worker processes.')
+  parser.add_argument('inputs', nargs='*', help='MPF files and directories of MPF files')
+  parser.add_argument('--jobs', help='JSON file with a list of job configs')
+  parser.add_argument('--regions', help=f'default region config JSON file of inputs without a {REGIONS_SIDECAR_SUFFIX} file')
+  parser.add_argument('--output-dir', help='directory of the output files, default is the input directory')
+  parser.add_argument('--workers', type=int, default=BATCH_WORKERS, help='worker processes, 0 uses the CPU count')
+  parser.add_argument('--seed', type=int, help='placement seed of jobs without a seed')
+  parser.add_argument('--set', action='append', default=[], metavar='NAME=VALUE', help='constant value of jobs that do not set it')
+  args = parser.parse_args()
+
+  jobs = buildJobs(inputs=args.inputs, jobsFilepath=args.jobs, regionsFilepath=args.regions, outputDirectory=args.output_dir, seed=args.seed, overrides=dict(parseOverride(s) for s in args.set))
+  if not jobs:
+    parser.error('no MPF files to process')
+  try:
+    checkJobFilepaths(jobs)
+  except ValueError as e:
+    parser.error(str(e))
+
+  startTime = time.monotonic()
+  results = runBatch(jobs=jobs, workers=args.workers)
+  wallTime = time.monotonic() - startTime
+  printSummary(results=results, wallTime=wallTime)
+  print(f"Completed in {str(datetime.timedelta(seconds=wallTime))}s")
+
+  if any(result['error'] for result in results):
+    sys.exit(1)
+
+if __name__ == '__main__':
+  main()
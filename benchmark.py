@@ -0,0 +1,267 @@
+import re, time, random, os, tempfile, io, contextlib, copy
+
+import mpf_post_process
+
+from printing_classes import *
+from constants import *
+from gcode_tokenizer import *
+from mpf_reader import *
+from intersection import *
+from placement import *
+
+# Reference line handling with the regex constants as it was done in the process() loop
+def regexTokenizeLine(cl: str) -> GcodeLine:
+  featureMatch = re.match(FEATURE_TYPE, cl)
+  m1Match = re.match(MACHINE_M1, cl)
+  if featureMatch:
+    gl = GcodeLine(GcodeLineKind.FEATURE)
+    gl.featureType = featureMatch.groups()[0]
+    return gl
+  elif m1Match:
+    return GcodeLine(GcodeLineKind.MACHINE_M1)
+
+  movementMatch = re.match(MOVEMENT_G, cl)
+  if not movementMatch:
+    return GcodeLine(GcodeLineKind.OTHER)
+
+  gl = GcodeLine(GcodeLineKind.MOVEMENT)
+  m = 0
+  while m+1 < len(movementMatch.groups()):
+    if movementMatch.groups()[m] == None:
+      m += 2
+      continue
+    axis = str(movementMatch.groups()[m])
+    if axis == ';':
+      axisValue = movementMatch.groups()[m+1]
+    else:
+      axisValue = float(movementMatch.groups()[m+1])
+    m += 2
+    if axis == 'X':
+      gl.X = axisValue
+      gl.axes |= AXIS_X
+    elif axis == 'Y':
+      gl.Y = axisValue
+      gl.axes |= AXIS_Y
+    elif axis == 'Z':
+      gl.Z = axisValue
+      gl.axes |= AXIS_Z
+    elif axis == 'E':
+      gl.E = axisValue
+      gl.axes |= AXIS_E
+    elif axis == ';':
+      gl.comment = axisValue
+  return gl
+
+def sameGcodeLine(a: GcodeLine, b: GcodeLine) -> bool:
+  return a.kind == b.kind and a.axes == b.axes and a.X == b.X and a.Y == b.Y and a.Z == b.Z and a.E == b.E and a.comment == b.comment and a.featureType == b.featureType
+
+def benchmarkTokenizer(inputFilepath: str, repeat: int = 5):
+  """
+  Compare the tokenizer against the regex line handling on every line of a file and time both.
+  """
+  with MappedFile(inputFilepath) as f:
+    byteLines = [cl for _, cl in f.lines()]
+  lines = [cl.decode() for cl in byteLines]
+
+  mismatches = [cl for cl, bcl in zip(lines, byteLines) if not sameGcodeLine(regexTokenizeLine(cl), tokenizeLine(bcl))]
+  print(f"{len(lines)} lines, {len(mismatches)} mismatches")
+  for cl in mismatches[:10]:
+    print(f"mismatch {repr(cl)}")
+
+  # regex path works on decoded text lines, tokenizer on byte lines
+  for name, fn, fnLines in [('regex', regexTokenizeLine, lines), ('tokenizer', tokenizeLine, byteLines)]:
+    best = None
+    for _ in range(repeat):
+      startTime = time.perf_counter()
+      for cl in fnLines:
+        fn(cl)
+      elapsed = time.perf_counter() - startTime
+      best = elapsed if best is None else min(best, elapsed)
+    print(f"{name}: {best*1000:.1f}ms best of {repeat} ({best/len(lines)*1e9:.0f}ns/line)")
+
+def benchmarkBoundingBoxSplit(count: int = 20000, repeat: int = 5):
+  """
+  Compare splitting random movements one at a time against the batched clip and time both.
+  """
+  rng = random.Random(0)
+  boundingBox = BoundingBox(origin=Position(-12, -12, 1.0), size=Position(24, 24, 7), density=0.1)
+  movements = []
+  for _ in range(count):
+    z = rng.choice([0.24, 1.2, 4.08, 7.92, 8.16])
+    movements.append(Movement(startPos=Position(rng.uniform(-20, 20), rng.uniform(-20, 20), z, 0), endPos=Position(rng.uniform(-20, 20), rng.uniform(-20, 20), z, 1)))
+
+  def splitKey(split):
+    return split and [(m.start.X, m.start.Y, m.start.E, m.end.X, m.end.Y, m.end.E, m.boundingBox is not None) for m in split]
+
+  mismatches = sum(1 for m, split in zip(movements, boundingBoxSplitBatch(movements=movements, boundingBox=boundingBox)) if splitKey(boundingBoxSplit(m, boundingBox)) != splitKey(split))
+  print(f"{count} movements, {mismatches} mismatches")
+
+  for name, fn in [('boundingBoxSplit', lambda: [boundingBoxSplit(m, boundingBox) for m in movements]), ('boundingBoxSplitBatch', lambda: boundingBoxSplitBatch(movements=movements, boundingBox=boundingBox))]:
+    best = None
+    for _ in range(repeat):
+      startTime = time.perf_counter()
+      fn()
+      elapsed = time.perf_counter() - startTime
+      best = elapsed if best is None else min(best, elapsed)
+    print(f"{name}: {best*1000:.1f}ms best of {repeat} ({best/count*1e9:.0f}ns/movement)")
+
+def benchmarkPlacementEngines(movementCount: int = 8, density: float = 0.9, repeat: int = 3):
+  """
+  Place droplets on an island of a few long movements over a fully supported last layer with each placement engine and compare the droplets placed and the time taken.
+  """
+  def island() -> tuple[list[Movement], PrintState]:
+    boundingBox = BoundingBox(origin=Position(-12, -12, 1.0), size=Position(24, 24, 7), density=density)
+    boundingBox.initializeDropletRaster()
+    boundingBox.dropletRaster[1].fill(1)
+    boundingBox.advanceDropletRasterNextLayer()
+
+    ps = PrintState()
+    ps.layerHeight = 2.0
+    ps.infillModifiedDropletsNeededForDensity = 0
+    movements = []
+    for i in range(movementCount):
+      y = -8 + 16 * i / max(1, movementCount-1)
+      m = Movement(startPos=Position(-10, y, ps.layerHeight, 0), endPos=Position(10, y, ps.layerHeight, 10), boundingBox=boundingBox)
+      dropletCount = planMovementDroplets(m=m, singleDropletWidthResolution=False)
+      ps.infillModifiedDropletsNeededForDensity += reducedDropletCountForDensity(numDroplets=dropletCount, density=density)
+      m.supportedPositions = findSupportedLocationsBatch(m=m)
+      movements.append(m)
+    return movements, ps
+
+  engines = [
+    ('round robin', lambda movements, ps: placeDropletsRoundRobin(movements=movements, ps=ps)),
+    ('pooled with fairness', lambda movements, ps: placeDropletsPooled(movements=movements, ps=ps, fairness=True)),
+    ('pooled', lambda movements, ps: placeDropletsPooled(movements=movements, ps=ps, fairness=False)),
+    ('blue noise', lambda movements, ps: placeDropletsBlueNoise(movements=movements, ps=ps))
+  ]
+  for name, fn in engines:
+    best = None
+    for r in range(repeat):
+      random.seed(r)
+      movements, ps = island()
+      needed = ps.infillModifiedDropletsNeededForDensity
+      startTime = time.perf_counter()
+      placed = fn(movements, ps)
+      elapsed = time.perf_counter() - startTime
+      best = elapsed if best is None else min(best, elapsed)
+    perMovement = [len(m.placedSupportedPositions or []) for m in movements]
+    print(f"{name}: placed {placed}/{needed} droplets, {min(perMovement)}-{max(perMovement)} per movement, {best*1000:.1f}ms best of {repeat}")
+
+def countLayersCompletedLines(filepath: str) -> int:
+  with MappedFile(filepath) as f:
+    return sum(1 for _, cl in f.lines() if cl.startswith(LAYERS_COMPLETED_WRITE_OUT.encode()))
+
+def checkLayersCompletedLines(inputFilepath: str, seed: int = 0):
+  """
+  Post process a file with and without layers passed through and check the output has as many layers completed lines as the input.
+  """
+  expected = countLayersCompletedLines(inputFilepath)
+  for passThrough in (True, False):
+    mpf_post_process.PASS_THROUGH_LAYERS_OUTSIDE_BOUNDING_BOX = passThrough
+    for bb in mpf_post_process.boundingBoxes:
+      bb.freeDropletRaster()
+    outputFile, outputFilepath = tempfile.mkstemp(suffix='.mpf')
+    os.close(outputFile)
+    try:
+      with contextlib.redirect_stdout(io.StringIO()):
+        mpf_post_process.process(inputFilepath=inputFilepath, outputFilepath=outputFilepath, seed=seed)
+      count = countLayersCompletedLines(outputFilepath)
+    finally:
+      os.remove(outputFilepath)
+    print(f"layers passed through {passThrough}: {count}/{expected} layers completed lines{'' if count == expected else ' MISMATCH'}")
+  mpf_post_process.PASS_THROUGH_LAYERS_OUTSIDE_BOUNDING_BOX = PASS_THROUGH_LAYERS_OUTSIDE_BOUNDING_BOX
+
+def writeTwoIslandPrint(inputFilepath: str, outputFilepath: str, offsetX: float):
+  """
+  Write a copy of a print with the infill of each layer repeated offsetX along X before the layer end lines. Each layer then has two infill islands far enough apart to be placed by separate workers.
+  """
+  axisValue = re.compile(r'([XYE])(-?\d*\.?\d+)')
+  with open(inputFilepath, mode='r') as inputFile:
+    lines = inputFile.readlines()
+
+  out = []
+  fill = None # infill lines of the current layer
+  position, e, fillStart = (0, 0), 0, None
+  for l in lines:
+    if re.match(LAYER_COMMENT, l):
+      fill = None
+    elif l.rstrip() == f'{FEATURE_TYPE_WRITE_OUT}fill' and fill is None:
+      fill, fillStart = [], (position, e)
+    elif re.match(MACHINE_M1, l) and fill:
+      layerEnd = []
+      while out[-1].rstrip() == PULSE_OFF or out[-1].startswith(LAYERS_COMPLETED_WRITE_OUT):
+        layerEnd.insert(0, out.pop())
+        fill.pop()
+
+      def shift(m: re.Match) -> str:
+        v = float(m.group(2))
+        if m.group(1) == 'X':
+          v += offsetX
+        elif m.group(1) == 'E':
+          v += e - fillStart[1]
+        return f'{m.group(1)}{v:.5f}'
+
+      out += [f'{FEATURE_TYPE_WRITE_OUT}inner perimeter\n', f'{FEATURE_TYPE_WRITE_OUT}travel\n', f'{PULSE_OFF}\n', f'G0 X{fillStart[0][0]+offsetX:.5f} Y{fillStart[0][1]:.5f}\n']
+      for fl in fill:
+        code, sep, comment = fl.partition(';')
+        out.append(axisValue.sub(shift, code) + sep + comment if fl.startswith(('G0', 'G1')) else fl)
+      out += layerEnd
+      fill = None
+
+    if l.startswith(('G0', 'G1')):
+      for axis, v in axisValue.findall(l.partition(';')[0]):
+        if axis == 'X':
+          position = (float(v), position[1])
+        elif axis == 'Y':
+          position = (position[0], float(v))
+        else:
+          e = float(v)
+    elif re.match(MACHINE_M1, l):
+      e = 0
+    if fill is not None:
+      fill.append(l)
+    out.append(l)
+
+  with open(outputFilepath, mode='w') as outputFile:
+    outputFile.writelines(out)
+
+def checkParallelPlacement(inputFilepath: str, workers: int = 2, seed: int = 0, offsetX: float = 40):
+  """
+  Post process a print with two infill islands per layer with islands placed serially and by workers, and check both outputs are the same.
+  """
+  twoIslandFile, twoIslandFilepath = tempfile.mkstemp(suffix='.mpf')
+  os.close(twoIslandFile)
+  writeTwoIslandPrint(inputFilepath=inputFilepath, outputFilepath=twoIslandFilepath, offsetX=offsetX)
+
+  boundingBoxes, testBoundingBox = mpf_post_process.boundingBoxes, mpf_post_process.testBoundingBox
+  outputs = []
+  try:
+    for w in (0, workers):
+      mpf_post_process.PARALLEL_ISLAND_WORKERS = w
+      # one box over both islands
+      size = copy.copy(testBoundingBox.size)
+      size.X += offsetX
+      bb = BoundingBox(origin=copy.copy(testBoundingBox.origin), size=size, density=testBoundingBox.density)
+      mpf_post_process.boundingBoxes, mpf_post_process.testBoundingBox = [bb], bb
+      outputFile, outputFilepath = tempfile.mkstemp(suffix='.mpf')
+      os.close(outputFile)
+      try:
+        with contextlib.redirect_stdout(io.StringIO()):
+          stats = mpf_post_process.process(inputFilepath=twoIslandFilepath, outputFilepath=outputFilepath, seed=seed)
+        with open(outputFilepath, mode='rb') as f:
+          outputs.append(f.read())
+      finally:
+        os.remove(outputFilepath)
+  finally:
+    os.remove(twoIslandFilepath)
+    mpf_post_process.boundingBoxes, mpf_post_process.testBoundingBox = boundingBoxes, testBoundingBox
+    mpf_post_process.PARALLEL_ISLAND_WORKERS = PARALLEL_ISLAND_WORKERS
+  print(f"{stats.islands} islands placed by {workers} workers: {stats.dropletsPlaced} droplets placed, output {'same as' if outputs[0] == outputs[1] else 'DIFFERENT from'} serial placement")
+
+# worker processes started with spawn import this file again and must not run it
+if __name__ == '__main__':
+  benchmarkTokenizer(inputFilepath='test-square-25x25x10.mpf')
+  benchmarkBoundingBoxSplit()
+  benchmarkPlacementEngines()
+  checkLayersCompletedLines(inputFilepath='test-square-25x25x10.mpf')
+  checkParallelPlacement(inputFilepath='test-square-25x25x10.mpf')
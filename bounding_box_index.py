@@ -0,0 +1,69 @@
+import bisect, itertools, math
+
+from printing_classes import *
+
+class BoundingBoxIndex:
+  """
+  Uniform grid over the XY extent of a list of bounding boxes.
+  Each cell lists the boxes that overlap it so a segment is only tested against the boxes in the cells it could reach.
+  Candidates are returned in bounding box list order, which is also the priority order where boxes overlap.
+  Boxes are also sorted by bottom Z so a Z range is checked with a binary search instead of testing every box.
+  """
+  def __init__(self, boundingBoxes: list[BoundingBox], cellSize: float = None):
+    self.boundingBoxes: list[BoundingBox] = list(boundingBoxes)
+
+    # default cell size is the average XY extent of the boxes
+    if cellSize is None:
+      extents = [max(bb.size.X, bb.size.Y) for bb in self.boundingBoxes]
+      cellSize = sum(extents) / len(extents) if extents else 1
+    self.cellSize: float = max(cellSize, 1e-6)
+
+    self.cells: dict[tuple[int, int], list[int]] = {}
+    for i, bb in enumerate(self.boundingBoxes):
+      for cell in self.cellsInRange(bb.origin.X, bb.origin.Y, bb.origin.X + bb.size.X, bb.origin.Y + bb.size.Y):
+        self.cells.setdefault(cell, []).append(i)
+
+    # highest top Z of the boxes up to each bottom Z
+    zOrder = sorted(self.boundingBoxes, key=lambda bb: bb.origin.Z)
+    self.bottomZ: list[float] = [bb.origin.Z for bb in zOrder]
+    self.topZ: list[float] = list(itertools.accumulate((bb.lastLayerHeight() for bb in zOrder), max))
+
+  def __len__(self):
+    return len(self.boundingBoxes)
+
+  def __iter__(self):
+    return iter(self.boundingBoxes)
+
+  def cell(self, v: float) -> int:
+    return math.floor(v / self.cellSize)
+
+  def cellsInRange(self, minX: float, minY: float, maxX: float, maxY: float):
+    for cx in range(self.cell(minX), self.cell(maxX) + 1):
+      for cy in range(self.cell(minY), self.cell(maxY) + 1):
+        yield (cx, cy)
+
+  def candidates(self, minX: float, minY: float, maxX: float, maxY: float, z: float) -> list[int]:
+    """
+    Return the indices of the boxes whose XY extent could overlap the XY range and whose Z range contains z.
+
+    :return: Bounding box indices in list order
+    :rtype: list[int]
+    """
+    found: set[int] = set()
+    for cell in self.cellsInRange(minX, minY, maxX, maxY):
+      found.update(self.cells.get(cell, ()))
+    return sorted(i for i in found if self.boundingBoxes[i].origin.Z <= z <= self.boundingBoxes[i].lastLayerHeight())
+
+  def intersectsZRange(self, minZ: float, maxZ: float) -> bool:
+    # any box starting at or below maxZ that ends at or above minZ
+    k = bisect.bisect_right(self.bottomZ, maxZ)
+    return k > 0 and self.topZ[k-1] >= minZ
+
+  def advanceDropletRastersNextLayer(self):
+    # each box advances its own raster
+    for bb in self.boundingBoxes:
+      bb.advanceDropletRasterNextLayer()
+
+  def precomputeLayerGeometry(self, heights: list[float]):
+    for bb in self.boundingBoxes:
+      bb.precomputeLayerGeometry(heights=heights)
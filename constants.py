@@ -23,6 +23,7 @@ DWELL_G4 = 'G4 F'
 
 # Layer Change
 MACHINE_M1 = '^M1\s+' #signal new layer followed by reset extrusion comments
+LAYER_COMMENT = '^; layer (\d+), Z = (\d*\.?\d*)' # Layer number and Z height comment at the start of each layer
 #LAYER_CHANGE = '^;\s?(?:feature plane change)'
 #LAYER_Z_HEIGHT = '^;\s?(?:Z_HEIGHT|Z):\s?(\d*\.?\d*)' # Current object layer height including current layer height
 #LAYER_HEIGHT = '^;\s?(?:LAYER_HEIGHT|HEIGHT):\s?(\d*\.?\d*)' # Current layer height
@@ -40,6 +41,10 @@ FEATURE_TYPE_WRITE_OUT = '; feature '
 PULSE_OFF='PRIO_OFF'
 PULSE_ON='PRIO_ON'
 
+# Start and end gcode markers
+START_GCODE_END = 'PARAM_SETUP' # Last line of the start gcode
+END_GCODE_START = 'G53 G0 Z=$MA_POS_LIMIT_PLUS[Z]-1' # First line of the end gcode
+
 FAKE_MOVE = '; fake move for elemx builder preview'
 
 LAYERS_COMPLETED_WRITE_OUT = 'LayersCompleted=' #number of layers completed starting from 1
@@ -51,9 +56,26 @@ ADD_ELEMX_PREVIEW_MOVE = True #enable for preview
 DWELL_BEFORE_EXTRUDE = True #also enable this for preview
 DWELL_AFTER_EXTRUDE = False
 OUTPUT_RENAME_OUTER_PERIMETER = INNER_PERIMETER #None or new feature type string
+WRITE_UNMODIFIED_INFILL_VERBATIM = True #write infill/travel islands without bounding box segments as the original lines with only E adjusted
+PASS_THROUGH_LAYERS_OUTSIDE_BOUNDING_BOX = True #copy layers that can not intersect the bounding box Z range to the output unchanged except for the outer perimeter rename and M1 edits
+LAYER_INDEX_CACHE = False #keep the layer index of each input in a cache file so later runs on the unchanged input skip the pre-scan
+LAYER_INDEX_CACHE_DIRECTORY = None #directory of the layer index cache files, None uses a directory in the system temp directory. Never the input directory.
 
 DEBUG_PREVIEW_ALL_DROPLETS_SUPPORTED = False #force all generated droplets to be seen as "supported"
 
+# Droplet placement on supported positions
+PLACEMENT_ENGINE_ROUND_ROBIN = 'roundRobin' # passes over the movements placing at most one droplet per movement per pass
+PLACEMENT_ENGINE_POOLED = 'pooled' # candidates of all movements of the island pooled and placed in a single pass
+PLACEMENT_ENGINE_BLUE_NOISE = 'blueNoise' # candidates of the island sampled as evenly spread blue noise at least the collision kernel apart
+PLACEMENT_ENGINE = PLACEMENT_ENGINE_ROUND_ROBIN
+PLACEMENT_POOLED_FAIRNESS = False #pooled engine keeps the round robin rule of one droplet per movement per pass
+PLACEMENT_SEED = None #seed for reproducible droplet placement with a random stream per layer and infill island. None draws from the unseeded global random module.
+PARALLEL_ISLAND_WORKERS = 0 #place the infill islands of a layer in a pool of this many worker processes. Islands within the collision kernel of each other are placed in order by the same worker. 0 places islands serially as they are read.
+PIPELINE_STAGES = False #parse, plan and emit in separate threads connected by bounded queues so reading and writing overlap with placement
+PIPELINE_QUEUE_SIZE = 64 #tasks a pipeline stage queue holds before the stage feeding it blocks
+PIPELINE_BATCH_SIZE = 256 #output lines passed to the emit stage per task
+BATCH_WORKERS = 0 #worker processes of batch.py, one job per worker process at a time. 0 uses the CPU count.
+
 # PRINT SETTINGS
 LAYER_HEIGHT = 0.24 #mm
 
@@ -75,6 +97,10 @@ MINIMUM_BOUNDARY_BOX_INSET = DROPLET_WIDTH*MINIMUM_INSET_DROPLET_WIDTH #mm
 INSET_DROPLET_WIDTH = 0 #3 #this is in addition to minimum inset!
 BOUNDARY_BOX_INSET = DROPLET_WIDTH*INSET_DROPLET_WIDTH #mm
 
+# INFILL density field
+# lowest average density used for a movement in a bounding box density field since a density of 0 has no droplet spacing
+MINIMUM_DENSITY_FIELD_DENSITY = 0.01
+
 # INFILL Z offset
 # raise Z by this amount when doing any infill feature moves that are on a layer with Z intersection bounding box
 INFILL_Z_OFFSET = 20 #mm
@@ -92,5 +118,7 @@ MPF_INPUT_FILE = 'test-square-25x25x10.mpf'
 INSET_FILENAME = f'{INSET_DROPLET_WIDTH+MINIMUM_INSET_DROPLET_WIDTH:.2f}'
 EXTRUSION_MULTIPLIER_FILENAME = f'{DROPLET_EXTRUSION_MULTIPLIER}'
 
-MPF_OUTPUT_FILE = f"test-square-25x25x10-{EXTRUSION_MULTIPLIER_FILENAME.replace('.','-')}mul-{INSET_FILENAME.replace('.','-')}inset-s{int(DROPLET_RASTER_SUPPORTED_SEARCH_KERNEL_SIZE)}k{int(DROPLET_RASTER_SUPPORTED_SEARCH_CORNER_RADIUS)}r-c{int(DROPLET_RASTER_COLLISION_SEARCH_KERNEL_SIZE)}k{int(DROPLET_RASTER_COLLISION_SEARCH_CORNER_RADIUS)}r.mpf"
+# parameters in output filenames, batch jobs append it to the input filename
+MPF_OUTPUT_SUFFIX = f"{EXTRUSION_MULTIPLIER_FILENAME.replace('.','-')}mul-{INSET_FILENAME.replace('.','-')}inset-s{int(DROPLET_RASTER_SUPPORTED_SEARCH_KERNEL_SIZE)}k{int(DROPLET_RASTER_SUPPORTED_SEARCH_CORNER_RADIUS)}r-c{int(DROPLET_RASTER_COLLISION_SEARCH_KERNEL_SIZE)}k{int(DROPLET_RASTER_COLLISION_SEARCH_CORNER_RADIUS)}r"
+MPF_OUTPUT_FILE = f"test-square-25x25x10-{MPF_OUTPUT_SUFFIX}.mpf"
 GCODE_OUTPUT_FILE = 'test-square-25x25x10-output.gcode'
\ No newline at end of file
@@ -0,0 +1,109 @@
+import abc, struct, typing
+
+import numpy as np
+
+from printing_classes import *
+
+# Density field file header: magic, value type, voxel count X/Y/Z, origin X/Y/Z, voxel size X/Y/Z
+DENSITY_FIELD_MAGIC = b'EDF1'
+DENSITY_FIELD_HEADER = struct.Struct('<4sB3I6d')
+
+# Value types of the density field file. uint8 values are density*255.
+DENSITY_FIELD_UINT8 = 1
+DENSITY_FIELD_FLOAT32 = 4
+
+class DensityField(abc.ABC):
+  """
+  Infill density as a function of (x, y, z) in print coordinates.
+  """
+  @abc.abstractmethod
+  def sample(self, x: np.ndarray, y: np.ndarray, z: np.ndarray) -> np.ndarray:
+    """
+    Return the density at each position. Arrays are broadcast together.
+
+    :return: Density from 0 to 1
+    :rtype: np.ndarray
+    """
+
+class FunctionDensityField(DensityField):
+  """
+  Density from an analytic function of NumPy arrays, e.g. lambda x, y, z: 0.1 + 0.02*np.abs(x)
+  """
+  def __init__(self, function: typing.Callable[[np.ndarray, np.ndarray, np.ndarray], np.ndarray]):
+    self.function = function
+
+  def sample(self, x: np.ndarray, y: np.ndarray, z: np.ndarray) -> np.ndarray:
+    x, y, z = np.broadcast_arrays(x, y, z)
+    return np.clip(np.asarray(self.function(x, y, z), dtype=np.float64), 0, 1)
+
+class VoxelDensityField(DensityField):
+  """
+  Density stored at the voxel centers of a regular grid and trilinearly interpolated. Positions outside the grid use the nearest edge voxels.
+  """
+  def __init__(self, values: np.ndarray, origin: Position, voxelSize: Position):
+    self.values: np.ndarray = np.asarray(values, dtype=np.float32) # [x][y][z]
+    self.origin: Position = origin # lower corner of the first voxel
+    self.voxelSize: Position = voxelSize
+
+  def sample(self, x: np.ndarray, y: np.ndarray, z: np.ndarray) -> np.ndarray:
+    x, y, z = np.broadcast_arrays(x, y, z)
+
+    # continuous voxel index of each position and interpolation weights along each axis
+    lower, weight = [], []
+    for p, o, s, n in zip((x, y, z), (self.origin.X, self.origin.Y, self.origin.Z), (self.voxelSize.X, self.voxelSize.Y, self.voxelSize.Z), self.values.shape):
+      f = np.clip((p - o) / s - 0.5, 0, n - 1)
+      i = np.minimum(np.floor(f).astype(np.int64), max(0, n - 2))
+      lower.append(i)
+      weight.append(f - i)
+
+    (ix, iy, iz), (wx, wy, wz) = lower, weight
+    # upper index stays on the edge voxel for axes with a single voxel
+    jx, jy, jz = (np.minimum(i + 1, n - 1) for i, n in zip(lower, self.values.shape))
+    v = self.values
+    c00 = v[ix, iy, iz] * (1 - wx) + v[jx, iy, iz] * wx
+    c10 = v[ix, jy, iz] * (1 - wx) + v[jx, jy, iz] * wx
+    c01 = v[ix, iy, jz] * (1 - wx) + v[jx, iy, jz] * wx
+    c11 = v[ix, jy, jz] * (1 - wx) + v[jx, jy, jz] * wx
+    return (c00 * (1 - wy) + c10 * wy) * (1 - wz) + (c01 * (1 - wy) + c11 * wy) * wz
+
+def readDensityField(filepath: str) -> VoxelDensityField:
+  """
+  Read a voxel density field file.
+
+  :param filepath: Density field file path
+  :type filepath: str
+  :return: Density field
+  :rtype: VoxelDensityField
+  """
+  with open(filepath, mode='rb') as fieldFile:
+    magic, valueType, nx, ny, nz, ox, oy, oz, sx, sy, sz = DENSITY_FIELD_HEADER.unpack(fieldFile.read(DENSITY_FIELD_HEADER.size))
+    if magic != DENSITY_FIELD_MAGIC:
+      raise ValueError(f"{filepath} is not a density field file")
+    if valueType == DENSITY_FIELD_UINT8:
+      values = np.fromfile(fieldFile, dtype=np.uint8, count=nx*ny*nz).astype(np.float32) / 255
+    elif valueType == DENSITY_FIELD_FLOAT32:
+      values = np.fromfile(fieldFile, dtype='<f4', count=nx*ny*nz)
+    else:
+      raise ValueError(f"Unknown density field value type {valueType}")
+  if values.size != nx*ny*nz:
+    raise ValueError(f"{filepath} is truncated")
+  return VoxelDensityField(values=values.reshape(nx, ny, nz), origin=Position(ox, oy, oz), voxelSize=Position(sx, sy, sz))
+
+def writeDensityField(filepath: str, field: VoxelDensityField, valueType: int = DENSITY_FIELD_UINT8):
+  """
+  Write a voxel density field file. uint8 values store density in steps of 1/255.
+
+  :param filepath: Density field file path
+  :type filepath: str
+  :param field: Density field
+  :type field: VoxelDensityField
+  :param valueType: DENSITY_FIELD_UINT8 or DENSITY_FIELD_FLOAT32
+  :type valueType: int
+  """
+  values = np.clip(field.values, 0, 1)
+  with open(filepath, mode='wb') as fieldFile:
+    fieldFile.write(DENSITY_FIELD_HEADER.pack(DENSITY_FIELD_MAGIC, valueType, *values.shape, field.origin.X, field.origin.Y, field.origin.Z, field.voxelSize.X, field.voxelSize.Y, field.voxelSize.Z))
+    if valueType == DENSITY_FIELD_UINT8:
+      fieldFile.write(np.rint(values * 255).astype(np.uint8).tobytes())
+    else:
+      fieldFile.write(values.astype('<f4').tobytes())
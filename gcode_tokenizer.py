@@ -0,0 +1,152 @@
+import enum
+
+from constants import *
+
+class GcodeLineKind(enum.Enum):
+  MOVEMENT = 'movement' # G0/G1 movement
+  FEATURE = 'feature' # feature type comment
+  MACHINE_M1 = 'm1' # M1 new layer/reset extrusion
+  OTHER = 'other' # misc gcode and comments
+
+# Axes present bit flags
+AXIS_X = 1
+AXIS_Y = 2
+AXIS_Z = 4
+AXIS_E = 8
+
+MOVEMENT_AXES = b'XYZE'
+WHITESPACE = b' \t\n\r\x0b\x0c' # \s for bytes
+SEMICOLON = ord(';')
+SPACE = ord(' ')
+MINUS = ord('-')
+DOT = ord('.')
+
+# Tokenized line
+class GcodeLine:
+  def __init__(self, kind: GcodeLineKind):
+    self.kind: GcodeLineKind = kind
+    self.axes: int = 0 # AXIS_* flags of the axes present
+    self.X: float = None
+    self.Y: float = None
+    self.Z: float = None
+    self.E: float = None
+    self.comment: str = None # movement comment after ;
+    self.featureType: str = None
+
+  def hasAxis(self, axis: int) -> bool:
+    return bool(self.axes & axis)
+
+# Reuse records for the line kinds without values
+OTHER_LINE = GcodeLine(GcodeLineKind.OTHER)
+MACHINE_M1_LINE = GcodeLine(GcodeLineKind.MACHINE_M1)
+
+def scanNumber(cl: bytes, p: int, n: int) -> int:
+  """
+  Return the end index of the number text (-?\\d*\\.?\\d*) starting at p.
+  """
+  if p < n and cl[p] == MINUS:
+    p += 1
+  while p < n and 48 <= cl[p] <= 57:
+    p += 1
+  if p < n and cl[p] == DOT:
+    p += 1
+    while p < n and 48 <= cl[p] <= 57:
+      p += 1
+  return p
+
+def tokenizeMovement(cl: bytes) -> GcodeLine:
+  """
+  Parse the axis words and comment of a G0/G1 line in one pass.
+  Follows MOVEMENT_G: up to 4 whitespace separated X/Y/Z/E words directly after the command, then an optional ; comment.
+  Parsing stops at the first word that is not an axis word (e.g. F), like the regex.
+  """
+  gl = GcodeLine(GcodeLineKind.MOVEMENT)
+  n = len(cl)
+  p = 3
+
+  # optional whitespace after the command
+  if p < n and cl[p] in WHITESPACE:
+    p += 1
+
+  for slot in range(4):
+    q = p
+    if slot > 0: # words after the first word need whitespace before them
+      while q < n and cl[q] in WHITESPACE:
+        q += 1
+      if q == p:
+        break
+    if q >= n or cl[q] not in MOVEMENT_AXES:
+      if slot == 0:
+        continue
+      break
+
+    axis = cl[q]
+
+    # fast path for a plain number word ending at a space or the line end, else scan the number
+    p = cl.find(b' ', q)
+    if p < 0:
+      p = n-1 if cl.endswith(b'\n') else n
+    whole, _, fraction = cl[q+2 if cl[q+1:q+2] == b'-' else q+1:p].partition(b'.')
+    if not ((whole == b'' or whole.isdigit()) and (fraction == b'' or fraction.isdigit())):
+      p = scanNumber(cl, q+1, n)
+    value = float(cl[q+1:p])
+    if axis == 88: # X
+      gl.X = value
+      gl.axes |= AXIS_X
+    elif axis == 89: # Y
+      gl.Y = value
+      gl.axes |= AXIS_Y
+    elif axis == 90: # Z
+      gl.Z = value
+      gl.axes |= AXIS_Z
+    else:
+      gl.E = value
+      gl.axes |= AXIS_E
+
+  # comment is only recorded if it directly follows the axis words and spaces
+  while p < n and cl[p] == SPACE:
+    p += 1
+  if p < n and cl[p] == SEMICOLON:
+    end = cl.find(b'\n', p)
+    gl.comment = cl[p+1:end if end >= 0 else n].decode()
+
+  return gl
+
+def tokenizeFeature(cl: bytes) -> GcodeLine:
+  """
+  Match FEATURE_TYPE (;\\s?feature\\s?(.*)) on a comment line. Return None if the comment is not a feature comment.
+  """
+  n = len(cl)
+  p = 1
+  if p < n and cl[p] in WHITESPACE:
+    p += 1
+  if not cl.startswith(b'feature', p):
+    return None
+  p += 7
+  if p < n and cl[p] in WHITESPACE:
+    p += 1
+  end = cl.find(b'\n', p)
+
+  gl = GcodeLine(GcodeLineKind.FEATURE)
+  gl.featureType = cl[p:end if end >= 0 else n].decode()
+  return gl
+
+def tokenizeLine(cl: bytes) -> GcodeLine:
+  """
+  Classify a line by its first bytes and parse it.
+
+  :param cl: Line including line ending
+  :type cl: bytes
+  :return: Tokenized line. Lines without values share the same record.
+  :rtype: GcodeLine
+  """
+  c = cl[:1]
+  if c == b';':
+    return tokenizeFeature(cl) or OTHER_LINE
+  if c == b'G':
+    if cl.startswith(b'G1 ') or cl.startswith(b'G0 '):
+      return tokenizeMovement(cl)
+  elif c == b'M':
+    if cl.startswith(b'M1') and len(cl) > 2 and cl[2] in WHITESPACE:
+      return MACHINE_M1_LINE
+  return OTHER_LINE
@@ -0,0 +1,99 @@
+import io
+import numpy as np
+
+from constants import *
+
+# Flush output once this many bytes are buffered
+WRITER_BLOCK_SIZE = 1 << 20
+
+class ChunkedWriter:
+  """
+  Buffer output G-code as a list of chunks and flush them to the output file in bounded blocks.
+  Strings are encoded when written. Peak buffered memory is about one block no matter how much is written between flushes.
+  """
+  def __init__(self, file: io.RawIOBase|io.BufferedIOBase, blockSize: int = WRITER_BLOCK_SIZE):
+    self.file = file
+    self.blockSize: int = blockSize
+    self.chunks: list[bytes] = []
+    self.bufferedSize: int = 0
+    self.bytesWritten: int = 0
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.flush()
+
+  def write(self, s: str|bytes|memoryview):
+    if isinstance(s, str):
+      s = s.encode()
+    self.chunks.append(s)
+    self.bufferedSize += len(s)
+    if self.bufferedSize >= self.blockSize:
+      self.flush()
+
+  def flush(self):
+    if self.chunks:
+      self.file.write(b''.join(self.chunks))
+      self.bytesWritten += self.bufferedSize
+      self.chunks = []
+      self.bufferedSize = 0
+
+class DropletTemplate:
+  """
+  G-code block written for each droplet, laid out once from the constants.py flags.
+  The droplet values of a whole batch are filled in with a single %-format of the repeated block.
+  %.5f/%.4f/%.2f and %r format Python floats the same way as the :.5f/:.4f/:.2f and str() formatting in Movement's travelGcodeToEnd() and extrudeAndMoveToEndGcode().
+  """
+  def __init__(self, previewMove: bool = ADD_ELEMX_PREVIEW_MOVE, dwellBefore: bool = DWELL_BEFORE_EXTRUDE, dwellAfter: bool = DWELL_AFTER_EXTRUDE):
+    block = ''
+    fields = [] # droplet value fields in the order of the block placeholders
+    travel = f"{FEATURE_TYPE_WRITE_OUT}{TRAVEL}\n{PULSE_OFF}\n{MOVEMENT_G0} X%.5f Y%.4f Z%.2f ;Travel to end\n"
+    dwell = f"{DWELL_G4}{DROPLET_DWELL:.5f}\n".replace('%', '%%')
+
+    # ElemX preview visual
+    # Add move that is close to the final droplet position but not the same
+    if previewMove:
+      block += f"{FAKE_MOVE}\n"
+      block += travel
+      fields += ['previewX', 'y', 'z']
+
+    # Move to actual droplet position
+    block += travel
+    fields += ['x', 'y', 'z']
+
+    if dwellBefore:
+      block += dwell
+
+    # Extrude movement
+    block += f"{FEATURE_TYPE_WRITE_OUT}{INFILL}\n{PULSE_ON}\n{MOVEMENT_G1} X%.5f Y%.4f Z%.2f E%.5f ; EInc=%r\n"
+    fields += ['x', 'y', 'z', 'e', 'eInc']
+
+    if dwellAfter:
+      block += f"{PULSE_OFF}\n"
+      block += dwell
+
+    self.block: str = block
+    self.fields: list[str] = fields
+
+  def render(self, x: np.ndarray, y: np.ndarray, z: np.ndarray, e: np.ndarray, eInc: np.ndarray) -> str:
+    """
+    Format the blocks of a droplet batch.
+
+    :param x: Droplet X
+    :type x: np.ndarray
+    :param y: Droplet Y
+    :type y: np.ndarray
+    :param z: Droplet Z including bounding box Z offset
+    :type z: np.ndarray
+    :param e: Droplet end E
+    :type e: np.ndarray
+    :param eInc: Droplet relative E
+    :type eInc: np.ndarray
+    :return: G-code for all droplets
+    :rtype: str
+    """
+    values = {'previewX': x + 0.00001, 'x': x, 'y': y, 'z': z, 'e': e, 'eInc': eInc}
+    # interleave per droplet values row by row, tolist() gives Python floats for %r
+    columns = np.column_stack([values[f] for f in self.fields]).ravel().tolist()
+    return (self.block * len(x)) % tuple(columns)
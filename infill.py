@@ -1,6 +1,9 @@
-import math, copy
+import math, copy, functools
+
+import numpy as np
 
 from printing_classes import *
+from mesh_region import *
 from constants import *
 
 
@@ -10,12 +13,171 @@ def getBBDropletRasterIndicesForPosition(bb: BoundingBox, pos: Position):
   #return (math.ceil((1/bb.dropletOverlap)/2) + round((pos.X-bb.origin.X)/(DROPLET_WIDTH*bb.dropletOverlap)), math.ceil((1/bb.dropletOverlap)/2) + round((pos.Y-bb.origin.Y)/(DROPLET_WIDTH*bb.dropletOverlap)))
 
 def fillBBDropletRasterForDroplet(bb: BoundingBox, droplet: Movement):
-  indices = getBBDropletRasterIndicesForPosition(bb=bb, pos=droplet.end)
-  bb.dropletRaster[1][indices[0]][indices[1]] = 1
+  fillBBDropletRasterForPosition(bb=bb, pos=droplet.end)
+
+def fillBBDropletRasterForPosition(bb: BoundingBox, pos: Position):
+  indices = getBBDropletRasterIndicesForPosition(bb=bb, pos=pos)
+  bb.dropletRaster[1][indices[0], indices[1]] = 1
+  stampBBDropletRasterBlocked(bb=bb, rasterX=indices[0], rasterY=indices[1])
+
+def fillBBDropletRasterForDropletBatch(bb: BoundingBox, droplets: DropletBatch):
+  rasterX = np.rint((droplets.X-bb.origin.X)/(DROPLET_WIDTH*bb.dropletRasterResolution)).astype(np.int64)
+  rasterY = np.rint((droplets.Y-bb.origin.Y)/(DROPLET_WIDTH*bb.dropletRasterResolution)).astype(np.int64)
+  # the last droplet of a movement ending on the far edge of a box can be centered past the edge of the raster
+  inRaster = (rasterX < bb.dropletRaster[1].shape[0]) & (rasterY < bb.dropletRaster[1].shape[1])
+  rasterX, rasterY = rasterX[inRaster], rasterY[inRaster]
+  bb.dropletRaster[1][rasterX, rasterY] = 1
+  for x, y in set(zip(rasterX.tolist(), rasterY.tolist())):
+    stampBBDropletRasterBlocked(bb=bb, rasterX=x, rasterY=y)
+
+def stampBBDropletRasterBlocked(bb: BoundingBox, rasterX: int, rasterY: int):
+  """
+  Mark the collision kernel footprint around a filled current layer raster cell as blocked. 
+  The collision kernel is symmetric so a position is blocked exactly when the collision kernel around it contains a filled cell.
+
+  :param bb: BoundingBox
+  :type bb: BoundingBox
+  :param rasterX: X index of the filled cell
+  :type rasterX: int
+  :param rasterY: Y index of the filled cell
+  :type rasterY: int
+  """
+  # use the cell that was actually filled when a negative index wrapped around
+  if rasterX < 0:
+    rasterX += bb.dropletRaster[1].shape[0]
+  if rasterY < 0:
+    rasterY += bb.dropletRaster[1].shape[1]
+
+  mask = getNxNKernelMask(DROPLET_RASTER_COLLISION_SEARCH_KERNEL_SIZE, DROPLET_RASTER_COLLISION_SEARCH_CORNER_RADIUS)
+  bb.dropletRasterBlocked[rasterX:rasterX+mask.shape[0], rasterY:rasterY+mask.shape[1]] |= mask
+
+def isBBDropletRasterPositionBlocked(bb: BoundingBox, pos: Position) -> bool:
+  """
+  Check if a droplet at the position would collide with a droplet already placed on the current layer. 
+  Same result as the collision kernel search with getNxNBBDropletRasterForPosition on the current layer but as a single lookup.
+
+  :param bb: BoundingBox
+  :type bb: BoundingBox
+  :param pos: Position to check
+  :type pos: Position
+  :return: True if the position is blocked
+  :rtype: bool
+  """
+  indices = getBBDropletRasterIndicesForPosition(bb=bb, pos=pos)
+  return isBBDropletRasterIndexBlocked(bb=bb, rasterX=indices[0], rasterY=indices[1])
+
+def isBBDropletRasterIndexBlocked(bb: BoundingBox, rasterX: int, rasterY: int) -> bool:
+  """
+  isBBDropletRasterPositionBlocked() for a droplet raster index that is already known.
+  """
+  collisionSideDist = int((DROPLET_RASTER_COLLISION_SEARCH_KERNEL_SIZE-1)/2)
+  blockedX, blockedY = rasterX+collisionSideDist, rasterY+collisionSideDist
+  if blockedX < 0 or blockedX >= bb.dropletRasterBlocked.shape[0] or blockedY < 0 or blockedY >= bb.dropletRasterBlocked.shape[1]:
+    return False
+  return bool(bb.dropletRasterBlocked[blockedX, blockedY])
+
+def isBBDropletRasterIndexInset(bb: BoundingBox, rasterX: np.ndarray|int, rasterY: np.ndarray|int, height: float, insetDistIndices: int) -> np.ndarray|bool:
+  """
+  Look up if droplet raster indices are inside the bounding box region and at least the inset distance from its edge.
+
+  :param bb: BoundingBox
+  :type bb: BoundingBox
+  :param rasterX: X raster indices
+  :type rasterX: np.ndarray|int
+  :param rasterY: Y raster indices
+  :type rasterY: np.ndarray|int
+  :param height: Layer height
+  :type height: float
+  :param insetDistIndices: Inset distance in raster indices
+  :type insetDistIndices: int
+  :return: True where the index is inset
+  :rtype: np.ndarray|bool
+  """
+  # the polygon of a mesh region changes with the layer height
+  mask = bb.insetMaskAtHeight(height=height, insetDistIndices=insetDistIndices) if isinstance(bb, MeshBoundingBox) else bb.insetMask(insetDistIndices=insetDistIndices)
+  inMask = (rasterX >= 0) & (rasterX < mask.shape[0]) & (rasterY >= 0) & (rasterY < mask.shape[1])
+  return inMask & mask[np.clip(rasterX, 0, mask.shape[0]-1), np.clip(rasterY, 0, mask.shape[1]-1)]
 
 def getBBDropletRasterForPosition(bb: BoundingBox, pos: Position, idx: int):
   indices = getBBDropletRasterIndicesForPosition(bb=bb, pos=pos)
-  return bb.dropletRaster[idx][indices[0]][indices[1]]
+  return bb.dropletRaster[idx][indices[0], indices[1]]
+
+@functools.cache
+def getNxNKernelMask(n: int, excludeCornerDropletRadius: int) -> np.ndarray:
+  """
+  Return the NxN search kernel as a boolean mask. Each row of the kernel excludes the corner cells that are within the corner radius.
+
+  :param n: Kernel size (odd number)
+  :type n: int
+  :param excludeCornerDropletRadius: Corner radius in raster index widths to exclude from the kernel
+  :type excludeCornerDropletRadius: int
+  :return: Boolean mask of shape (n, n) indexed [x][y] relative to the kernel corner
+  :rtype: np.ndarray
+  """
+  sideDist = int((n-1)/2)
+  mask = np.zeros((n, n), dtype=bool)
+  for i in range(-sideDist, sideDist+1):
+    cornerExclude = max(0, excludeCornerDropletRadius-(sideDist-abs(i)))
+    mask[i+sideDist, cornerExclude:n-cornerExclude] = True
+  mask.flags.writeable = False
+  return mask
+
+@functools.cache
+def getNxNKernelRectangles(n: int, excludeCornerDropletRadius: int) -> tuple[tuple[int, int, int, int], ...]:
+  """
+  Decompose the NxN search kernel into non overlapping rectangles. Consecutive kernel rows with the same corner exclusion are merged into one rectangle.
+
+  :param n: Kernel size (odd number)
+  :type n: int
+  :param excludeCornerDropletRadius: Corner radius in raster index widths to exclude from the kernel
+  :type excludeCornerDropletRadius: int
+  :return: Rectangles as (x0, x1, y0, y1) inclusive offsets from the kernel center
+  :rtype: tuple[tuple[int, int, int, int], ...]
+  """
+  sideDist = int((n-1)/2)
+  rectangles: list[list[int]] = []
+  for i in range(-sideDist, sideDist+1):
+    cornerExclude = max(0, excludeCornerDropletRadius-(sideDist-abs(i)))
+    y0, y1 = -sideDist+cornerExclude, sideDist-cornerExclude
+    if rectangles and rectangles[-1][2] == y0 and rectangles[-1][3] == y1:
+      rectangles[-1][1] = i
+    else:
+      rectangles.append([i, i, y0, y1])
+  return tuple(tuple(r) for r in rectangles)
+
+def getSummedAreaRectangleSum(table: np.ndarray, x0: int, x1: int, y0: int, y1: int) -> int:
+  """
+  Return the raster sum inside an inclusive index rectangle using a summed-area table. The rectangle is clipped to the raster edges.
+  """
+  x0, x1 = max(0, x0), min(table.shape[0]-1, x1+1)
+  y0, y1 = max(0, y0), min(table.shape[1]-1, y1+1)
+  if x0 >= x1 or y0 >= y1:
+    return 0
+  return int(table[x1, y1] - table[x0, y1] - table[x1, y0] + table[x0, y0])
+
+def getNxNSummedAreaForIndices(table: np.ndarray, rasterX: np.ndarray, rasterY: np.ndarray, n: int, excludeCornerDropletRadius: int) -> np.ndarray:
+  """
+  Vectorized NxN kernel search for many raster indices at once using a summed-area table.
+
+  :param table: Summed-area table of the raster
+  :type table: np.ndarray
+  :param rasterX: X raster indices
+  :type rasterX: np.ndarray
+  :param rasterY: Y raster indices
+  :type rasterY: np.ndarray
+  :return: Boolean array that is True where the kernel contains a filled cell
+  :rtype: np.ndarray
+  """
+  found = np.zeros(rasterX.shape, dtype=bool)
+  maxX, maxY = table.shape[0]-1, table.shape[1]-1
+  for x0, x1, y0, y1 in getNxNKernelRectangles(n, excludeCornerDropletRadius):
+    # clipping to the raster makes rectangles outside of the raster empty
+    rx0 = np.clip(rasterX+x0, 0, maxX)
+    rx1 = np.clip(rasterX+x1+1, 0, maxX)
+    ry0 = np.clip(rasterY+y0, 0, maxY)
+    ry1 = np.clip(rasterY+y1+1, 0, maxY)
+    found |= (table[rx1, ry1] - table[rx0, ry1] - table[rx1, ry0] + table[rx0, ry0]) > 0
+  return found
 
 def getNxNBBDropletRasterForPosition(bb: BoundingBox, pos: Position, idx: int, n: int, excludeCornerDropletRadius: int):
   indices = getBBDropletRasterIndicesForPosition(bb=bb, pos=pos)
@@ -27,68 +189,143 @@ def getNxNBBDropletRasterForPosition(bb: BoundingBox, pos: Position, idx: int, n
     print(f'excludeCornerDropletRadius {excludeCornerDropletRadius} is greater than sideDistance {sideDist}\n')
     0==1 #abort
 
-  for i in range(rasterX-sideDist, rasterX+sideDist+1):
-    if i >= 0 and i < len(bb.dropletRaster[idx]):
-      for j in range(rasterY-sideDist+max(0, excludeCornerDropletRadius-(sideDist-abs(rasterX-i))), rasterY+sideDist+1-max(0, excludeCornerDropletRadius-(sideDist-abs(rasterX-i)))):
-        if j >= 0 and j < len(bb.dropletRaster[idx][i]):
-          if bb.dropletRaster[idx][i][j]:
-            return bb.dropletRaster[idx][i][j]
+  # last layer is not modified after layer change so use the summed-area table built on layer change
+  if idx == 0 and bb.dropletRasterSummedArea is not None:
+    table = bb.dropletRasterSummedArea
+    for x0, x1, y0, y1 in getNxNKernelRectangles(n, excludeCornerDropletRadius):
+      if getSummedAreaRectangleSum(table, rasterX+x0, rasterX+x1, rasterY+y0, rasterY+y1) > 0:
+        return 1
+    return 0
 
-  return 0
+  raster = bb.dropletRaster[idx]
+  mask = getNxNKernelMask(n, excludeCornerDropletRadius)
 
-def reduceDropletsToDensity(droplets: list[Movement], density: float) -> list[Movement]:
+  # clip the kernel window to the raster edges
+  x0, x1 = max(0, rasterX-sideDist), min(raster.shape[0], rasterX+sideDist+1)
+  y0, y1 = max(0, rasterY-sideDist), min(raster.shape[1], rasterY+sideDist+1)
+  if x0 >= x1 or y0 >= y1:
+    return 0
+
+  window = raster[x0:x1, y0:y1]
+  windowMask = mask[x0-(rasterX-sideDist):x1-(rasterX-sideDist), y0-(rasterY-sideDist):y1-(rasterY-sideDist)]
+  return int(window.max(where=windowMask, initial=0))
+
+def reducedDropletIndices(numDroplets: int, density: float) -> np.ndarray:
   """
   Reduce # dots to % density. Evenly space droplets inclusive of start and end segments.
 
-  :param droplets: The chain of droplets to reduce in density.
-  :type droplets: list[Movement]
+  :param numDroplets: Number of droplets in the chain of droplets to reduce in density.
+  :type numDroplets: int
   :param density: Target density.
   :type density: float
-  :return: List of droplets at the target density.
-  :rtype: list[Movement]
+  :return: Indices of the droplets at the target density.
+  :rtype: np.ndarray
   """  
 
-  #density = 0.03
-
-  numDroplets = len(droplets)
   nthDroplet = 1/density 
   steps = round(numDroplets/nthDroplet) - 1 #number of steps after the 0th (first) step
 
-  reducedDroplets: list[Movement] = []
-
   if steps > 1:
     inset45DegreeDropletCount = (MINIMUM_INSET_DROPLET_WIDTH+INSET_DROPLET_WIDTH)*2**0.5
-    for i in range(0, steps + 1):
-      # Check if scaled droplets is enough drops if we avoid dropping in inset assuming bounding box is exactly where infill bounds are. Assume 45 degree infill angle on average.
-      #reducedDroplets.append(droplets[round((i)*(numDroplets-1)/steps)]) #drop evenly spaced
-      if numDroplets <= steps+1: #drop all drops
-        reducedDroplets.extend(droplets)
-        break
-      elif numDroplets - math.floor(inset45DegreeDropletCount)*2 < steps+1:
-        insetDropletCountOnEnds = math.floor((numDroplets - (steps+1)) / 2)
-        reducedDroplets.extend(droplets[insetDropletCountOnEnds:insetDropletCountOnEnds+steps+1]) #drop center droplets
-      else: #drop avoiding inset distance on either end
-        reducedDroplets.append(droplets[math.floor(inset45DegreeDropletCount) + round((i)*(numDroplets-1-inset45DegreeDropletCount*2)/steps)]) #drop evenly spaced
+    # Check if scaled droplets is enough drops if we avoid dropping in inset assuming bounding box is exactly where infill bounds are. Assume 45 degree infill angle on average.
+    if numDroplets <= steps+1: #drop all drops
+      return np.arange(numDroplets)
+    elif numDroplets - math.floor(inset45DegreeDropletCount)*2 < steps+1: #drop center droplets. Center droplets are added for every step.
+      insetDropletCountOnEnds = math.floor((numDroplets - (steps+1)) / 2)
+      return np.tile(np.arange(insetDropletCountOnEnds, insetDropletCountOnEnds+steps+1), steps+1)
+    else: #drop avoiding inset distance on either end
+      return math.floor(inset45DegreeDropletCount) + np.rint(np.arange(steps + 1)*(numDroplets-1-inset45DegreeDropletCount*2)/steps).astype(np.int64) #drop evenly spaced
 
   else: # Special case if total output droplet count is 1 or 2
     if steps > 0: # output 2 droplets evenly spaced exclusive of endpoints
-      reducedDroplets.append(droplets[math.floor(numDroplets/3) if numDroplets/3 > 1.5 else math.floor(numDroplets/3)-1])
-      reducedDroplets.append(droplets[math.floor(numDroplets/3*2)])
+      return np.array([math.floor(numDroplets/3) if numDroplets/3 > 1.5 else math.floor(numDroplets/3)-1, math.floor(numDroplets/3*2)])
     else: # output 1 droplet (center)
-      reducedDroplets.append(droplets[round(numDroplets/2)])
+      return np.array([round(numDroplets/2)])
+
+def densitiesAlongMovements(bb: BoundingBox, movements: list[Movement], height: float) -> np.ndarray:
+  """
+  Return the average of the bounding box density map along each movement. Each movement is sampled at the droplet raster resolution and all samples are looked up and summed in one batch.
+
+  :param bb: BoundingBox with a density field
+  :type bb: BoundingBox
+  :param movements: Movements in the bounding box
+  :type movements: list[Movement]
+  :param height: Layer height
+  :type height: float
+  :return: Average density of each movement
+  :rtype: np.ndarray
+  """
+  if not movements:
+    return np.zeros(0)
+
+  densityMap = bb.densityMapAtHeight(height=height)
+  source = bb.layerGeometrySource
+  xyResolution = DROPLET_WIDTH*source.dropletRasterResolution
+
+  segments = np.array([(m.start.X, m.start.Y, m.end.X, m.end.Y) for m in movements], dtype=np.float64)
+  dx, dy = segments[:, 2] - segments[:, 0], segments[:, 3] - segments[:, 1]
+  sampleCounts = np.maximum(1, np.ceil(np.hypot(dx, dy) / xyResolution)).astype(np.int64)
+
+  # sample at the middle of each raster resolution step of every movement
+  offsets = np.cumsum(sampleCounts) - sampleCounts
+  step = np.arange(sampleCounts.sum()) - np.repeat(offsets, sampleCounts)
+  t = (step + 0.5) / np.repeat(sampleCounts, sampleCounts)
+  x = np.repeat(segments[:, 0], sampleCounts) + t * np.repeat(dx, sampleCounts)
+  y = np.repeat(segments[:, 1], sampleCounts) + t * np.repeat(dy, sampleCounts)
 
-  return reducedDroplets
+  rasterX = np.clip(np.rint((x - source.origin.X) / xyResolution).astype(np.int64), 0, densityMap.shape[0]-1)
+  rasterY = np.clip(np.rint((y - source.origin.Y) / xyResolution).astype(np.int64), 0, densityMap.shape[1]-1)
+  return np.add.reduceat(densityMap[rasterX, rasterY].astype(np.float64), offsets) / sampleCounts
 
-def splitMovementToDroplets(m: Movement, singleDropletWidthResolution: bool) -> list[Movement]:
+def reduceDropletsToDensity(droplets: DropletBatch, density: float) -> DropletBatch:
   """
-  Split movement into individual droplets
+  Reduce # dots to % density. Evenly space droplets inclusive of start and end segments.
 
-  :param m: The movement to split into droplets
-  :type m: Movement
-  :return: List of droplets for the movement
-  :rtype: list[Movement]
+  :param droplets: The chain of droplets to reduce in density.
+  :type droplets: DropletBatch
+  :param density: Target density.
+  :type density: float
+  :return: Droplets at the target density.
+  :rtype: DropletBatch
   """  
+  return droplets.select(reducedDropletIndices(numDroplets=len(droplets), density=density))
+
+def reducedDropletCountForDensity(numDroplets: int, density: float) -> int:
+  """
+  Return the number of droplets reduceDropletsToDensity returns for a chain of droplets without needing the droplets.
+
+  :param numDroplets: Number of droplets in the chain
+  :type numDroplets: int
+  :param density: Target density.
+  :type density: float
+  :return: Number of droplets at the target density.
+  :rtype: int
+  """
+  nthDroplet = 1/density
+  steps = round(numDroplets/nthDroplet) - 1 #number of steps after the 0th (first) step
 
+  if steps > 1:
+    inset45DegreeDropletCount = (MINIMUM_INSET_DROPLET_WIDTH+INSET_DROPLET_WIDTH)*2**0.5
+    if numDroplets <= steps+1: #drop all drops
+      return numDroplets
+    elif numDroplets - math.floor(inset45DegreeDropletCount)*2 < steps+1: #center droplets are added for every step
+      return (steps+1)*(steps+1)
+    else: #drop avoiding inset distance on either end
+      return steps+1
+  elif steps > 0:
+    return 2
+  else:
+    return 1
+
+def dropletSegmentsForMovement(m: Movement, singleDropletWidthResolution: bool) -> tuple[float, float, float, float]:
+  """
+  Return the droplet count and the per droplet X/Y/E deltas of a movement split into droplets.
+
+  :param m: The movement to split into droplets
+  :type m: Movement
+  :return: Fractional droplet count, X delta, Y delta, E delta
+  :rtype: tuple[float, float, float, float]
+  """
   x_delta = m.end.X-m.start.X
   y_delta = m.end.Y-m.start.Y
   e_delta = m.end.E-m.start.E
@@ -100,22 +337,42 @@ def splitMovementToDroplets(m: Movement, singleDropletWidthResolution: bool) ->
   segment_y_delta = y_delta / dropletCount
   segment_e_delta = (e_delta / dropletCount) * (1 if singleDropletWidthResolution else 1/DROPLET_RASTER_RESOLUTION_PERC)
 
+  return dropletCount, segment_x_delta, segment_y_delta, segment_e_delta
+
+def planMovementDroplets(m: Movement, singleDropletWidthResolution: bool) -> int:
+  """
+  Set the droplet E of a movement and return how many droplets it splits into without creating the droplets.
+
+  :param m: The movement to plan droplets for
+  :type m: Movement
+  :return: Number of droplets splitMovementToDroplets would return
+  :rtype: int
+  """
+  dropletCount, _, _, segment_e_delta = dropletSegmentsForMovement(m=m, singleDropletWidthResolution=singleDropletWidthResolution)
+
   m.dropletE = segment_e_delta * DROPLET_EXTRUSION_MULTIPLIER
 
-  newDroplets: list[Movement] = []
+  return max(0, math.ceil(dropletCount))
+
+def splitMovementToDroplets(m: Movement, singleDropletWidthResolution: bool) -> DropletBatch:
+  """
+  Split movement into individual droplets
+
+  :param m: The movement to split into droplets
+  :type m: Movement
+  :return: Droplets for the movement
+  :rtype: DropletBatch
+  """  
+
+  dropletCount, segment_x_delta, segment_y_delta, segment_e_delta = dropletSegmentsForMovement(m=m, singleDropletWidthResolution=singleDropletWidthResolution)
+
+  m.dropletE = segment_e_delta * DROPLET_EXTRUSION_MULTIPLIER
 
-  for i in range(0, math.ceil(dropletCount)):
-    start = copy.copy(m.start)
-    start.E += segment_e_delta * i
-    start.X += segment_x_delta * (i+0.5)
-    start.Y += segment_y_delta * (i+0.5)
+  i = np.arange(max(0, math.ceil(dropletCount)))
+  startE = m.start.E + segment_e_delta * i
+  endE = startE + segment_e_delta * DROPLET_EXTRUSION_MULTIPLIER
 
-    end = copy.copy(start)
-    end.E += segment_e_delta * DROPLET_EXTRUSION_MULTIPLIER
-    droplet = Movement(startPos=start, endPos=end, boundingBox=m.boundingBox)
-    newDroplets.append(droplet)
-  
-  return newDroplets
+  return DropletBatch(x=m.start.X + segment_x_delta * (i+0.5), y=m.start.Y + segment_y_delta * (i+0.5), z=np.full(len(i), m.start.Z, dtype=np.float64), e=startE, eInc=endE - startE, movement=m)
 
 def findSupportedLocations(m: Movement) -> list[(int,Position)]:
   """
@@ -147,7 +404,9 @@ def findSupportedLocations(m: Movement) -> list[(int,Position)]:
 
   supportedLocations: list[(int,Position)] = []
 
-  insetPercentage = 1 - m.boundingBox.percentThroughRampUpDensityZone(m.end.Z)
+  insetPercentage = m.boundingBox.geometryAtHeight(height=m.end.Z).insetPercentage
+
+  insetDistIndices = math.floor(MINIMUM_BOUNDARY_BOX_INSET/xyResolution + BOUNDARY_BOX_INSET/xyResolution*insetPercentage)
 
   for i in range(0, math.ceil(interpolationSteps)):
     checkPosition = copy.copy(m.start)
@@ -155,16 +414,12 @@ def findSupportedLocations(m: Movement) -> list[(int,Position)]:
     checkPosition.Y += interpolate_y_delta * i
     checkPosition.E = 0
 
-    # Check if position is too close to edge of bounding box
+    # Check if position is outside or too close to edge of bounding box
     rasterIndices = getBBDropletRasterIndicesForPosition(bb=m.boundingBox, 
     pos=checkPosition)
     #rasterIndices = tuple(rasterIndices[ri]-math.ceil((1/m.boundingBox.dropletOverlap)/2) for ri in range(len(rasterIndices))) #subtract raster indices by padded amount on raster edge to get 0 based location relative to bounding box origin
 
-    insetDistIndices = math.floor(MINIMUM_BOUNDARY_BOX_INSET/xyResolution + BOUNDARY_BOX_INSET/xyResolution*insetPercentage)
-
-    if rasterIndices[0] < insetDistIndices or rasterIndices[0] > len(m.boundingBox.dropletRaster[0]) - insetDistIndices:
-      continue 
-    if rasterIndices[1] < insetDistIndices or rasterIndices[1] > len(m.boundingBox.dropletRaster[0][0]) - insetDistIndices:
+    if not isBBDropletRasterIndexInset(bb=m.boundingBox, rasterX=rasterIndices[0], rasterY=rasterIndices[1], height=m.end.Z, insetDistIndices=insetDistIndices):
       continue 
 
     if getNxNBBDropletRasterForPosition(bb=m.boundingBox, pos=checkPosition, idx=0, n=DROPLET_RASTER_SUPPORTED_SEARCH_KERNEL_SIZE, excludeCornerDropletRadius=DROPLET_RASTER_SUPPORTED_SEARCH_CORNER_RADIUS) > 0:
@@ -182,4 +437,59 @@ def findSupportedLocations(m: Movement) -> list[(int,Position)]:
     if getNxNBBDropletRasterForPosition(bb=m.boundingBox, pos=checkPositionRight, idx=0, n=DROPLET_RASTER_SUPPORTED_SEARCH_KERNEL_SIZE, excludeCornerDropletRadius=DROPLET_RASTER_SUPPORTED_SEARCH_CORNER_RADIUS) > 0:
       supportedLocations.append((i,checkPositionRight))
 
-  return supportedLocations
\ No newline at end of file
+  return supportedLocations
+
+def findSupportedLocationsBatch(m: Movement) -> SupportedLocations:
+  """
+  Batched findSupportedLocations. All interpolated center, left and right check positions of the Movement, the inset check and the supported search are computed as arrays.
+
+  :param m: The movement
+  :return: Supported locations in the same order as findSupportedLocations
+  :rtype: SupportedLocations
+  """
+
+  x_delta = m.end.X-m.start.X
+  y_delta = m.end.Y-m.start.Y
+
+  xyResolution = DROPLET_WIDTH*m.boundingBox.dropletRasterResolution
+
+  interpolate_x_delta = 0
+  interpolate_y_delta = 0
+
+  # normalize x/y delta for interpolation by raster resolution
+  if y_delta > x_delta:
+    interpolate_x_delta = xyResolution/y_delta * x_delta
+    interpolate_y_delta = xyResolution
+  else:
+    interpolate_y_delta = xyResolution/x_delta * y_delta
+    interpolate_x_delta = xyResolution
+
+  interpolationSteps = x_delta/interpolate_x_delta
+
+  insetPercentage = m.boundingBox.geometryAtHeight(height=m.end.Z).insetPercentage
+  insetDistIndices = math.floor(MINIMUM_BOUNDARY_BOX_INSET/xyResolution + BOUNDARY_BOX_INSET/xyResolution*insetPercentage)
+
+  steps = np.arange(max(0, math.ceil(interpolationSteps)))
+
+  # [step][center|left|right]
+  checkX = np.empty((len(steps), 3))
+  checkY = np.empty((len(steps), 3))
+  checkX[:, 0] = m.start.X + interpolate_x_delta * steps
+  checkY[:, 0] = m.start.Y + interpolate_y_delta * steps
+  checkX[:, 1] = checkX[:, 0] + -1*interpolate_y_delta
+  checkY[:, 1] = checkY[:, 0] + interpolate_x_delta
+  checkX[:, 2] = checkX[:, 0] + interpolate_y_delta
+  checkY[:, 2] = checkY[:, 0] + -1*interpolate_x_delta
+
+  rasterX = np.rint((checkX-m.boundingBox.origin.X)/xyResolution).astype(np.int64)
+  rasterY = np.rint((checkY-m.boundingBox.origin.Y)/xyResolution).astype(np.int64)
+
+  # Check if center position is outside or too close to edge of bounding box
+  inset = isBBDropletRasterIndexInset(bb=m.boundingBox, rasterX=rasterX[:, 0], rasterY=rasterY[:, 0], height=m.end.Z, insetDistIndices=insetDistIndices)
+
+  supported = getNxNSummedAreaForIndices(m.boundingBox.dropletRasterSummedArea, rasterX, rasterY, n=DROPLET_RASTER_SUPPORTED_SEARCH_KERNEL_SIZE, excludeCornerDropletRadius=DROPLET_RASTER_SUPPORTED_SEARCH_CORNER_RADIUS)
+  supported &= inset[:, np.newaxis]
+
+  # flatten in step order with center, left, right order for each step
+  supportedFlat = supported.ravel()
+  return SupportedLocations(index=np.repeat(steps, 3)[supportedFlat], x=checkX.ravel()[supportedFlat], y=checkY.ravel()[supportedFlat], template=m.start)
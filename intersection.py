@@ -1,8 +1,12 @@
 import re, os, typing, queue, time, datetime, math, enum, copy
 
+import numpy as np
+
 from printing_classes import *
 from constants import *
 from line_ending import *
+from bounding_box_index import *
+from mesh_region import *
 
 
 #https://stackoverflow.com/a/72474223/761902
@@ -29,81 +33,212 @@ def point_in_box(p1: Position, boundingBox: BoundingBox):
     return True
   return False
 
-# check if movement is in bounding box and split movement by intersections
-# return array of new movements or false if no intersection
-def boundingBoxSplit(movement: Movement, boundingBox: BoundingBox):
+def clipSegmentToBox(x0: float, y0: float, x1: float, y1: float, minX: float, minY: float, maxX: float, maxY: float) -> tuple[float, float]|None:
+  """
+  Liang-Barsky clip of a segment to an axis aligned box.
+  Segments that only touch the box at a point, run along an edge, or have zero length are outside.
+
+  :return: Segment parameters (tEnter, tExit) of the part inside the box or None if no part of the segment is inside
+  :rtype: tuple[float, float]|None
+  """
+  dx, dy = x1 - x0, y1 - y0
+  tEnter, tExit = 0.0, 1.0
+  # p is the segment direction towards the outside of each edge, q is the distance of the start inside the edge
+  for p, q in ((-dx, x0 - minX), (dx, maxX - x0), (-dy, y0 - minY), (dy, maxY - y0)):
+    if p == 0: # parallel to the edge
+      if q <= 0:
+        return None
+    elif p < 0: # entering
+      tEnter = max(tEnter, q / p)
+    else: # leaving
+      tExit = min(tExit, q / p)
+  if tEnter >= tExit:
+    return None
+  return tEnter, tExit
+
+def clipSegmentsToBox(x0: np.ndarray, y0: np.ndarray, x1: np.ndarray, y1: np.ndarray, minX: np.ndarray, minY: np.ndarray, maxX: np.ndarray, maxY: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+  """
+  Batched clipSegmentToBox(). Box bounds can be per segment arrays or scalars.
+
+  :return: tEnter, tExit, and mask of segments with a part inside the box. tEnter/tExit are only meaningful where the mask is set.
+  :rtype: tuple[np.ndarray, np.ndarray, np.ndarray]
+  """
+  dx, dy = x1 - x0, y1 - y0
+  p = np.stack(np.broadcast_arrays(-dx, dx, -dy, dy))
+  q = np.stack(np.broadcast_arrays(x0 - minX, maxX - x0, y0 - minY, maxY - y0))
+  with np.errstate(divide='ignore', invalid='ignore'):
+    t = q / p
+  tEnter = np.where(p < 0, t, 0.0).max(axis=0, initial=0.0)
+  tExit = np.where(p > 0, t, 1.0).min(axis=0, initial=1.0)
+  inside = ~((p == 0) & (q <= 0)).any(axis=0) & (tEnter < tExit)
+  return tEnter, tExit, inside
+
+def currentBoundingBoxAtHeight(boundingBox: BoundingBox, height: float) -> BoundingBox:
+  geometry = boundingBox.geometryAtHeight(height=height)
   currentBoundingBox = copy.copy(boundingBox) #only use this for intersection checking
-  currentBoundingBox.origin = boundingBox.currentBoundingBoxOriginAtHeight(movement.end.Z)
-  currentBoundingBox.size = boundingBox.currentBoundingBoxSizeAtHeight(movement.end.Z)
+  if isinstance(boundingBox, MeshBoundingBox): # mesh regions keep the mesh bounds that their raster and inside mask are indexed from
+    return currentBoundingBox
+  currentBoundingBox.origin = geometry.origin
+  currentBoundingBox.size = geometry.size
+  return currentBoundingBox
+
+def positionAtClip(movement: Movement, t: float) -> Position:
+  # intersection is at the movement end Z since Z is not clipped. E is interpolated along the movement.
+  return Position(x=movement.start.X + t * (movement.end.X - movement.start.X), y=movement.start.Y + t * (movement.end.Y - movement.start.Y), z=movement.end.Z, e=movement.start.E + t * (movement.end.E - movement.start.E))
+
+def splitMovementAtClips(movement: Movement, clips: list[tuple[float, float, BoundingBox, BoundingBox]]) -> list[Movement]:
+  """
+  Split a movement at the clip parameters of one or more bounding boxes into the parts outside and inside each box.
+  A movement entirely inside one box is a copy of the movement with the current bounding box. Split parts inside use the bounding box.
+
+  :param movement: Movement to split
+  :type movement: Movement
+  :param clips: (tEnter, tExit, bounding box, current bounding box at the movement height) of non overlapping clips sorted by tEnter
+  :type clips: list[tuple[float, float, BoundingBox, BoundingBox]]
+  :return: Split movements
+  :rtype: list[Movement]
+  """
+  if len(clips) == 1 and clips[0][0] <= 0 and clips[0][1] >= 1:
+    movementWithBoundingBox = copy.copy(movement)
+    movementWithBoundingBox.boundingBox = clips[0][3]
+    return [movementWithBoundingBox]
 
   newMovements: list[Movement] = []
+  start, t = movement.start, 0.0 # start position and parameter of the next part
+  for tEnter, tExit, boundingBox, _ in clips:
+    if tEnter > t: # part outside before the box
+      enter = positionAtClip(movement=movement, t=tEnter)
+      newMovements.append(Movement(startPos=start, endPos=enter, boundingBox=None, feature=movement.feature))
+      start = enter
+    if tExit >= 1: # movement ends in the box
+      newMovements.append(Movement(startPos=start, endPos=movement.end, boundingBox=boundingBox, feature=movement.feature))
+      return newMovements
+    exit = positionAtClip(movement=movement, t=tExit)
+    newMovements.append(Movement(startPos=start, endPos=exit, boundingBox=boundingBox, feature=movement.feature))
+    start, t = exit, tExit
+  newMovements.append(Movement(startPos=start, endPos=movement.end, boundingBox=None, feature=movement.feature))
+  return newMovements
+
+def splitMovementAtClip(movement: Movement, boundingBox: BoundingBox, currentBoundingBox: BoundingBox, tEnter: float, tExit: float) -> list[Movement]:
+  """
+  Split a movement at the clip parameters into the parts outside, inside, and outside the bounding box.
+  """
+  return splitMovementAtClips(movement=movement, clips=[(tEnter, tExit, boundingBox, currentBoundingBox)])
 
-  #intersect Left Right Top Bottom of bounding box
-  intersectBBL, intersectBBR, intersectBBT, intersectBBB = False, False, False, False
+# check if movement is in bounding box and split movement by intersections
+# return array of new movements or false if no intersection
+def boundingBoxSplit(movement: Movement, boundingBox: BoundingBox):
+  currentBoundingBox = currentBoundingBoxAtHeight(boundingBox=boundingBox, height=movement.end.Z)
 
   #currently this only checks if the movement end is in the Z range of the boundingbox
-  if movement.end.Z >= currentBoundingBox.origin.Z and movement.end.Z <= currentBoundingBox.origin.Z + currentBoundingBox.size.Z:
-
-    #check if entire movement start and end are in bounding box
-    if point_in_box(movement.start, currentBoundingBox) and point_in_box(movement.end, currentBoundingBox):
-      movementWithBoundingBox = copy.copy(movement)
-      movementWithBoundingBox.boundingBox = currentBoundingBox
-      newMovements.append(movementWithBoundingBox)
-      return newMovements
-
-    intersectBBL = line_intersection([movement.start.X,movement.start.Y], [movement.end.X,movement.end.Y], [currentBoundingBox.origin.X, currentBoundingBox.origin.Y], [currentBoundingBox.origin.X, currentBoundingBox.origin.Y + currentBoundingBox.size.Y])
-    intersectBBR = line_intersection([movement.start.X,movement.start.Y], [movement.end.X,movement.end.Y], [currentBoundingBox.origin.X + currentBoundingBox.size.X, currentBoundingBox.origin.Y], [currentBoundingBox.origin.X + currentBoundingBox.size.X, currentBoundingBox.origin.Y + currentBoundingBox.size.Y])
-    intersectBBT = line_intersection([movement.start.X,movement.start.Y], [movement.end.X,movement.end.Y], [currentBoundingBox.origin.X, currentBoundingBox.origin.Y + currentBoundingBox.size.Y], [currentBoundingBox.origin.X + currentBoundingBox.size.X, currentBoundingBox.origin.Y + currentBoundingBox.size.Y])
-    intersectBBB = line_intersection([movement.start.X,movement.start.Y], [movement.end.X,movement.end.Y], [currentBoundingBox.origin.X, currentBoundingBox.origin.Y], [currentBoundingBox.origin.X + currentBoundingBox.size.X, currentBoundingBox.origin.Y])
-
-  intersect1: Position|False = False
-  intersect2: Position|False = False
-  intersectChecks = [intersectBBL, intersectBBR, intersectBBT, intersectBBB]
-  for i in intersectChecks:
-    if i != False:
-      iPosition = Position()
-      iPosition.X = i[0]
-      iPosition.Y = i[1]
-      if intersect1:
-        if intersect2:
-          print(f'three intersections found {intersect1} {intersect2} {i}')
-        intersect2 = iPosition
-      else:
-        intersect1 = iPosition
+  if movement.end.Z < currentBoundingBox.origin.Z or movement.end.Z > currentBoundingBox.origin.Z + currentBoundingBox.size.Z:
+    return False
 
-  # Return False if no intersections
-  if intersect1 is False:
+  clip = clipSegmentToBox(movement.start.X, movement.start.Y, movement.end.X, movement.end.Y, currentBoundingBox.origin.X, currentBoundingBox.origin.Y, currentBoundingBox.origin.X + currentBoundingBox.size.X, currentBoundingBox.origin.Y + currentBoundingBox.size.Y)
+  if clip is None:
     return False
 
-  # determine which intersection is first on the movement line
-  if intersect2 and point_distance(intersect2, movement.start) < point_distance(intersect1, movement.start):
-    intersect1, intersect2 = intersect2, intersect1
-  
-  #set Z position for intersections (since we don't check for Z intersect point)
-  intersect1.Z = movement.end.Z
-  if intersect2:
-    intersect2.Z = movement.end.Z
-
-  originalStartEndEDistance = movement.end.E-movement.start.E
-  originalStartEndPointDistance = point_distance(movement.start, movement.end)
-
-  # check if movement starts in bounding box to know which side of single intersection found is in the box
-  intersect1.E = movement.start.E # absolute E position of the movement before this
-  intersect1.E += originalStartEndEDistance * point_distance(movement.start, intersect1)/originalStartEndPointDistance # add the relative E distance
-
-  if intersect2 is False:
-    if point_in_box(movement.start, boundingBox): # start is in box
-      newMovements.append(Movement(startPos=movement.start, endPos=intersect1, boundingBox=boundingBox, feature=movement.feature))
-      newMovements.append(Movement(startPos=intersect1, endPos=movement.end, boundingBox=None, feature=movement.feature))
-    else:
-      newMovements.append(Movement(startPos=movement.start, endPos=intersect1, boundingBox=None, feature=movement.feature))
-      newMovements.append(Movement(startPos=intersect1, endPos=movement.end, boundingBox=boundingBox, feature=movement.feature))
-  else:
-    intersect2.E = intersect1.E # absolute E position of the movement before this
-    intersect2.E += originalStartEndEDistance * point_distance(intersect1, intersect2)/originalStartEndPointDistance # add the relative E distance
-
-    newMovements.append(Movement(startPos=movement.start, endPos=intersect1, boundingBox=None, feature=movement.feature))
-    newMovements.append(Movement(startPos=intersect1, endPos=intersect2, boundingBox=boundingBox, feature=movement.feature))
-    newMovements.append(Movement(startPos=intersect2, endPos=movement.end, boundingBox=None, feature=movement.feature))
-  
-  return newMovements
\ No newline at end of file
+  return splitMovementAtClip(movement=movement, boundingBox=boundingBox, currentBoundingBox=currentBoundingBox, tEnter=clip[0], tExit=clip[1])
+
+def boundingBoxSplitBatch(movements: list[Movement], boundingBox: BoundingBox) -> list[list[Movement]|bool]:
+  """
+  boundingBoxSplit() for a list of movements with all movements clipped in one call.
+
+  :param movements: Movements to split
+  :type movements: list[Movement]
+  :param boundingBox: Bounding box
+  :type boundingBox: BoundingBox
+  :return: Split movements or False for each movement
+  :rtype: list[list[Movement]|bool]
+  """
+  if not movements:
+    return []
+
+  # current bounding box for each movement end Z
+  currentBoundingBoxes: dict[float, BoundingBox] = {}
+  for m in movements:
+    if m.end.Z not in currentBoundingBoxes:
+      currentBoundingBoxes[m.end.Z] = currentBoundingBoxAtHeight(boundingBox=boundingBox, height=m.end.Z)
+  movementBoundingBoxes = [currentBoundingBoxes[m.end.Z] for m in movements]
+
+  segments = np.array([(m.start.X, m.start.Y, m.end.X, m.end.Y, m.end.Z) for m in movements], dtype=np.float64)
+  boxes = np.array([(bb.origin.X, bb.origin.Y, bb.origin.X + bb.size.X, bb.origin.Y + bb.size.Y, bb.origin.Z, bb.origin.Z + bb.size.Z) for bb in movementBoundingBoxes], dtype=np.float64)
+
+  tEnter, tExit, inside = clipSegmentsToBox(segments[:,0], segments[:,1], segments[:,2], segments[:,3], boxes[:,0], boxes[:,1], boxes[:,2], boxes[:,3])
+  #currently this only checks if the movement end is in the Z range of the boundingbox
+  inside &= (segments[:,4] >= boxes[:,4]) & (segments[:,4] <= boxes[:,5])
+
+  # each split gets its own current bounding box copy like boundingBoxSplit()
+  return [splitMovementAtClip(movement=m, boundingBox=boundingBox, currentBoundingBox=copy.copy(currentBoundingBox), tEnter=te, tExit=tx) if i else False for m, currentBoundingBox, te, tx, i in zip(movements, movementBoundingBoxes, tEnter.tolist(), tExit.tolist(), inside.tolist())]
+
+def subtractClipRanges(tEnter: float, tExit: float, taken: list[tuple[float, float]]) -> list[tuple[float, float]]:
+  # parts of the range (tEnter, tExit) not covered by the taken ranges
+  parts = [(tEnter, tExit)]
+  for a, b in taken:
+    parts = [p for start, end in parts for p in ((start, min(end, a)), (max(start, b), end)) if p[0] < p[1]]
+  return parts
+
+def boundingBoxIndexSplitBatch(movements: list[Movement], boundingBoxIndex: BoundingBoxIndex) -> list[list[Movement]|bool]:
+  """
+  boundingBoxSplit() against every bounding box in an index with all candidate (movement, box) pairs clipped in one call.
+  Movements are only clipped against the boxes in the grid cells their XY extent reaches and whose Z range contains the movement end Z.
+  Where boxes overlap the part of the movement inside an earlier box in the index keeps that box.
+
+  :param movements: Movements to split
+  :type movements: list[Movement]
+  :param boundingBoxIndex: Bounding boxes
+  :type boundingBoxIndex: BoundingBoxIndex
+  :return: Split movements or False for each movement
+  :rtype: list[list[Movement]|bool]
+  """
+  # candidate (movement, box) pairs. Mesh regions are clipped to their layer polygon separately.
+  pairs: list[tuple[int, int]] = []
+  meshPairs: list[tuple[int, int]] = []
+  for i, m in enumerate(movements):
+    for j in boundingBoxIndex.candidates(min(m.start.X, m.end.X), min(m.start.Y, m.end.Y), max(m.start.X, m.end.X), max(m.start.Y, m.end.Y), m.end.Z):
+      if isinstance(boundingBoxIndex.boundingBoxes[j], MeshBoundingBox):
+        meshPairs.append((i, j))
+      else:
+        pairs.append((i, j))
+  if not pairs and not meshPairs:
+    return [False] * len(movements)
+
+  # clip ranges of each movement
+  movementClips: list[list[tuple[float, float, int]]] = [[] for _ in movements]
+
+  if pairs:
+    segments = np.array([(movements[i].start.X, movements[i].start.Y, movements[i].end.X, movements[i].end.Y) for i, _ in pairs], dtype=np.float64)
+    geometries = [boundingBoxIndex.boundingBoxes[j].geometryAtHeight(height=movements[i].end.Z) for i, j in pairs]
+    boxes = np.array([(g.origin.X, g.origin.Y, g.origin.X + g.size.X, g.origin.Y + g.size.Y) for g in geometries], dtype=np.float64)
+
+    tEnter, tExit, inside = clipSegmentsToBox(segments[:,0], segments[:,1], segments[:,2], segments[:,3], boxes[:,0], boxes[:,1], boxes[:,2], boxes[:,3])
+
+    for (i, j), te, tx, isInside in zip(pairs, tEnter.tolist(), tExit.tolist(), inside.tolist()):
+      if isInside:
+        movementClips[i].append((te, tx, j))
+
+  for i, j in meshPairs:
+    m = movements[i]
+    for te, tx in boundingBoxIndex.boundingBoxes[j].clipSegmentAtHeight(m.start.X, m.start.Y, m.end.X, m.end.Y, height=m.end.Z):
+      movementClips[i].append((te, tx, j))
+
+  splits: list[list[Movement]|bool] = []
+  for m, clipRanges in zip(movements, movementClips):
+    if not clipRanges:
+      splits.append(False)
+      continue
+
+    # earlier boxes keep the overlapping parts
+    clips = []
+    taken: list[tuple[float, float]] = []
+    for te, tx, j in sorted(clipRanges, key=lambda c: c[2]):
+      boundingBox = boundingBoxIndex.boundingBoxes[j]
+      for part in subtractClipRanges(tEnter=te, tExit=tx, taken=taken):
+        clips.append((part[0], part[1], boundingBox))
+      taken.append((te, tx))
+    clips.sort(key=lambda c: c[0])
+
+    # the current bounding box copy is only used by a movement entirely inside one box
+    currentBoundingBox = currentBoundingBoxAtHeight(boundingBox=clips[0][2], height=m.end.Z) if len(clips) == 1 and clips[0][0] <= 0 and clips[0][1] >= 1 else None
+    splits.append(splitMovementAtClips(movement=m, clips=[(te, tx, boundingBox, currentBoundingBox) for te, tx, boundingBox in clips]))
+  return splits
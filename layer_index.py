@@ -0,0 +1,199 @@
+import os, re, json, bisect, hashlib, tempfile
+
+from constants import *
+from gcode_tokenizer import *
+from mpf_reader import *
+
+# Bump when the cache file layout changes so older cache files are rebuilt
+LAYER_INDEX_VERSION = 2
+LAYER_INDEX_CACHE_SUFFIX = '.layers.json'
+
+# All layer markers in one pattern matched at line starts so the file is scanned once. Group 1 is M1, groups 2-3 are the layer comment number and Z, group 4 is the feature type, group 5 is the Z word of a G0/G1 movement.
+LAYER_MARKERS = re.compile(f"^(?:({MACHINE_M1[1:]})|{LAYER_COMMENT[1:]}|{FEATURE_TYPE}|G[01] [^;\\n]*?Z(-?\\d*\\.?\\d*))".encode(), flags=re.MULTILINE)
+
+class Layer:
+  """
+  Byte range and markers of one layer. A layer runs from the line after the previous layer's M1 (or the start gcode) up to and including its own M1 line.
+  Offsets are true byte offsets in the input file. Offsets of markers not found are -1.
+  """
+  def __init__(self, number: int, start: int):
+    self.number: int = number # layer number from the layer comment, or the layer position if there is no comment
+    self.start: int = start
+    self.end: int = start # byte offset after the last byte of the layer
+    self.z: float = None # Z height from the layer comment or the plane change move
+    self.zMin: float = None # range of the Z words of movements in the layer
+    self.zMax: float = None
+    self.layerCommentOffset: int = -1
+    self.planeChangeOffset: int = -1
+    self.m1Offset: int = -1
+    self.featureCounts: dict[str, int] = {}
+
+  def __len__(self):
+    return self.end - self.start
+
+  def toDict(self) -> dict:
+    return self.__dict__.copy()
+
+  @staticmethod
+  def fromDict(d: dict):
+    layer = Layer(number=d['number'], start=d['start'])
+    layer.__dict__.update(d)
+    return layer
+
+class LayerIndex:
+  """
+  Byte offset index of the layers of an MPF file built in one pre-scan of the memory mapped file.
+  """
+  def __init__(self, size: int, mtime: int):
+    self.size: int = size # input file size and modification time the index was built from
+    self.mtime: int = mtime
+    self.startGcodeEnd: int = 0 # byte offset after the start gcode
+    self.endGcodeStart: int = size # byte offset of the end gcode
+    self.layers: list[Layer] = []
+
+  def __len__(self):
+    return len(self.layers)
+
+  def __getitem__(self, i: int) -> Layer:
+    return self.layers[i]
+
+  def __iter__(self):
+    return iter(self.layers)
+
+  def layerForOffset(self, offset: int) -> int:
+    """
+    Index of the layer containing the byte offset, e.g. for progress reporting. Returns -1 if the offset is in the start or end gcode.
+    """
+    if offset < self.startGcodeEnd or offset >= self.endGcodeStart:
+      return -1
+    return max(0, bisect.bisect_right([layer.start for layer in self.layers], offset) - 1)
+
+  def layersInZRange(self, minZ: float, maxZ: float) -> list[Layer]:
+    return [layer for layer in self.layers if layer.z is not None and minZ <= layer.z <= maxZ]
+
+  def toDict(self) -> dict:
+    return {
+      'version': LAYER_INDEX_VERSION,
+      'size': self.size,
+      'mtime': self.mtime,
+      'startGcodeEnd': self.startGcodeEnd,
+      'endGcodeStart': self.endGcodeStart,
+      'layers': [layer.toDict() for layer in self.layers]
+    }
+
+  @staticmethod
+  def fromDict(d: dict):
+    index = LayerIndex(size=d['size'], mtime=d['mtime'])
+    index.startGcodeEnd = d['startGcodeEnd']
+    index.endGcodeStart = d['endGcodeStart']
+    index.layers = [Layer.fromDict(layer) for layer in d['layers']]
+    return index
+
+def findLineStart(f: MappedFile, s: bytes, start: int = 0) -> int:
+  """
+  Find the byte offset of the first line starting with s at or after start. Returns -1 if not found.
+  """
+  p = f.map.find(s, start)
+  while p > 0 and f.map[p-1] != ord('\n'):
+    p = f.map.find(s, p+1)
+  return p
+
+def buildLayerIndex(f: MappedFile) -> LayerIndex:
+  """
+  Scan a mapped MPF file once for the start/end gcode, M1, plane change and layer comment markers.
+
+  :param f: Mapped input file
+  :type f: MappedFile
+  :return: Layer index
+  :rtype: LayerIndex
+  """
+  st = os.fstat(f.file.fileno())
+  index = LayerIndex(size=st.st_size, mtime=st.st_mtime_ns)
+  m = f.map
+
+  startGcodePosition = findLineStart(f, START_GCODE_END.encode())
+  if startGcodePosition != -1:
+    nl = m.find(b'\n', startGcodePosition)
+    index.startGcodeEnd = len(m) if nl < 0 else nl+1
+  endGcodePosition = findLineStart(f, END_GCODE_START.encode(), index.startGcodeEnd)
+  if endGcodePosition != -1:
+    index.endGcodeStart = endGcodePosition
+
+  layer = Layer(number=0, start=index.startGcodeEnd)
+  for match in LAYER_MARKERS.finditer(m, index.startGcodeEnd, index.endGcodeStart):
+    if match.group(1) is not None: # M1 ends the layer
+      layer.m1Offset = match.start()
+      nl = m.find(b'\n', match.start(), index.endGcodeStart)
+      layer.end = index.endGcodeStart if nl < 0 else nl+1
+      index.layers.append(layer)
+      layer = Layer(number=len(index.layers), start=layer.end)
+    elif match.group(5) is not None: # movement with Z
+      if match.group(5):
+        z = float(match.group(5))
+        layer.zMin = z if layer.zMin is None else min(layer.zMin, z)
+        layer.zMax = z if layer.zMax is None else max(layer.zMax, z)
+    elif match.group(2) is not None: # layer comment
+      layer.layerCommentOffset = match.start()
+      layer.number = int(match.group(2))
+      if match.group(3):
+        layer.z = float(match.group(3))
+    else: # feature comment
+      featureType = match.group(4).rstrip(b'\r').decode()
+      layer.featureCounts[featureType] = layer.featureCounts.get(featureType, 0) + 1
+      if featureType == LAYER_CHANGE and layer.planeChangeOffset == -1:
+        layer.planeChangeOffset = match.start()
+        # layers without a layer comment use the Z of the plane change move
+        if layer.z is None:
+          for _, cl in f.lines(start=match.end()+1, end=index.endGcodeStart):
+            gl = tokenizeLine(cl)
+            if gl.kind == GcodeLineKind.MOVEMENT and gl.hasAxis(AXIS_Z):
+              layer.z = gl.Z
+            break
+
+  # last layer ends at the end gcode
+  layer.end = index.endGcodeStart
+  if layer.end > layer.start:
+    index.layers.append(layer)
+
+  return index
+
+def layerIndexCacheDirectory() -> str:
+  return LAYER_INDEX_CACHE_DIRECTORY or os.path.join(tempfile.gettempdir(), 'mpf-layer-index')
+
+def layerIndexCacheFilepath(inputFilepath: str, cacheDirectory: str) -> str:
+  # inputs with the same name in different directories have their own file
+  pathHash = hashlib.sha1(os.path.realpath(inputFilepath).encode()).hexdigest()[:12]
+  return os.path.join(cacheDirectory, f"{os.path.basename(inputFilepath)}-{pathHash}{LAYER_INDEX_CACHE_SUFFIX}")
+
+def loadLayerIndex(f: MappedFile, cacheDirectory: str = None) -> LayerIndex:
+  """
+  Load the layer index from the cache file of the input in the cache directory if it matches the input file size and modification time. Otherwise build the index and write the cache file.
+
+  :param f: Mapped input file
+  :type f: MappedFile
+  :param cacheDirectory: Directory of the cache file, e.g. layerIndexCacheDirectory(). None only builds the index.
+  :type cacheDirectory: str
+  :return: Layer index
+  :rtype: LayerIndex
+  """
+  if cacheDirectory is None:
+    return buildLayerIndex(f)
+
+  cacheFilepath = layerIndexCacheFilepath(f.filepath, cacheDirectory=cacheDirectory)
+  st = os.fstat(f.file.fileno())
+  try:
+    with open(cacheFilepath, mode='r') as cacheFile:
+      d = json.load(cacheFile)
+    if d.get('version') == LAYER_INDEX_VERSION and d.get('size') == st.st_size and d.get('mtime') == st.st_mtime_ns:
+      return LayerIndex.fromDict(d)
+  except (OSError, ValueError, KeyError):
+    pass
+
+  index = buildLayerIndex(f)
+  try:
+    os.makedirs(cacheDirectory, exist_ok=True)
+    with open(cacheFilepath, mode='w') as cacheFile:
+      json.dump(index.toDict(), cacheFile)
+  except OSError as e:
+    print(f"Failed to write layer index {e}")
+  return index
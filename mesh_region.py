@@ -0,0 +1,245 @@
+import math
+
+import numpy as np
+
+from printing_classes import *
+from constants import *
+
+# Binary STL triangle record
+STL_BINARY_TRIANGLE = np.dtype([('normal', '<f4', (3,)), ('vertices', '<f4', (3, 3)), ('attribute', '<u2')])
+
+def readSTL(filepath: str) -> np.ndarray:
+  """
+  Read the triangles of a binary or ASCII STL file.
+
+  :param filepath: STL file path
+  :type filepath: str
+  :return: Triangle vertices [triangle][vertex][x|y|z]
+  :rtype: np.ndarray
+  """
+  with open(filepath, mode='rb') as stlFile:
+    data = stlFile.read()
+
+  # binary STL is an 80 byte header, a triangle count, and 50 bytes per triangle
+  if len(data) >= 84:
+    count = int.from_bytes(data[80:84], byteorder='little')
+    if len(data) == 84 + count * STL_BINARY_TRIANGLE.itemsize:
+      return np.frombuffer(data, dtype=STL_BINARY_TRIANGLE, count=count, offset=84)['vertices'].astype(np.float64)
+
+  vertices = [line.split()[1:4] for line in data.decode(errors='replace').splitlines() if line.strip().startswith('vertex')]
+  return np.array(vertices, dtype=np.float64).reshape(-1, 3, 3)
+
+def sliceTriangles(triangles: np.ndarray, z: float) -> np.ndarray:
+  """
+  Slice triangles with the plane at z. Vertices on the plane count as above it so faces in the plane add no edges.
+
+  :param triangles: Triangle vertices [triangle][vertex][x|y|z]
+  :type triangles: np.ndarray
+  :param z: Slice height
+  :type z: float
+  :return: Unordered polygon edges [edge][x0|y0|x1|y1]
+  :rtype: np.ndarray
+  """
+  # triangle edges a -> b
+  a = triangles
+  b = np.roll(triangles, -1, axis=1)
+  sa = a[:, :, 2] - z
+  sb = b[:, :, 2] - z
+  crossing = (sa >= 0) != (sb >= 0)
+
+  with np.errstate(divide='ignore', invalid='ignore'):
+    t = np.where(crossing, sa / (sa - sb), 0)
+  points = a[:, :, :2] + t[:, :, np.newaxis] * (b[:, :, :2] - a[:, :, :2])
+
+  # a triangle crossing the plane has exactly 2 crossing edges
+  sliced = crossing.sum(axis=1) == 2
+  return points[sliced][crossing[sliced]].reshape(-1, 4)
+
+class MeshRegionLayer:
+  """
+  Polygon of a mesh region at one layer height as unordered edges bucketed by Y band.
+  Bands are one droplet raster index tall and start at the raster origin so band j holds every edge that could cross the raster row j.
+  Inside is decided by the even-odd rule.
+  """
+  def __init__(self, edges: np.ndarray, originY: float, bandHeight: float, bandCount: int):
+    self.edges: np.ndarray = edges # [edge][x0|y0|x1|y1]
+    self.originY: float = originY
+    self.bandHeight: float = bandHeight
+    self.bandCount: int = max(1, bandCount)
+
+    self.minY = np.minimum(edges[:, 1], edges[:, 3])
+    self.maxY = np.maximum(edges[:, 1], edges[:, 3])
+
+    # edges of each band. Edges past the first or last band are kept in that band.
+    firstBand = np.clip(self.band(self.minY), 0, self.bandCount-1)
+    lastBand = np.clip(self.band(self.maxY), 0, self.bandCount-1)
+    counts = lastBand - firstBand + 1
+    edgeBands = np.repeat(firstBand, counts) + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    order = np.argsort(edgeBands, kind='stable')
+    self.bucketEdges: np.ndarray = np.repeat(np.arange(len(edges)), counts)[order]
+    self.bucketOffsets: np.ndarray = np.searchsorted(edgeBands[order], np.arange(self.bandCount+1))
+
+  def band(self, y: np.ndarray|float) -> np.ndarray|int:
+    return np.floor((y - self.originY) / self.bandHeight).astype(np.int64)
+
+  def edgesInBands(self, firstBand: int, lastBand: int) -> np.ndarray:
+    firstBand = min(max(firstBand, 0), self.bandCount-1)
+    lastBand = min(max(lastBand, 0), self.bandCount-1)
+    return np.unique(self.bucketEdges[self.bucketOffsets[firstBand]:self.bucketOffsets[lastBand+1]])
+
+  def crossingsAtY(self, y: float) -> np.ndarray:
+    # sorted X of the edges crossing the horizontal line at y. Edges include their lower end only so vertices are counted once.
+    e = self.edgesInBands(self.band(y), self.band(y))
+    e = e[(self.minY[e] <= y) & (y < self.maxY[e])]
+    x0, y0, x1, y1 = self.edges[e].T
+    return np.sort(x0 + (y - y0) / (y1 - y0) * (x1 - x0))
+
+  def containsPoint(self, x: float, y: float) -> bool:
+    return bool(np.count_nonzero(self.crossingsAtY(y) > x) % 2)
+
+  def clipSegment(self, x0: float, y0: float, x1: float, y1: float) -> list[tuple[float, float]]:
+    """
+    Clip a segment to the polygon.
+
+    :return: Segment parameters (tEnter, tExit) of the parts inside the polygon in segment order
+    :rtype: list[tuple[float, float]]
+    """
+    e = self.edgesInBands(self.band(min(y0, y1)), self.band(max(y0, y1)))
+    ex0, ey0, ex1, ey1 = self.edges[e].T
+
+    # segment parameter t of the crossing with each edge, u is the parameter along the edge
+    dx, dy = x1 - x0, y1 - y0
+    edx, edy = ex1 - ex0, ey1 - ey0
+    denominator = dx * edy - dy * edx
+    with np.errstate(divide='ignore', invalid='ignore'):
+      t = ((ex0 - x0) * edy - (ey0 - y0) * edx) / denominator
+      u = ((ex0 - x0) * dy - (ey0 - y0) * dx) / denominator
+    t = t[(denominator != 0) & (t > 0) & (t < 1) & (u >= 0) & (u <= 1)]
+
+    # each part between crossings is inside or outside as a whole, decided at its midpoint
+    ts = np.unique(np.concatenate(([0.0], t, [1.0]))).tolist()
+    clips: list[tuple[float, float]] = []
+    for tEnter, tExit in zip(ts[:-1], ts[1:]):
+      tMid = (tEnter + tExit) / 2
+      if self.containsPoint(x0 + tMid * dx, y0 + tMid * dy):
+        if clips and clips[-1][1] == tEnter:
+          clips[-1] = (clips[-1][0], tExit)
+        else:
+          clips.append((tEnter, tExit))
+    return clips
+
+  def insideMask(self, originX: float, shape: tuple[int, int]) -> np.ndarray:
+    """
+    Rasterize the polygon with a scanline fill of each raster row. Raster index [x][y] is at (originX + x * bandHeight, originY + y * bandHeight).
+
+    :return: Boolean mask indexed [x][y] by raster index
+    :rtype: np.ndarray
+    """
+    mask = np.zeros(shape, dtype=bool)
+    for y in range(shape[1]):
+      crossings = self.crossingsAtY(self.originY + y * self.bandHeight)
+      for xEnter, xExit in zip(crossings[0::2], crossings[1::2]):
+        first = max(0, math.ceil((xEnter - originX) / self.bandHeight))
+        last = min(shape[0]-1, math.floor((xExit - originX) / self.bandHeight))
+        mask[first:last+1, y] = True
+    return mask
+
+class MeshBoundingBox(BoundingBox):
+  """
+  Density region shaped by a closed mesh such as an STL modifier mesh. Origin and size are the mesh bounds.
+  The mesh is sliced to a polygon at each layer height. Movements are clipped to the polygon and to the box that shrinks as the sides fill in.
+  The droplet raster covers the mesh bounds and the inset is a lookup in the polygon inside mask.
+  """
+  def __init__(self, triangles: np.ndarray, density: float = 1, offset: Position = None):
+    triangles = np.array(triangles, dtype=np.float64)
+    if offset is not None:
+      triangles += (offset.X, offset.Y, offset.Z)
+    low = triangles.reshape(-1, 3).min(axis=0)
+    high = triangles.reshape(-1, 3).max(axis=0)
+    super().__init__(origin=Position(*low.tolist()), size=Position(*(high - low).tolist()), density=density)
+
+    self.triangles: np.ndarray = triangles
+    self.layerRegions: dict[float, MeshRegionLayer] = {} # polygon by layer height, shared with copies
+
+  @staticmethod
+  def fromSTL(filepath: str, density: float = 1, offset: Position = None):
+    return MeshBoundingBox(triangles=readSTL(filepath), density=density, offset=offset)
+
+  def rasterResolution(self) -> float:
+    return DROPLET_WIDTH*self.dropletRasterResolution
+
+  def rasterShape(self) -> tuple[int, int]:
+    # copies for intersection checking keep the mesh bounds so this is also the shape of the shared raster
+    return self.layerGeometrySource.dropletRasterShape()
+
+  def regionAtHeight(self, height: float) -> MeshRegionLayer:
+    region = self.layerRegions.get(height)
+    if region is None:
+      source = self.layerGeometrySource
+      region = MeshRegionLayer(edges=sliceTriangles(triangles=self.triangles, z=height), originY=source.origin.Y, bandHeight=self.rasterResolution(), bandCount=self.rasterShape()[1])
+      self.layerRegions[height] = region
+    return region
+
+  def precomputeLayerGeometry(self, heights: list[float]):
+    super().precomputeLayerGeometry(heights=heights)
+    for height in heights:
+      if self.intersectsZRange(minZ=height, maxZ=height):
+        self.regionAtHeight(height=height)
+
+  def clipSegmentAtHeight(self, x0: float, y0: float, x1: float, y1: float, height: float) -> list[tuple[float, float]]:
+    """
+    Clip a segment to the polygon at the layer height and to the box at the height after the sides fill in.
+
+    :return: Segment parameters (tEnter, tExit) of the parts inside the region in segment order
+    :rtype: list[tuple[float, float]]
+    """
+    geometry = self.geometryAtHeight(height=height)
+    clips = []
+    for tEnter, tExit in self.regionAtHeight(height=height).clipSegment(x0, y0, x1, y1):
+      # Liang-Barsky clip against the current box limited to the polygon part
+      for p, q in ((x0 - x1, x0 - geometry.origin.X), (x1 - x0, geometry.origin.X + geometry.size.X - x0), (y0 - y1, y0 - geometry.origin.Y), (y1 - y0, geometry.origin.Y + geometry.size.Y - y0)):
+        if p == 0:
+          if q <= 0:
+            tExit = tEnter
+        elif p < 0:
+          tEnter = max(tEnter, q / p)
+        else:
+          tExit = min(tExit, q / p)
+      if tEnter < tExit:
+        clips.append((tEnter, tExit))
+    return clips
+
+  def insetMaskAtHeight(self, height: float, insetDistIndices: int) -> np.ndarray:
+    """
+    Return the mask of droplet raster indices inside the polygon and the current box at the height that are at least the inset distance from their edges.
+    Raster indices are relative to the mesh bounds origin.
+
+    :param height: Layer height
+    :type height: float
+    :param insetDistIndices: Inset distance in raster indices
+    :type insetDistIndices: int
+    :return: Boolean mask indexed [x][y] by raster index
+    :rtype: np.ndarray
+    """
+    mask = self.insetMasks.get((height, insetDistIndices))
+    if mask is None:
+      source = self.layerGeometrySource
+      shape = self.rasterShape()
+      resolution = self.rasterResolution()
+      inside = self.regionAtHeight(height=height).insideMask(originX=source.origin.X, shape=shape)
+
+      # limit to the box after the sides fill in
+      geometry = self.geometryAtHeight(height=height)
+      x = source.origin.X + np.arange(shape[0]) * resolution
+      y = source.origin.Y + np.arange(shape[1]) * resolution
+      inside &= ((x >= geometry.origin.X) & (x <= geometry.origin.X + geometry.size.X))[:, np.newaxis]
+      inside &= ((y >= geometry.origin.Y) & (y <= geometry.origin.Y + geometry.size.Y))[np.newaxis, :]
+
+      # erode by the inset. An index is inset when the whole square around it is inside.
+      d = max(0, insetDistIndices)
+      table = summedAreaTable(np.pad(inside, d))
+      n = 2*d + 1
+      mask = (table[n:, n:] - table[:-n, n:] - table[n:, :-n] + table[:-n, :-n]) == n*n
+      mask.flags.writeable = False
+      self.insetMasks[(height, insetDistIndices)] = mask
+    return mask
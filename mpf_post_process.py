@@ -1,12 +1,23 @@
-import re, os, typing, queue, time, datetime, math, enum, copy, random, shutil
+import re, os, typing, queue, time, datetime, math, enum, copy, random, shutil, contextlib, threading
+
+import numpy as np
 
 from functools import cmp_to_key
 
 from printing_classes import *
 from constants import *
 from line_ending import *
+from gcode_tokenizer import *
+from mpf_reader import *
+from gcode_writer import *
+from layer_index import *
 from intersection import *
 from infill import *
+from density_field import *
+from placement import *
+from parallel_placement import *
+from pipeline import *
+from parsed_print import *
 
 bbOrigin = Position()
 bbSize = Position()
@@ -21,155 +32,33 @@ bbSize.X, bbSize.Y, bbSize.Z = 24, 24, 7 #Upper right
 
 testBoundingBox = BoundingBox(origin = bbOrigin, size=bbSize, density=0.1)
 
-def getInfillRequirements(imq: list[Movement], ps: PrintState):
-  """Plan infill by splitting infill movements into droplets, calculating infill droplet count needed for target density, and finding supported locations. 
-
-  :param imq: Infill movement queue
-  :type imq: list[Movement]
-  :param ps: PrintState
-  :type ps: PrintState
-  """  
-  for m in imq:
-    if m.boundingBox:
-      m.dropletMovements = splitMovementToDroplets(m=m, singleDropletWidthResolution=False if m.boundingBox.dropletRaster else True)
-
-      ps.infillModifiedDropletsOriginal += len(m.dropletMovements)
-      ps.infillModifiedDropletsNeededForDensity += len(reduceDropletsToDensity(droplets=m.dropletMovements, density=m.boundingBox.densityAtLayerHeightForTargetDensity(layerHeight=ps.layerHeight)))
+# Bounding boxes with modified infill. Each box has its own density, ramp, raster and Z offset. Boxes earlier in the list take priority where boxes overlap.
+# A region shaped by an STL modifier mesh in print coordinates is added with MeshBoundingBox.fromSTL(filepath, density)
+# Set densityField of a bounding box (e.g. readDensityField(filepath) or FunctionDensityField(function)) for spatially varying density. density then only sets the ramp up length.
+boundingBoxes: list[BoundingBox] = [testBoundingBox]
 
-      # Get supported locations if previous layer raster exists
-      if m.boundingBox.dropletRaster and DEBUG_PREVIEW_ALL_DROPLETS_SUPPORTED == False:
-        m.supportedPositions = findSupportedLocations(m=m)
-        ps.infillModifiedDropletsSupportedAvailable += len(m.supportedPositions)
-        m.dropletMovements = None # clear movement split droplets from initial planning. 
+# infill
+def processInfillMovementQueue(imq: list[Movement], ps: PrintState):
+  # only the boxes the island has segments in
+  for bb in dict.fromkeys(m.boundingBox.layerGeometrySource for m in imq if m.boundingBox):
+    currentBBGeometry = bb.geometryAtHeight(height=ps.layerHeight)
+    print(f"current bb on layer height {ps.layerHeight} origin {currentBBGeometry.origin.X} {currentBBGeometry.origin.Y} {currentBBGeometry.origin.Z} size {currentBBGeometry.size.X} {currentBBGeometry.size.Y} {currentBBGeometry.size.Z}")
+  placeIsland(imq=imq, ps=ps)
 
-def placeInfill(imq: list[Movement], ps: PrintState) -> int:
-  """Place infill into print space. Modified the queued movements to set the correct droplets.
+def outputInfillMovementQueue(imq: list[Movement], ps: PrintState, out: ChunkedWriter, dropletTemplate: DropletTemplate):
+  """Write out the placed queued infill movements. Output is streamed to the writer as it is generated.
 
   :param imq: Infill movement queue
   :type imq: list[Movement]
   :param ps: PrintState
   :type ps: PrintState
-  :return: Total number of droplets placed
-  :rtype: int
-  """  
-  sortedMovements = copy.copy(imq)
-  sortedMovements.sort(key=lambda x: len(x.supportedPositions))
-
-  totalDropletsPlaced = 0
-
-  while ps.infillModifiedDropletsNeededForDensity > 0:
-    dropletsPlaced = 0
-
-    for m in sortedMovements:
-      if m.boundingBox: # check if movement needs to be modified because it is in bounding box
-        
-        if m.boundingBox.dropletRaster == None: # initialize raster with [1] allocated if needed
-          m.boundingBox.initializeDropletRaster()
-
-        if DEBUG_PREVIEW_ALL_DROPLETS_SUPPORTED:
-          for d in m.dropletMovements:
-            fillBBDropletRasterForDroplet(bb=m.boundingBox, droplet=d)
-
-        if m.boundingBox.dropletRaster[0] == None: #initial layer, reduce and space out drops
-          reducedDroplets = reduceDropletsToDensity(droplets=m.dropletMovements, density=m.boundingBox.density)
-          ps.infillModifiedDropletsNeededForDensity -= len(reducedDroplets)
-          dropletsPlaced += len(reducedDroplets)
-          m.dropletMovements = reducedDroplets
-          for d in reducedDroplets:
-            fillBBDropletRasterForDroplet(bb=m.boundingBox, droplet=d)
-        else: # not initial layer, place drops on supported area
-          if len(m.supportedPositions) > 0:
-            # pick random unfilled support position to make droplet for
-            sp = None
-            while sp == None and len(m.supportedPositions) > 0:
-              randomSupportPositionIdx = random.randint(0,len(m.supportedPositions)-1)
-
-              # TODO: kernel size?
-              # check if another placed droplet on this layer would overlap too much with this droplet
-              if getNxNBBDropletRasterForPosition(bb=m.boundingBox, pos=m.supportedPositions[randomSupportPositionIdx][1], idx=1, n=DROPLET_RASTER_COLLISION_SEARCH_KERNEL_SIZE, excludeCornerDropletRadius=DROPLET_RASTER_COLLISION_SEARCH_CORNER_RADIUS) == 0:
-                sp = m.supportedPositions[randomSupportPositionIdx]
-                break
-
-              del m.supportedPositions[randomSupportPositionIdx]
-            
-            if sp:
-              # create droplet
-              supportPositionStart = sp[1]
-              supportPositionEnd = copy.copy(sp[1])
-              supportPositionEnd.E += m.dropletE
-              supportDroplet = Movement(startPos=supportPositionStart, endPos=supportPositionEnd, boundingBox=m.boundingBox)
-
-              # Add to unsorted list of supported position droplet movements. Sort this when all random position added by the original index
-              if m.supportedPositionMovements == None:
-                m.supportedPositionMovements = []
-              m.supportedPositionMovements.append((sp[0], supportDroplet))
-
-              # Unused because we sort supported droplets before adding to droplet movement list
-              # Add droplet to list of droplets replacing the movement
-              #if m.dropletMovements == None:
-              #  m.dropletMovements = [supportDroplet]
-              #else:
-              #  m.dropletMovements.append(supportDroplet)
-
-              # Fill current layer raster with droplet
-              fillBBDropletRasterForDroplet(bb=m.boundingBox, droplet=supportDroplet)
-
-              ps.infillModifiedDropletsNeededForDensity -= 1
-              dropletsPlaced += 1
-
-              # Remove position from supported positions
-              del m.supportedPositions[randomSupportPositionIdx]
-
-    totalDropletsPlaced += dropletsPlaced
-
-    # Stop trying to place droplets if we ran out of valid positions
-    if dropletsPlaced == 0:
-      print(f"Ran out of support positions on layer {ps.layerHeight}")
-      break
-
-  # Compare the original random index stored in tuple
-  #def compareSupportedPositionsRandomIdx(move1: tuple[int, Movement], move2: tuple[int, Movement]):
-  #  return move1[0] - move2[0]
-
-  # Sort all Movements' supportedPositionMovements and replace dropletMovements
-  for m in imq:
-    if m.supportedPositionMovements:
-      m.supportedPositionMovements.sort(key=lambda x:x[0])
-      m.dropletMovements = [spm[1] for spm in m.supportedPositionMovements]
-      m.supportedPositionMovements = None # remove reference to previously sorted array
-
-  return totalDropletsPlaced
-
-def reorderMovementsByZOffset(imq: list[Movement]):
-  imq.sort(reverse=True, key=lambda x:x.boundingBox.offsetZ if x.boundingBox else -1)
-
-# infill
-def processInfillMovementQueue(imq: list[Movement], ps: PrintState):
-  ps.infillModifiedDropletsOriginal = 0
-  ps.infillModifiedDropletsNeededForDensity = 0
-  ps.infillModifiedDropletsSupportedAvailable = 0
-
-  testCurrentBBOrigin = testBoundingBox.currentBoundingBoxOriginAtHeight(height=ps.layerHeight)
-  testCurrentBBSize = testBoundingBox.currentBoundingBoxSizeAtHeight(height=ps.layerHeight)
-
-  print(f"current test bb on layer height {ps.layerHeight} origin {testCurrentBBOrigin.X} {testCurrentBBOrigin.Y} {testCurrentBBOrigin.Z} size {testCurrentBBSize.X} {testCurrentBBSize.Y} {testCurrentBBSize.Z}")
-  print(f"getting infill requirements on layer height {ps.layerHeight}")
-  getInfillRequirements(imq, ps)
-  print(f"infill on layer height {ps.layerHeight} requires {ps.infillModifiedDropletsNeededForDensity}/{ps.infillModifiedDropletsOriginal} droplets for density. Found {ps.infillModifiedDropletsSupportedAvailable} available support locations.")
-  print(f"placing infill on layer height {ps.layerHeight}")
-  totalDropletsPlaced = placeInfill(imq=imq, ps=ps)
-  print(f"infill on layer height {ps.layerHeight} placed {totalDropletsPlaced} droplets and still requires {ps.infillModifiedDropletsNeededForDensity} droplets")
-
-  print(f"reordering movements by Z offset") 
-  reorderMovementsByZOffset(imq=imq)
-
-def outputInfillMovementQueue(imq: list[Movement], ps: PrintState):
-  outputGcode = ''
-
+  :param out: Output writer
+  :type out: ChunkedWriter
+  :param dropletTemplate: Droplet G-code layout
+  :type dropletTemplate: DropletTemplate
+  """
   queuedTravelMovement: Movement = None
 
-  processInfillMovementQueue(imq=imq, ps=ps)
-
   #increment this as we write out the queue. This will be the tail position when processing
   queueStartPosition = copy.copy(ps.infillMovementQueueOriginalStartPosition)
   queueStartPosition.E += ps.deltaE #apply deltaE now since we will set and print movement E in this loop
@@ -187,59 +76,42 @@ def outputInfillMovementQueue(imq: list[Movement], ps: PrintState):
     ps.infillMovementQueueOriginalStartPosition.E += m.end.E - m.start.E
     
     
-  # write out gcode to extrude a droplet
-  def writeDroplet(m: Movement):
-    nonlocal outputGcode
-
-    # ElemX preview visual
-    # Add move that is close to the final droplet position but not the same
-    # Turn off for production print, only use for preview
-    if ADD_ELEMX_PREVIEW_MOVE:
-      fakeMove = Movement(endPos=copy.copy(m.end), boundingBox=m.boundingBox)
-      fakeMove.end.X += 0.00001
-      outputGcode += f"{FAKE_MOVE}\n"
-      outputGcode += f"{fakeMove.travelGcodeToEnd(addZAxis=True)}\n"
-
-    # Move to actual droplet position
-    outputGcode += f"{m.travelGcodeToEnd(addZAxis=True)}\n"
-
-    # Dwell
-    if DWELL_BEFORE_EXTRUDE:
-      outputGcode += f"{DWELL_G4}{DROPLET_DWELL:.5f}\n"
-
-    # Extrude movement w/o XY position
-    #outputGcode += f"{m.extrudeOnlyGcode()}\n"
-    outputGcode += f"{m.extrudeAndMoveToEndGcode()}\n"
-
-    # Dwell
-    if DWELL_AFTER_EXTRUDE:
-      outputGcode += f"{PULSE_OFF}\n"
-      outputGcode += f"{DWELL_G4}{DROPLET_DWELL:.5f}\n"
+  # adjust E values of a droplet batch in order. Returns droplet end E and relative E.
+  def adjustDropletBatchE(droplets: DropletBatch) -> tuple[np.ndarray, np.ndarray]:
+    nonlocal queueStartPosition
 
-  def writeAdjustedExtrusionMove(m: Movement):
-    nonlocal outputGcode
+    # accumulate sequentially so E matches adjusting each droplet one after another
+    endE = np.add.accumulate(np.concatenate(([queueStartPosition.E], droplets.EInc)))
+    relativeE = endE[1:] - endE[:-1]
+
+    #track end position as start position of next move
+    queueStartPosition = Position(e=float(endE[-1]))
 
+    #track original position
+    ps.infillMovementQueueOriginalStartPosition.E = float(np.add.accumulate(np.concatenate(([ps.infillMovementQueueOriginalStartPosition.E], relativeE)))[-1])
+
+    return endE[1:], relativeE
+
+  def writeAdjustedExtrusionMove(m: Movement):
     # Move to start position
-    outputGcode += f"{m.travelGcodeToStart()}\n"
+    out.write(f"{m.travelGcodeToStart()}\n")
 
     # Add feature tag
-    outputGcode += f"; {FEATURE_TYPE_WRITE_OUT}{m.feature.featureType}\n"
+    out.write(f"; {FEATURE_TYPE_WRITE_OUT}{m.feature.featureType}\n")
 
     # Activate PULSE_ON
-    outputGcode += f"{PULSE_ON}\n"
+    out.write(f"{PULSE_ON}\n")
 
     # Extrusion move
-    outputGcode += f"{m.gcode(adjustE=False)}\n"
+    out.write(f"{m.gcode(adjustE=False)}\n")
 
   def writeTravelMove(m: Movement):
-    nonlocal outputGcode
-
     #DEBUG
     #if m.end.X == -6.91134 and m.end.Y==11.8645:
     #  0==0
 
     # Travel move to end
-    outputGcode += f"{m.travelGcodeToEnd(addZAxis=(m.start.Z != m.end.Z and m.end.Z > 0))}\n"
+    out.write(f"{m.travelGcodeToEnd(addZAxis=(m.start.Z != m.end.Z and m.end.Z > 0))}\n")
 
   # G0 move is not needed if the next extrusion move is dropet because we already add a travel move in writeDroplet() to setup the start position
   #We don't know if the next extrusion move is droplet, so we add travel moves to queue until we find next extrusion move
@@ -255,11 +127,11 @@ def outputInfillMovementQueue(imq: list[Movement], ps: PrintState):
       travelMovementQueue.append(m)
     '''
 
-  outputGcode += f"; Start {len(imq)} queued infill moves\n"
+  out.write(f"; Start {len(imq)} queued infill moves\n")
 
   for m in imq:
     if m.start == None: #output original misc gcode
-      outputGcode += f"{m.originalGcode}"
+      out.write(m.originalGcode)
 
     elif m.boundingBox: # In bounding box so write droplets
       if m.dropletMovements: # write droplet movements
@@ -267,12 +139,12 @@ def outputInfillMovementQueue(imq: list[Movement], ps: PrintState):
         # Reset travel move queue since droplet movement does not need to be setup with last travel. We add our own travel before extrude.
         queuedTravelMovement = None
 
-        outputGcode += f"; Interpolated movement to {len(m.dropletMovements)} droplets\n"
-        for d in m.dropletMovements:
-          adjustE(m=d)
-          writeDroplet(m=d)
+        out.write(f"; Interpolated movement to {len(m.dropletMovements)} droplets\n")
+        # droplets are written at the bounding box Z offset
+        dropletEnd, dropletRelativeE = adjustDropletBatchE(droplets=m.dropletMovements)
+        out.write(dropletTemplate.render(x=m.dropletMovements.X, y=m.dropletMovements.Y, z=m.dropletMovements.Z + m.boundingBox.offsetZ, e=dropletEnd, eInc=dropletRelativeE))
       else: # no droplets placed so jump to end pos for next move
-        outputGcode += f"; Move with bounding box had no droplets placed so add travel move to the end. Original move is {m.originalGcode}\n"
+        out.write(f"; Move with bounding box had no droplets placed so add travel move to the end. Original move is {m.originalGcode.decode()}\n")
         addTravelMoveToQueue(m=m)
     elif m.start.E != m.end.E: # write G1 move
       # Write queued travel move if needed
@@ -280,13 +152,13 @@ def outputInfillMovementQueue(imq: list[Movement], ps: PrintState):
         writeTravelMove(m=queuedTravelMovement)
         queuedTravelMovement = None
 
-      outputGcode += f"; Adjusted extrusion move\n"
+      out.write(f"; Adjusted extrusion move\n")
       adjustE(m=m)
       writeAdjustedExtrusionMove(m=m)
     elif m.start != m.end: # write G0 move
       addTravelMoveToQueue(m=m)
 
-      #outputGcode += f"{m.originalGcode}"
+      #out.write(f"{m.originalGcode}")
       #writeTravelMove(m=m)
     else: #unknown
       0==1
@@ -299,180 +171,466 @@ def outputInfillMovementQueue(imq: list[Movement], ps: PrintState):
 
   ps.infillMovementQueue = None
 
-  outputGcode += f"; End queued infill moves\n"
-
-  return outputGcode
+  out.write(f"; End queued infill moves\n")
 
 # Update position state
-def checkAndUpdatePosition(cl: str, pp: Position):
+def checkAndUpdatePosition(gl: GcodeLine, pp: Position):
   #clear last comment
   pp.comment = None
 
   # look for movement gcode and record last position before entering a feature
-  movementMatch = re.match(MOVEMENT_G, cl)
-  if movementMatch:
-    m = 0
-    travelMove = True
-    while m+1 < len(movementMatch.groups()):
-      if movementMatch.groups()[m] == None:
-        m += 2
-        continue
-      axis = str(movementMatch.groups()[m])
-      if axis == ';':
-        axisValue = movementMatch.groups()[m+1]
-      else:
-        axisValue = float(movementMatch.groups()[m+1])
-      m += 2
-      if axis == 'X':
-        pp.X = axisValue
-      elif axis == 'Y':
-        pp.Y = axisValue
-      elif axis == 'Z':
-        pp.Z = axisValue
-      elif axis == 'E':
-        pp.E = axisValue
-        travelMove = False
-      elif axis == 'F':
-        pp.F = axisValue
-      elif axis == ';':
-        pp.comment = axisValue
-      else:
-        print(f"Unknown axis {axis} {axisValue} for input {cl}")
+  if gl.kind == GcodeLineKind.MOVEMENT:
+    if gl.axes & AXIS_X:
+      pp.X = gl.X
+    if gl.axes & AXIS_Y:
+      pp.Y = gl.Y
+    if gl.axes & AXIS_Z:
+      pp.Z = gl.Z
+    if gl.axes & AXIS_E:
+      pp.E = gl.E
+    pp.comment = gl.comment
       
     # If this move did not have extrusion, save the Feedrate as last travel speed
-    if travelMove:
+    if not gl.axes & AXIS_E:
       pp.FTravel = pp.F
 
+# Update position state to the last movement values in a byte range of the input
+def updatePositionFromRange(f: MappedFile, start: int, end: int, pp: Position):
+  """
+  Set pp to the last X/Y/Z/E values of the movements between byte offsets start and end. Lines are read backward from end until all axes are found. Axes without a movement in the range keep their value.
+  """
+  missingAxes = AXIS_X | AXIS_Y | AXIS_Z | AXIS_E
+  lineEnd = end
+  while missingAxes and lineEnd > start:
+    lineStart = max(start, f.map.rfind(b'\n', start, lineEnd-1) + 1)
+    gl = tokenizeLine(f.read(lineStart, lineEnd))
+    if gl.kind == GcodeLineKind.MOVEMENT:
+      if missingAxes & gl.axes & AXIS_X:
+        pp.X = gl.X
+      if missingAxes & gl.axes & AXIS_Y:
+        pp.Y = gl.Y
+      if missingAxes & gl.axes & AXIS_Z:
+        pp.Z = gl.Z
+      if missingAxes & gl.axes & AXIS_E:
+        pp.E = gl.E
+      missingAxes &= ~gl.axes
+    lineEnd = lineStart
+
+# Start of the PULSE_OFF and layers completed lines at the end of a layer
+def layerEndLinesStart(f: MappedFile, end: int) -> int:
+  """
+  Return the byte offset of the PULSE_OFF and layers completed lines just before end, or end if there are none. The M1 handling writes these lines, so copies of the input ending at M1 stop before them.
+  """
+  start = end
+  while start > 0:
+    lineStart = f.map.rfind(b'\n', 0, start-1) + 1
+    line = f.read(lineStart, start).rstrip()
+    if line == PULSE_OFF.encode() or line.startswith(LAYERS_COMPLETED_WRITE_OUT.encode()):
+      start = lineStart
+    else:
+      break
+  return start
+
 # Update states for movment POSITION and TOOL
-def updatePrintState(ps: PrintState, cl: str, sw: bool):
+def updatePrintState(ps: PrintState, gl: GcodeLine, sw: bool):
     # look for movement gcode and record last position
-    checkAndUpdatePosition(cl=cl, pp=ps.originalPosition)
+    checkAndUpdatePosition(gl=gl, pp=ps.originalPosition)
 
     ps.layerHeight = ps.originalPosition.Z
 
-def process(inputFilepath: str, outputFilepath: str):
-  startTime = time.monotonic()
+def splitInfillMovementQueue(ps: PrintState, boundingBoxIndex: BoundingBoxIndex) -> dict[Movement, list[Movement]|bool]:
+  """Split the queued infill movements by the bounding boxes with all movements clipped in one call. The queue is replaced by the split movements.
+
+  :param ps: PrintState
+  :type ps: PrintState
+  :param boundingBoxIndex: Bounding boxes
+  :type boundingBoxIndex: BoundingBoxIndex
+  :return: Split movements or False for each original infill movement
+  :rtype: dict[Movement, list[Movement]|bool]
+  """
+  infillMovements = [m for m in ps.infillMovementQueue if m.start.E != m.end.E]
+  splits = dict(zip(infillMovements, boundingBoxIndexSplitBatch(movements=infillMovements, boundingBoxIndex=boundingBoxIndex)))
+
+  imq: list[Movement] = []
+  for m in ps.infillMovementQueue:
+    newMovements = splits.get(m) or [m] # list of new Movements bisected by boundingbox or list of just the original Movement
+
+    # Swap start/end points of trailing movement if that segment is not in bounding box
+    if len(newMovements) > 1 and FLIP_MOVEMENT_TO_MOVE_TOWARDS_INTERSECTING_BOUNDING_BOX:
+      if newMovements[-1].boundingBox == None:
+        # swap copies since the start is the end of the part before and the end is shared with the original movement
+        newStart, newEnd = copy.copy(newMovements[-1].end), copy.copy(newMovements[-1].start)
+        newStart.E, newEnd.E = newMovements[-1].start.E, newMovements[-1].end.E
+        newMovements[-1].start, newMovements[-1].end = newStart, newEnd
+
+    for nm in newMovements:
+      nm.originalGcode = m.originalGcode
+      if nm.boundingBox:
+        ps.infillMovementQueueVerbatim = False
+    imq.extend(newMovements)
+
+  ps.infillMovementQueue = imq
+  return splits
+
+# E word of a G0/G1 line after up to 3 other axis words like MOVEMENT_G
+MOVEMENT_E_WORD = re.compile(rb'^(G[01] \s?(?:[XYZ]-?\d*\.?\d*\s+){0,3})E(-?\d*\.?\d*)', flags=re.MULTILINE)
+
+def outputInfillIslandVerbatim(f: MappedFile, start: int, end: int, ps: PrintState, out: ChunkedWriter):
+  """Write the original lines of a queued infill island that has no bounding box segments. E values are offset by the current deltaE.
+
+  :param f: Mapped input file
+  :type f: MappedFile
+  :param start: Byte offset of the first line of the island
+  :type start: int
+  :param end: Byte offset after the last line of the island
+  :type end: int
+  :param ps: PrintState
+  :type ps: PrintState
+  :param out: Output writer
+  :type out: ChunkedWriter
+  """
+  islandGcode = f.read(start, end)
+  if ps.deltaE != 0:
+    islandGcode = MOVEMENT_E_WORD.sub(lambda m: m.group(1) + f"E{float(m.group(2)) + ps.deltaE:.5f}".encode() if m.group(2) else m.group(0), islandGcode)
+  out.write(islandGcode)
 
-  lineEndingFlavor = determineLineEndingTypeInFile(inputFilepath)
-  print(f"detected line ending {repr(lineEndingFlavor)}")
-  if lineEndingFlavor == LineEnding.UNKNOWN:
-    lineEndingFlavor = LineEnding.UNIX
-    print('default to unix line ending')
-  lineEnding = lineEndingFlavor.value
+  ps.infillMovementQueue = None
+
+class PlanEmitStages:
+  """
+  Plan and emit stages fed with the islands and output of the parse loop of process(). The plan stage places islands in the droplet rasters and the emit stage writes the output in order.
+  Islands are placed as they are parsed, in the plan thread of a Pipeline, or together with the other islands of their layer by a ParallelIslandPlacer.
+  ParsedPrint records the same steps so that emitParsedPrint() can run them through these stages later.
+  """
+  def __init__(self, f: MappedFile, out: ChunkedWriter, boundingBoxIndex: BoundingBoxIndex, stats: ProcessStats, pipeline: Pipeline = None, islandPlacer: ParallelIslandPlacer = None):
+    self.f: MappedFile = f # verbatim islands are read from the input
+    self.out: ChunkedWriter = out
+    self.boundingBoxIndex: BoundingBoxIndex = boundingBoxIndex
+    self.stats: ProcessStats = stats
+    self.pipeline: Pipeline = pipeline
+    self.islandPlacer: ParallelIslandPlacer = islandPlacer
+    self.dropletTemplate: DropletTemplate = DropletTemplate() # droplet G-code layout built once from the constants flags
+    self.deltaE: float = 0 # carried from island to island in output order
+
+    # Islands of the layer waiting for parallel placement, set when placed
+    self.layerIslands: list[tuple[list[Movement], PrintState, threading.Event]] = []
+    # Output held back from the first island waiting for parallel placement without the pipeline. Callables write an island.
+    self.layerOutput: list[str|bytes|typing.Callable[[], None]] = None
+
+  # Write to the output in order
+  def output(self, s: str|bytes):
+    if self.pipeline:
+      self.pipeline.write(s)
+    elif self.layerOutput is None:
+      self.out.write(s)
+    else:
+      self.layerOutput.append(s)
+
+  # Run an emit step in order with the output, e.g. writing an island once it is placed
+  def emit(self, task: typing.Callable[[], None]):
+    if self.pipeline:
+      self.pipeline.later(task)
+    elif self.layerOutput is None:
+      task()
+    else:
+      self.layerOutput.append(task)
+
+  # Run a step that uses the droplet rasters in order with the other planning steps
+  def plan(self, task: typing.Callable[[], None]):
+    if self.pipeline:
+      self.pipeline.plan(task)
+    else:
+      task()
+
+  def island(self, imq: list[Movement], ps: PrintState):
+    """
+    Place a queued infill island and write it once placed.
+
+    :param imq: Infill movement queue split by the bounding boxes
+    :type imq: list[Movement]
+    :param ps: Island state from islandEmitState()
+    :type ps: PrintState
+    """
+    placed = threading.Event()
+    if self.islandPlacer:
+      self.layerIslands.append((imq, ps, placed))
+      if self.layerOutput is None and not self.pipeline:
+        self.layerOutput = []
+    else:
+      def placeIsland():
+        processInfillMovementQueue(imq=imq, ps=ps)
+        self.stats.recordIsland(ps)
+        placed.set()
+      self.plan(placeIsland)
+
+    def outputIsland():
+      if self.pipeline:
+        self.pipeline.waitForPlan(placed)
+      ps.deltaE = self.deltaE
+      outputInfillMovementQueue(imq=imq, ps=ps, out=self.out, dropletTemplate=self.dropletTemplate)
+      self.deltaE = ps.deltaE
+    self.emit(outputIsland)
+
+  def verbatimIsland(self, start: int, end: int, ps: PrintState):
+    # island without bounding box segments is written as the original lines
+    def outputIslandVerbatim():
+      ps.deltaE = self.deltaE
+      outputInfillIslandVerbatim(f=self.f, start=start, end=end, ps=ps, out=self.out)
+    self.emit(outputIslandVerbatim)
+
+  def advanceDropletRasters(self):
+    self.plan(self.boundingBoxIndex.advanceDropletRastersNextLayer)
+
+  def resetDeltaE(self):
+    def resetDeltaE():
+      self.deltaE = 0
+    self.emit(resetDeltaE)
+
+  def endLayer(self):
+    # Place the waiting islands of the layer and write the output held back behind them
+    if self.layerIslands:
+      islands, self.layerIslands = self.layerIslands, []
+      def placeIslands():
+        self.islandPlacer.place(islands=[(imq, ps) for imq, ps, _ in islands])
+        for _, ps, placed in islands:
+          self.stats.recordIsland(ps)
+          placed.set()
+      self.plan(placeIslands)
+    if self.layerOutput is not None:
+      heldBack, self.layerOutput = self.layerOutput, None
+      for s in heldBack:
+        if callable(s):
+          s()
+        else:
+          self.out.write(s)
+
+# Outer perimeter feature comment lines for renaming in bulk copied layers
+OUTER_PERIMETER_FEATURE = re.compile(f"^(;\\s?feature\\s?){OUTER_PERIMETER}".encode(), flags=re.MULTILINE)
+
+def process(inputFilepath: str, outputFilepath: str, seed: int = PLACEMENT_SEED, parsedPrint: ParsedPrint = None) -> ProcessStats:
+  """Post process an MPF file.
+
+  :param inputFilepath: Input MPF file path
+  :type inputFilepath: str
+  :param outputFilepath: Output MPF file path
+  :type outputFilepath: str
+  :param seed: Placement seed, None for unseeded placement
+  :type seed: int
+  :param parsedPrint: Only parse the input into the steps of this parsed print without placing islands or writing the output, see parsePrint()
+  :type parsedPrint: ParsedPrint
+  :return: Island and droplet totals and timing of the run
+  :rtype: ProcessStats
+  """
+  startTime = time.monotonic()
+  stats = ProcessStats(inputFilepath=inputFilepath, outputFilepath=outputFilepath)
 
   try:
-    with open(inputFilepath, mode='r') as f, open(outputFilepath, mode='w') as out:
+    # Input is memory mapped and read as byte lines with their byte offsets. CRLF and LF line endings are handled by the reader.
+    # Output is buffered in chunks and written in bounded blocks
+    # Islands of a layer are placed together in a process pool when PARALLEL_ISLAND_WORKERS is set
+    islandPlacerContext = ParallelIslandPlacer(workers=PARALLEL_ISLAND_WORKERS, boundingBoxes=boundingBoxes) if PARALLEL_ISLAND_WORKERS > 0 and parsedPrint is None else contextlib.nullcontext()
+    # Parsing only records the steps of the plan and emit stages
+    outputContext = open(outputFilepath, mode='wb') if parsedPrint is None else contextlib.nullcontext()
+    # Planning and output run in their own threads when PIPELINE_STAGES is set
+    with MappedFile(inputFilepath) as f, outputContext as outFile, (ChunkedWriter(outFile) if outFile else contextlib.nullcontext()) as out, islandPlacerContext as islandPlacer, (Pipeline(out=out) if PIPELINE_STAGES and parsedPrint is None else contextlib.nullcontext()) as pipeline:
       # Persistent variables for the read loop
-      
+
       # The current print state
       currentPrint: PrintState = PrintState()
+      currentPrint.placementSeed = seed
+      if islandPlacer and seed is None:
+        # islands placed out of order need their own random streams
+        currentPrint.placementSeed = random.getrandbits(32)
 
-      #Get total length of file
-      f.seek(0, os.SEEK_END)
-      #lp = f.tell()
-      f.seek(0, os.SEEK_SET)
-      
       currentFeature = Feature()
       currentFeature.featureType = UNKNOWN
-      currentFeature.start = f.tell()
+      currentFeature.start = 0
       currentPrint.features = [currentFeature]
 
+      # the layer index is only cached when LAYER_INDEX_CACHE is set, outside the input directory
+      layerIndex = loadLayerIndex(f, cacheDirectory=layerIndexCacheDirectory() if LAYER_INDEX_CACHE else None)
 
-      # Current line buffer
-      cl = True
-      while cl:
-        cl = f.readline()
-        clsp = f.tell() - len(cl) - (len(lineEnding)-1) # read line start position
-        #cp = f.tell() # position is start of next line after read line. We define in lower scope function as needed for retention.
-
-        def positionZIntersectsBoundingBoxZ(p: Position, bb: BoundingBox):
-          return p.Z >= bb.origin.Z and p.Z <= bb.origin.Z + bb.size.Z
-
-        def startInfillMovementQueue():
-          if currentPrint.originalPosition.Z == 1.2:
-            0==0
-
-          currentPrint.infillMovementQueue = []
-          currentPrint.infillMovementQueueOriginalStartPosition = copy.copy(currentPrint.originalPosition) #save original position at queue start
-
-          '''
-          # insert movement to only change Z
-          if INFILL_Z_OFFSET > 0 and positionZIntersectsBoundingBoxZ(currentPrint.originalPosition, bb=testBoundingBox):
-            moveZUp = Movement(startPos=currentPrint.infillMovementQueueOriginalStartPosition, endPos=copy.copy(currentPrint.infillMovementQueueOriginalStartPosition), boundingBox=None, originalGcode=None, feature=currentFeature)
-            moveZUp.end.Z += INFILL_Z_OFFSET
-            moveZUp.end.Z = round(moveZUp.end.Z, 3)
-            currentPrint.infillMovementQueue.append(moveZUp)
-            currentPrint.offsetZ = INFILL_Z_OFFSET
-            #currentPrint.originalPosition.Z = moveZUp.end.Z
-          '''
-
-        def endInfillMovementQueue():
-          '''
-          # reset Z offset
-          # insert movement to only change Z
-          moveZDown = None
-          if currentPrint.offsetZ > 0:
-            moveZDown = Movement(startPos=copy.copy(currentPrint.originalPosition), endPos=copy.copy(currentPrint.originalPosition), boundingBox=None, originalGcode=None, feature=currentFeature)
-            moveZDown.start.Z += currentPrint.offsetZ # Set real Z position for start so that we know that Z has changed when creating Gcode
-            currentPrint.infillMovementQueue.append(moveZDown)
-          '''
-            
-          #process all queued infill moves -> output the moves
-          out.write(outputInfillMovementQueue(imq=currentPrint.infillMovementQueue, ps=currentPrint))
-
-          '''
-          # reset Z offset
-          if currentPrint.offsetZ > 0:
-            currentPrint.offsetZ = 0
-          '''
-
-        # check for feature comment
-        featureMatch = re.match(FEATURE_TYPE, cl)
-        m1Match = re.match(MACHINE_M1, cl)
-        if featureMatch:
+      # Movements are only checked against the bounding boxes near them
+      boundingBoxIndex = BoundingBoxIndex(boundingBoxes=boundingBoxes)
+
+      # Islands and output go to the plan and emit stages, or are recorded in the parsed print
+      stages: PlanEmitStages|ParsedPrint = parsedPrint
+      if parsedPrint:
+        parsedPrint.boundingBoxes = boundingBoxes
+        parsedPrint.boundingBoxIndex = boundingBoxIndex
+        parsedPrint.placementSeed = seed
+      else:
+        stages = PlanEmitStages(f=f, out=out, boundingBoxIndex=boundingBoxIndex, stats=stats, pipeline=pipeline, islandPlacer=islandPlacer)
+
+      # Bounding box geometry for every layer height in the print
+      boundingBoxIndex.precomputeLayerGeometry(heights=[layer.z for layer in layerIndex if layer.z is not None])
+
+      # Layers ending in M1 by start offset. Layers that can not intersect any bounding box are copied through in bulk.
+      passThroughLayers: dict[int, Layer] = {}
+      if PASS_THROUGH_LAYERS_OUTSIDE_BOUNDING_BOX:
+        passThroughLayers = {layer.start: layer for layer in layerIndex if layer.m1Offset != -1 and layer.zMin is not None}
+
+      def layerIntersectsBoundingBoxes(layer: Layer) -> bool:
+        # movements before the first Z word of the layer are still at the current Z
+        return boundingBoxIndex.intersectsZRange(minZ=min(layer.zMin, currentPrint.originalPosition.Z), maxZ=max(layer.zMax, currentPrint.originalPosition.Z))
+
+      def startNewLayer():
+        print(f"starting new layer")
+        currentPrint.features = []
+        currentPrint.layerIndex += 1
+        currentPrint.islandIndex = -1
+        stages.advanceDropletRasters()
+
+      # Copy a layer up to its M1 line to the output. The M1 line is handled by the read loop.
+      def passThroughLayer(layer: Layer):
+        stages.endLayer()
+        if layer.planeChangeOffset != -1:
+          startNewLayer()
+
+        # the layer end lines are written by the M1 handling
+        layerGcode = f.read(layer.start, layerEndLinesStart(f=f, end=layer.m1Offset))
+
+        # Replace outer perimeter with another string for output file only
+        if OUTPUT_RENAME_OUTER_PERIMETER and OUTER_PERIMETER in layer.featureCounts:
+          layerGcode = OUTER_PERIMETER_FEATURE.sub(lambda m: m.group(1) + OUTPUT_RENAME_OUTER_PERIMETER.encode(), layerGcode)
+
+        stages.output(layerGcode)
+
+        # track the last position of the layer as the start of the next movements
+        updatePositionFromRange(f=f, start=layer.start, end=layer.m1Offset, pp=currentPrint.originalPosition)
+        currentPrint.layerHeight = currentPrint.originalPosition.Z
+
+      def positionZIntersectsBoundingBoxZ(p: Position, bb: BoundingBox):
+        return p.Z >= bb.origin.Z and p.Z <= bb.origin.Z + bb.size.Z
+
+      def startInfillMovementQueue(queueStart: int):
+        currentPrint.infillMovementQueue = []
+        currentPrint.islandIndex += 1
+        currentPrint.infillMovementQueueOriginalStartPosition = copy.copy(currentPrint.originalPosition) #save original position at queue start
+        currentPrint.infillMovementQueueStart = queueStart
+        currentPrint.infillMovementQueueGcode = []
+        currentPrint.infillMovementQueueVerbatim = WRITE_UNMODIFIED_INFILL_VERBATIM
+
+        '''
+        # insert movement to only change Z
+        if INFILL_Z_OFFSET > 0 and positionZIntersectsBoundingBoxZ(currentPrint.originalPosition, bb=testBoundingBox):
+          moveZUp = Movement(startPos=currentPrint.infillMovementQueueOriginalStartPosition, endPos=copy.copy(currentPrint.infillMovementQueueOriginalStartPosition), boundingBox=None, originalGcode=None, feature=currentFeature)
+          moveZUp.end.Z += INFILL_Z_OFFSET
+          moveZUp.end.Z = round(moveZUp.end.Z, 3)
+          currentPrint.infillMovementQueue.append(moveZUp)
+          currentPrint.offsetZ = INFILL_Z_OFFSET
+          #currentPrint.originalPosition.Z = moveZUp.end.Z
+        '''
+
+      def endInfillMovementQueue(queueEnd: int):
+        splits = splitInfillMovementQueue(ps=currentPrint, boundingBoxIndex=boundingBoxIndex)
+
+        # Island output can run after the read loop has moved on so it uses a copy of the print state at the end of the island
+        islandPs = islandEmitState(currentPrint)
+
+        # island without bounding box segments is written as the original lines
+        if currentPrint.infillMovementQueueVerbatim:
+          stages.verbatimIsland(start=islandPs.infillMovementQueueStart, end=queueEnd, ps=islandPs)
+          currentPrint.infillMovementQueue = None
+          return
+
+        # write the output held back while the queue was open
+        for s in currentPrint.infillMovementQueueGcode:
+          if isinstance(s, Movement): # queued infill movement comment for each split movement
+            split = splits[s]
+            for _ in range(len(split) if split else 1):
+              stages.output(f"; queued 1{(' =>' + str(len(split))) if split else ''} infill movement\n")
+          else:
+            stages.output(s)
+
+        '''
+        # reset Z offset
+        # insert movement to only change Z
+        moveZDown = None
+        if currentPrint.offsetZ > 0:
+          moveZDown = Movement(startPos=copy.copy(currentPrint.originalPosition), endPos=copy.copy(currentPrint.originalPosition), boundingBox=None, originalGcode=None, feature=currentFeature)
+          moveZDown.start.Z += currentPrint.offsetZ # Set real Z position for start so that we know that Z has changed when creating Gcode
+          currentPrint.infillMovementQueue.append(moveZDown)
+        '''
+
+        #process all queued infill moves -> output the moves
+        stages.island(imq=currentPrint.infillMovementQueue, ps=islandPs)
+        currentPrint.infillMovementQueue = None
+
+        '''
+        # reset Z offset
+        if currentPrint.offsetZ > 0:
+          currentPrint.offsetZ = 0
+        '''
+
+      # Output while an infill queue is open is held back until the queue is written.
+      # Output that is not part of the queued island lines means the island can not be written as the original lines.
+      def write(s: str|bytes|Movement, island: bool = False):
+        if currentPrint.infillMovementQueue is None:
+          stages.output(s)
+        else:
+          currentPrint.infillMovementQueueGcode.append(s)
+          if not island:
+            currentPrint.infillMovementQueueVerbatim = False
+
+      # Current line and read line start position
+      lines = f.lines()
+      while (line := next(lines, None)) is not None:
+        clsp, cl = line
+
+        layer = passThroughLayers.get(clsp)
+        if layer and currentPrint.infillMovementQueue is None and not layerIntersectsBoundingBoxes(layer):
+          passThroughLayer(layer)
+          lines = f.lines(start=layer.m1Offset)
+          continue
+
+        # classify line and check for feature comment
+        gl = tokenizeLine(cl)
+        if gl.kind == GcodeLineKind.FEATURE:
           if len(currentPrint.features) > 0:
             currentPrint.features[-1].end = clsp
 
           currentFeature = Feature()
-          currentFeature.featureType = featureMatch.groups()[0]
+          currentFeature.featureType = gl.featureType
           currentFeature.start = clsp
-          
+
           if currentFeature.featureType == INFILL or currentFeature.featureType == TRAVEL:
             # Start new infill movement sequence
             if currentPrint.infillMovementQueue == None:
-              startInfillMovementQueue()
+              startInfillMovementQueue(queueStart=clsp)
             #if currentPrint.infillMovementQueue: # save feature tag gcode to queue (write feature tag twice, once where it is in the file and again when writing queue)
             #  currentPrint.infillMovementQueue.append(Movement(originalGcode=cl))
 
           elif currentPrint.infillMovementQueue: # if non INFILL/TRAVEL feature found
-            endInfillMovementQueue()
+            endInfillMovementQueue(queueEnd=clsp)
 
           if currentFeature.featureType == LAYER_CHANGE:
-            print(f"starting new layer")
-            currentPrint.features = []
-            testBoundingBox.advanceDropletRasterNextLayer()
+            stages.endLayer()
+            startNewLayer()
 
           # Replace outer perimeter with another string for output file only
           if currentFeature.featureType == OUTER_PERIMETER and OUTPUT_RENAME_OUTER_PERIMETER:
-            cl = cl.replace(OUTER_PERIMETER, OUTPUT_RENAME_OUTER_PERIMETER)
+            cl = cl.replace(OUTER_PERIMETER.encode(), OUTPUT_RENAME_OUTER_PERIMETER.encode())
 
           currentPrint.features.append(currentFeature)
 
-          out.write(cl)
-        elif m1Match: #check for M1 new layer/reset extrusion
+          write(cl, island=(currentFeature.featureType == INFILL or currentFeature.featureType == TRAVEL))
+        elif gl.kind == GcodeLineKind.MACHINE_M1: #check for M1 new layer/reset extrusion
           #process all queued infill moves
+          # an island written as the original lines stops before the layer end lines written here
           if currentPrint.infillMovementQueue:
-            endInfillMovementQueue()
+            endInfillMovementQueue(queueEnd=layerEndLinesStart(f=f, end=clsp))
+          stages.endLayer()
 
           #Assume M1 will only appear right before plane change
           #During layer change, M1 comes before plane change
           currentPrint.doneLayerCount += 1
-          out.write(f"{PULSE_OFF}\n") # Turn off pulse at end of layer to prevent dribbling
-          out.write(f"{LAYERS_COMPLETED_WRITE_OUT}{currentPrint.doneLayerCount}\n")
+          write(f"{PULSE_OFF}\n") # Turn off pulse at end of layer to prevent dribbling
+          write(f"{LAYERS_COMPLETED_WRITE_OUT}{currentPrint.doneLayerCount}\n")
 
           currentPrint.originalPosition.E = 0
-          currentPrint.deltaE = 0
-          out.write(cl)
+          stages.resetDeltaE()
+          write(cl)
 
           currentFeature = Feature()
           currentFeature.featureType = UNKNOWN
@@ -484,7 +642,7 @@ def process(inputFilepath: str, outputFilepath: str):
           lastOriginalPosition: Position = copy.copy(currentPrint.originalPosition)
 
           # Update current print state variables
-          updatePrintState(ps=currentPrint, cl=cl, sw=currentPrint.skipWrite)
+          updatePrintState(ps=currentPrint, gl=gl, sw=currentPrint.skipWrite)
 
           # retrieve current feature
           currentFeature = None
@@ -500,35 +658,12 @@ def process(inputFilepath: str, outputFilepath: str):
           if currentFeature and (currentFeature.featureType == INFILL or currentFeature.featureType == TRAVEL):
             if currentMovement.start != currentMovement.end: #G0 or G1
               if currentMovement.start.E != currentMovement.end.E: #G1 infill
-                newMovements: list[Movement] = [currentMovement] # list of new Movements bisected by boundingbox or list of just the original Movement
-
-                #if movement is infill, check for boundingbox intersect
-                boundingBoxSplitMovements = boundingBoxSplit(currentMovement, testBoundingBox)
-
-                if boundingBoxSplitMovements:
-                  newMovements = boundingBoxSplitMovements
-
-                  
-                  # Swap start/end points of trailing movement if that segment is not in bounding box
-                  if len(newMovements) > 1 and FLIP_MOVEMENT_TO_MOVE_TOWARDS_INTERSECTING_BOUNDING_BOX:
-                    if newMovements[-1].boundingBox == None:
-                      newStartXYZ = copy.copy(newMovements[-1].end)
-                      newMovements[-1].end.X = newMovements[-1].start.X
-                      newMovements[-1].end.Y = newMovements[-1].start.Y
-                      newMovements[-1].end.Z = newMovements[-1].start.Z
-                      newMovements[-1].start.X = newStartXYZ.X
-                      newMovements[-1].start.Y = newStartXYZ.Y
-                      newMovements[-1].start.Z = newStartXYZ.Z
-                  
-                for nm in newMovements:
-                  nm.originalGcode = cl
-                  #process infill movements in batch once another feature type is found
-                  currentPrint.infillMovementQueue.append(nm)
-                  
-                  out.write(f"; queued 1{(' =>' + str(len(boundingBoxSplitMovements))) if boundingBoxSplitMovements else ''} infill movement\n")
+                #infill movements are split by the bounding box in one batch when the queue ends
+                currentPrint.infillMovementQueue.append(currentMovement)
+                write(currentMovement, island=True)
               else: #G0 travel
                 currentPrint.infillMovementQueue.append(currentMovement)
-                out.write(f"; queued 1 travel movement\n")
+                write(f"; queued 1 travel movement\n", island=True)
                 '''
             else: #misc gcode
               if cl == f"{PULSE_ON}\n" or cl == f"{PULSE_OFF}\n":
@@ -539,27 +674,89 @@ def process(inputFilepath: str, outputFilepath: str):
                 currentPrint.infillMovementQueue.append(currentMovement)
                 out.write(f"; queued 1 misc gcode\n")
                 '''
-          
+
           else:
-            out.write(cl)
+            write(cl)
           #print(f.tell())
-          
+
           # start new infill map
 
-      out.write(f';Post Processed with variable density\n')
+      stages.endLayer()
+
+      # output held back by a queue that was not ended
+      if currentPrint.infillMovementQueue is not None:
+        for s in currentPrint.infillMovementQueueGcode:
+          if not isinstance(s, Movement):
+            stages.output(s)
+
+      stages.output(f';Post Processed with variable density\n')
 
+      if pipeline:
+        pipeline.close()
+        stats.timings = pipeline.timings()
+        for timing in stats.timings:
+          print(f"pipeline {timing}")
+
+      if parsedPrint:
+        print(f"Parsed {inputFilepath} into {len(parsedPrint.steps)} steps")
+      else:
+        print(f"Saved new mpf to {outputFilepath}")
+
+  except PermissionError as e:
+    print(f"Failed to open {e}")
+
+  stats.elapsed = time.monotonic()-startTime
+  print(f"Placed {stats.dropletsPlaced}/{stats.dropletsNeeded} droplets needed for density in {stats.islands} infill islands")
+  print(f"Completed in {str(datetime.timedelta(seconds=stats.elapsed))}s")
+  return stats
+
+def parsePrint(inputFilepath: str, seed: int = PLACEMENT_SEED) -> ParsedPrint:
+  """Parse an MPF file once into the steps of the plan and emit stages. Emit it with emitParsedPrint().
+
+  :param inputFilepath: Input MPF file path
+  :type inputFilepath: str
+  :param seed: Placement seed, None for unseeded placement
+  :type seed: int
+  :return: Parsed print
+  :rtype: ParsedPrint
+  """
+  parsedPrint = ParsedPrint(inputFilepath=inputFilepath)
+  parsedPrint.elapsed = process(inputFilepath=inputFilepath, outputFilepath=None, seed=seed, parsedPrint=parsedPrint).elapsed
+  return parsedPrint
+
+def emitParsedPrint(parsedPrint: ParsedPrint, outputFilepath: str) -> ProcessStats:
+  """Place the islands of a parsed print and write the output with the current constants. The output is the same as process() with the seed the print was parsed with.
+
+  :param parsedPrint: Parsed print that has not been emitted
+  :type parsedPrint: ParsedPrint
+  :param outputFilepath: Output MPF file path
+  :type outputFilepath: str
+  :return: Island and droplet totals and timing of the run
+  :rtype: ProcessStats
+  """
+  startTime = time.monotonic()
+  stats = ProcessStats(inputFilepath=parsedPrint.inputFilepath, outputFilepath=outputFilepath)
+
+  try:
+    with MappedFile(parsedPrint.inputFilepath) as f, open(outputFilepath, mode='wb') as outFile, ChunkedWriter(outFile) as out:
+      parsedPrint.emit(stages=PlanEmitStages(f=f, out=out, boundingBoxIndex=parsedPrint.boundingBoxIndex, stats=stats))
       print(f"Saved new mpf to {outputFilepath}")
 
   except PermissionError as e:
     print(f"Failed to open {e}")
 
-  print(f"Completed in {str(datetime.timedelta(seconds=time.monotonic()-startTime))}s")
+  stats.elapsed = time.monotonic()-startTime
+  print(f"Placed {stats.dropletsPlaced}/{stats.dropletsNeeded} droplets needed for density in {stats.islands} infill islands")
+  print(f"Completed in {str(datetime.timedelta(seconds=stats.elapsed))}s")
+  return stats
 
-#process(inputFilepath='test-square.mpf', outputFilepath='test-square-output.mpf')
-process(inputFilepath=MPF_INPUT_FILE, outputFilepath=MPF_OUTPUT_FILE)
-#process(inputFilepath='test-square-10-layer.mpf', outputFilepath='test-square-output.mpf')
+# worker processes started with spawn import this file again and must not run it
+if __name__ == '__main__':
+  #process(inputFilepath='test-square.mpf', outputFilepath='test-square-output.mpf')
+  process(inputFilepath=MPF_INPUT_FILE, outputFilepath=MPF_OUTPUT_FILE)
+  #process(inputFilepath='test-square-10-layer.mpf', outputFilepath='test-square-output.mpf')
 
-#process(inputFilepath='test-square-10-layer.mpf', outputFilepath='test-square-output.gcode')
+  #process(inputFilepath='test-square-10-layer.mpf', outputFilepath='test-square-output.gcode')
 
-# copy and change extesion to .gcode for drag and drop preview in gcode previewer
-shutil.copyfile(MPF_OUTPUT_FILE, GCODE_OUTPUT_FILE)
\ No newline at end of file
+  # copy and change extesion to .gcode for drag and drop preview in gcode previewer
+  shutil.copyfile(MPF_OUTPUT_FILE, GCODE_OUTPUT_FILE)
\ No newline at end of file
@@ -0,0 +1,70 @@
+import mmap
+
+from typing import Iterator
+
+class MappedFile:
+  """
+  Read only memory map of an input file. Lines are read as bytes slices of the map with their true byte offsets in the file.
+  CRLF and LF line endings are handled per line. Lines are returned ending with LF like a file opened in text mode.
+  """
+  def __init__(self, filepath: str):
+    self.filepath: str = filepath
+    self.file = open(filepath, mode='rb')
+    try:
+      self.map: mmap.mmap|bytes = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+    except ValueError: # empty files can not be mapped
+      self.map = b''
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+  def close(self):
+    if isinstance(self.map, mmap.mmap):
+      self.map.close()
+    self.file.close()
+
+  def __len__(self):
+    return len(self.map)
+
+  def view(self, start: int, end: int) -> memoryview:
+    """
+    Zero-copy view of a byte range for bulk copies. Line endings are not converted.
+    """
+    return memoryview(self.map)[start:end]
+
+  def read(self, start: int, end: int) -> bytes:
+    """
+    Copy a byte range with CRLF line endings converted to LF like lines().
+    """
+    data = self.map[start:end]
+    return data.replace(b'\r\n', b'\n') if b'\r' in data else data
+
+  def lines(self, start: int = 0, end: int = None) -> Iterator[tuple[int, bytes]]:
+    """
+    Iterate lines starting at byte offset start until byte offset end.
+
+    :param start: Byte offset of the first line
+    :type start: int
+    :param end: Byte offset to stop at. Defaults to end of file.
+    :type end: int
+    :return: Iterator of (byte offset of line start, line ending with LF)
+    :rtype: Iterator[tuple[int, bytes]]
+    """
+    m = self.map
+    end = len(m) if end is None else end
+    find = m.find
+    pos = start
+    while pos < end:
+      nl = find(b'\n', pos, end)
+      if nl < 0: # last line without line ending
+        yield pos, m[pos:end]
+        return
+      if nl > pos and m[nl-1] == 13: # CRLF
+        yield pos, m[pos:nl-1] + b'\n'
+      else:
+        yield pos, m[pos:nl+1]
+      pos = nl+1
+
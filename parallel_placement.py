@@ -0,0 +1,228 @@
+import gc, io, pickle, multiprocessing, multiprocessing.pool
+
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from printing_classes import *
+from constants import *
+from placement import *
+
+class SharedRasterPickler(pickle.Pickler):
+  """
+  Pickle arrays in shared memory as a reference to their shared memory block so workers write droplets into the rasters of the main process.
+  """
+  def __init__(self, file: io.BytesIO, sharedArrays: dict[int, tuple[np.ndarray, str]]):
+    super().__init__(file, protocol=pickle.HIGHEST_PROTOCOL)
+    self.sharedArrays = sharedArrays
+
+  def persistent_id(self, obj):
+    if isinstance(obj, np.ndarray):
+      shared = self.sharedArrays.get(id(obj))
+      if shared is not None and shared[0] is obj:
+        return (shared[1], obj.shape, obj.dtype.str)
+    return None
+
+# Shared memory blocks attached by this process by block name. Blocks stay attached for the life of the worker.
+attachedSharedMemory: dict[str, shared_memory.SharedMemory] = {}
+
+class SharedRasterUnpickler(pickle.Unpickler):
+  def persistent_load(self, pid):
+    name, shape, dtype = pid
+    block = attachedSharedMemory.get(name)
+    if block is None:
+      block = shared_memory.SharedMemory(name=name)
+      attachedSharedMemory[name] = block
+    return np.ndarray(shape, dtype=dtype, buffer=block.buf)
+
+def islandPlacementState(ps: PrintState) -> PrintState:
+  """
+  Return a PrintState with only the values used to place an island so it can be sent to a worker.
+  """
+  islandPs = PrintState()
+  islandPs.layerHeight = ps.layerHeight
+  islandPs.placementSeed = ps.placementSeed
+  islandPs.layerIndex = ps.layerIndex
+  islandPs.islandIndex = ps.islandIndex
+  return islandPs
+
+def islandDropletCounts(ps: PrintState) -> tuple[int, int, int, int]:
+  return (ps.infillModifiedDropletsOriginal, ps.infillModifiedDropletsNeededForDensity, ps.infillModifiedDropletsSupportedAvailable, ps.infillModifiedDropletsPlaced)
+
+def setIslandDropletCounts(ps: PrintState, counts: tuple[int, int, int, int]):
+  ps.infillModifiedDropletsOriginal, ps.infillModifiedDropletsNeededForDensity, ps.infillModifiedDropletsSupportedAvailable, ps.infillModifiedDropletsPlaced = counts
+
+def placeIslandGroup(payload: bytes) -> tuple[list[tuple[list[int], list[DropletBatch], tuple[int, int, int, int]]], list[int]]:
+  """
+  Worker task that places a group of islands in order.
+
+  :param payload: Islands and the bounding boxes they use pickled by SharedRasterPickler
+  :type payload: bytes
+  :return: Movement order, droplets and droplet counts of each island, and the indices of the bounding boxes whose raster was initialized
+  :rtype: tuple[list[tuple[list[int], list[DropletBatch], tuple[int, int, int, int]]], list[int]]
+  """
+  islands, sources = SharedRasterUnpickler(io.BytesIO(payload)).load()
+
+  results = []
+  for imq, ps in islands:
+    originalIndex = {id(m): i for i, m in enumerate(imq)}
+    placeIsland(imq=imq, ps=ps)
+
+    droplets = []
+    for m in imq:
+      if m.dropletMovements is not None:
+        m.dropletMovements.movement = None # the movement is reattached in the main process
+      droplets.append(m.dropletMovements)
+    results.append(([originalIndex[id(m)] for m in imq], droplets, islandDropletCounts(ps)))
+
+  return results, [i for i, bb in enumerate(sources) if bb.dropletRaster is not None]
+
+class ParallelIslandPlacer:
+  """
+  Place the queued infill islands of a layer in a process pool.
+  Islands only interact through the current layer raster of their bounding boxes. Islands farther apart than the collision kernel are independent and are placed in separate workers that write droplets into the rasters in shared memory.
+  Islands close to each other, and all islands of a bounding box on the layer its raster is initialized, are placed in order in the same worker.
+  With the placement random stream of each island from its layer and island index the droplets are the same as placing the islands serially.
+  """
+  def __init__(self, workers: int, boundingBoxes: list[BoundingBox]):
+    self.workers: int = workers
+    self.boundingBoxes: list[BoundingBox] = boundingBoxes
+    self.pool: multiprocessing.pool.Pool = None
+    self.sharedMemory: list[shared_memory.SharedMemory] = []
+    self.sharedArrays: dict[int, tuple[np.ndarray, str]] = {} # shared array and block name by array id
+
+    # rasters are allocated in shared memory up front and taken by initializeDropletRaster on first use
+    for bb in boundingBoxes:
+      if bb.dropletRaster is None and bb.dropletRasterPreallocated is None:
+        shape = bb.dropletRasterShape()
+        bb.dropletRasterPreallocated = (self.sharedZeros(shape=shape, dtype=np.uint8), self.sharedZeros(shape=shape, dtype=np.uint8), self.sharedZeros(shape=bb.dropletRasterBlockedShape(), dtype=bool))
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.close()
+
+  def sharedZeros(self, shape: tuple[int, int], dtype: np.dtype) -> np.ndarray:
+    block = shared_memory.SharedMemory(create=True, size=max(1, int(np.prod(shape)) * np.dtype(dtype).itemsize))
+    array = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+    array.fill(0)
+    self.sharedMemory.append(block)
+    self.sharedArrays[id(array)] = (array, block.name)
+    return array
+
+  def close(self):
+    if self.pool is not None:
+      self.pool.close()
+      self.pool.join()
+      self.pool = None
+    # drop the raster views into the blocks before closing them
+    for bb in self.boundingBoxes:
+      bb.freeDropletRaster()
+      bb.dropletRasterPreallocated = None
+    self.sharedArrays = {}
+    # BoundingBox copies in queued movements and movement/droplet cycles hold views until they are collected
+    gc.collect()
+    blocks, self.sharedMemory = self.sharedMemory, []
+    for block in blocks:
+      block.unlink()
+      try:
+        block.close()
+      except BufferError:
+        # the output is already written, the mapping is released when the process exits
+        print(f"Shared raster memory {block.name} is still in use and stays mapped until exit")
+
+  def islandFootprints(self, imq: list[Movement]) -> dict[BoundingBox, tuple[float, float, float, float]]:
+    # XY extent of the island movements in each bounding box raster
+    footprints: dict[BoundingBox, tuple[float, float, float, float]] = {}
+    for m in imq:
+      if m.boundingBox:
+        source = m.boundingBox.layerGeometrySource
+        minX, minY, maxX, maxY = min(m.start.X, m.end.X), min(m.start.Y, m.end.Y), max(m.start.X, m.end.X), max(m.start.Y, m.end.Y)
+        if source in footprints:
+          f = footprints[source]
+          minX, minY, maxX, maxY = min(f[0], minX), min(f[1], minY), max(f[2], maxX), max(f[3], maxY)
+        footprints[source] = (minX, minY, maxX, maxY)
+    return footprints
+
+  def groupIslands(self, islands: list[tuple[list[Movement], PrintState]]) -> list[list[int]]:
+    """
+    Group islands that can affect each other. Island footprints are padded by the collision kernel side distance plus the supported position offsets.
+
+    :return: Island indices of each group in island order
+    :rtype: list[list[int]]
+    """
+    footprints = [self.islandFootprints(imq) for imq, _ in islands]
+
+    parent = list(range(len(islands)))
+    def root(i: int) -> int:
+      while parent[i] != i:
+        parent[i] = parent[parent[i]]
+        i = parent[i]
+      return i
+
+    for i in range(len(islands)):
+      for j in range(i):
+        for source, a in footprints[i].items():
+          b = footprints[j].get(source)
+          if b is None:
+            continue
+          # the layer a raster is initialized on changes how later islands are planned
+          margin = (int((DROPLET_RASTER_COLLISION_SEARCH_KERNEL_SIZE-1)/2) + 2) * DROPLET_WIDTH * source.dropletRasterResolution + DROPLET_WIDTH
+          if source.dropletRaster is None or (a[0] - margin <= b[2] and b[0] - margin <= a[2] and a[1] - margin <= b[3] and b[1] - margin <= a[3]):
+            parent[root(i)] = root(j)
+            break
+
+    groups: dict[int, list[int]] = {}
+    for i in range(len(islands)):
+      groups.setdefault(root(i), []).append(i)
+    return list(groups.values())
+
+  def place(self, islands: list[tuple[list[Movement], PrintState]]):
+    """
+    Place the islands of a layer. The queued movements of each island are reordered and given their droplets, and the droplet counts of each PrintState are set, as placeIsland() would.
+
+    :param islands: Infill movement queue and PrintState of each island in island order
+    :type islands: list[tuple[list[Movement], PrintState]]
+    """
+    islandStates = [ps for _, ps in islands]
+    islands = [(imq, islandPlacementState(ps)) for imq, ps in islands]
+    groups = self.groupIslands(islands)
+
+    payloads: list[bytes] = []
+    groupSources: list[list[BoundingBox]] = []
+    if len(groups) > 1 and self.workers > 1:
+      try:
+        for group in groups:
+          sources = list({source: None for i in group for source in self.islandFootprints(islands[i][0])})
+          payload = io.BytesIO()
+          SharedRasterPickler(payload, sharedArrays=self.sharedArrays).dump(([islands[i] for i in group], sources))
+          payloads.append(payload.getvalue())
+          groupSources.append(sources)
+      except (pickle.PicklingError, AttributeError, TypeError) as e:
+        print(f"Placing islands serially because they can not be sent to worker processes: {e}")
+        payloads = []
+
+    if not payloads:
+      for (imq, ps), islandState in zip(islands, islandStates):
+        placeIsland(imq=imq, ps=ps)
+        setIslandDropletCounts(islandState, islandDropletCounts(ps))
+      return
+
+    if self.pool is None:
+      self.pool = multiprocessing.Pool(processes=self.workers)
+
+    for group, sources, (results, initialized) in zip(groups, groupSources, self.pool.map(placeIslandGroup, payloads)):
+      for i, (order, droplets, counts) in zip(group, results):
+        setIslandDropletCounts(islandStates[i], counts)
+        imq = islands[i][0]
+        imq[:] = [imq[k] for k in order]
+        for m, d in zip(imq, droplets):
+          if d is not None:
+            d.movement = m
+          m.dropletMovements = d
+
+      # rasters initialized by a worker are already filled in shared memory
+      for k in initialized:
+        if sources[k].dropletRaster is None:
+          sources[k].initializeDropletRaster()
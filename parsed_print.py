@@ -0,0 +1,92 @@
+import copy, enum, pickle
+
+from printing_classes import *
+
+class ParsedStepKind(enum.Enum):
+  OUTPUT = enum.auto() # lines written as they are
+  ISLAND = enum.auto() # queued infill island placed and written
+  VERBATIM_ISLAND = enum.auto() # infill island written as the original lines
+  ADVANCE_DROPLET_RASTERS = enum.auto() # new layer
+  RESET_DELTA_E = enum.auto() # M1 extrusion reset
+
+def islandEmitState(ps: PrintState) -> PrintState:
+  """
+  Return a PrintState with only the values used to place and write an island. The island is placed and written after the read loop has moved on so positions are copied.
+  """
+  islandPs = PrintState()
+  islandPs.layerHeight = ps.layerHeight
+  islandPs.placementSeed = ps.placementSeed
+  islandPs.layerIndex = ps.layerIndex
+  islandPs.islandIndex = ps.islandIndex
+  islandPs.originalPosition = copy.copy(ps.originalPosition)
+  islandPs.infillMovementQueueOriginalStartPosition = copy.copy(ps.infillMovementQueueOriginalStartPosition)
+  islandPs.infillMovementQueueStart = ps.infillMovementQueueStart
+  return islandPs
+
+class ParsedPrint:
+  """
+  Input file parsed by process() into the steps of the plan and emit stages, so islands can be placed and the output written without parsing the input again.
+  It records the calls process() makes to PlanEmitStages and emit() replays them.
+  Steps only hold values that do not depend on the droplet placement constants, so a parsed print can be emitted with different placement constants.
+  Emitting places droplets into the rasters of the bounding boxes, so a parsed print is emitted once. Save it to a file and load a copy for each emit.
+  """
+  def __init__(self, inputFilepath: str):
+    self.inputFilepath: str = inputFilepath # verbatim islands are read from the input when emitted
+    self.steps: list[tuple] = [] # (ParsedStepKind, values...)
+    self.boundingBoxes: list[BoundingBox] = None
+    self.boundingBoxIndex: 'BoundingBoxIndex' = None
+    self.placementSeed: int = None
+    self.elapsed: float = 0 # seconds spent parsing
+
+  def output(self, s: str|bytes):
+    # consecutive lines are kept in one step
+    if self.steps and self.steps[-1][0] == ParsedStepKind.OUTPUT:
+      self.steps[-1][1].append(s)
+    else:
+      self.steps.append((ParsedStepKind.OUTPUT, [s]))
+
+  def island(self, imq: list[Movement], ps: PrintState):
+    self.steps.append((ParsedStepKind.ISLAND, imq, ps))
+
+  def verbatimIsland(self, start: int, end: int, ps: PrintState):
+    self.steps.append((ParsedStepKind.VERBATIM_ISLAND, start, end, ps))
+
+  def advanceDropletRasters(self):
+    self.steps.append((ParsedStepKind.ADVANCE_DROPLET_RASTERS,))
+
+  def resetDeltaE(self):
+    self.steps.append((ParsedStepKind.RESET_DELTA_E,))
+
+  def endLayer(self):
+    # islands are placed one at a time when emitted
+    pass
+
+  def emit(self, stages: 'PlanEmitStages'):
+    """
+    Run the steps through the plan and emit stages.
+
+    :param stages: Plan and emit stages writing the output
+    :type stages: PlanEmitStages
+    """
+    for kind, *values in self.steps:
+      if kind == ParsedStepKind.OUTPUT:
+        for s in values[0]:
+          stages.output(s)
+      elif kind == ParsedStepKind.ISLAND:
+        stages.island(*values)
+      elif kind == ParsedStepKind.VERBATIM_ISLAND:
+        stages.verbatimIsland(*values)
+      elif kind == ParsedStepKind.ADVANCE_DROPLET_RASTERS:
+        stages.advanceDropletRasters()
+      elif kind == ParsedStepKind.RESET_DELTA_E:
+        stages.resetDeltaE()
+    stages.endLayer()
+
+  def save(self, filepath: str):
+    with open(filepath, mode='wb') as parsedFile:
+      pickle.dump(self, parsedFile, protocol=pickle.HIGHEST_PROTOCOL)
+
+  @staticmethod
+  def load(filepath: str):
+    with open(filepath, mode='rb') as parsedFile:
+      return pickle.load(parsedFile)
@@ -0,0 +1,141 @@
+import queue, threading, time, typing
+
+from constants import *
+
+class PipelineStage:
+  """
+  Thread that runs the tasks put in its bounded queue in the order they are put.
+  Putting a task into a full queue blocks the producer until the stage catches up (backpressure).
+  After a task fails the remaining tasks are drained without running so producers never block on a dead stage. The error is raised in the producer.
+  """
+  def __init__(self, name: str, queueSize: int = PIPELINE_QUEUE_SIZE):
+    self.name: str = name
+    self.queue: queue.Queue = queue.Queue(maxsize=queueSize)
+    self.error: BaseException = None
+
+    # Timing counters
+    self.tasks: int = 0
+    self.busyTime: float = 0 # running tasks
+    self.idleTime: float = 0 # waiting for tasks
+    self.blockedPuts: int = 0 # puts into the full queue
+    self.blockedTime: float = 0 # producers waiting for space in the full queue
+    self.maxQueued: int = 0
+
+    self.thread = threading.Thread(target=self.run, name=name, daemon=True)
+    self.thread.start()
+
+  def put(self, task: typing.Callable[[], None]|None):
+    self.raiseError()
+    if self.queue.full():
+      self.blockedPuts += 1
+      startTime = time.perf_counter()
+      while True:
+        try:
+          self.queue.put(task, timeout=0.1)
+          break
+        except queue.Full:
+          self.raiseError()
+      self.blockedTime += time.perf_counter() - startTime
+    else:
+      self.queue.put(task)
+    self.maxQueued = max(self.maxQueued, self.queue.qsize())
+
+  def run(self):
+    while True:
+      startTime = time.perf_counter()
+      task = self.queue.get()
+      self.idleTime += time.perf_counter() - startTime
+      if task is None:
+        return
+      if self.error is None:
+        startTime = time.perf_counter()
+        try:
+          task()
+        except BaseException as e:
+          self.error = e
+        self.busyTime += time.perf_counter() - startTime
+        self.tasks += 1
+
+  def raiseError(self):
+    if self.error is not None:
+      raise RuntimeError(f"{self.name} stage failed") from self.error
+
+  def waitFor(self, event: threading.Event):
+    # wait for an event set by a task of this stage
+    while not event.wait(timeout=0.1):
+      self.raiseError()
+
+  def close(self):
+    if self.thread.is_alive():
+      self.queue.put(None)
+      self.thread.join()
+    self.raiseError()
+
+  def timings(self) -> str:
+    return f"{self.name} ran {self.tasks} tasks, busy {self.busyTime:.3f}s, idle {self.idleTime:.3f}s, producers blocked {self.blockedPuts} times for {self.blockedTime:.3f}s, max queued {self.maxQueued}"
+
+class Pipeline:
+  """
+  Threads running the plan and emit steps of PlanEmitStages, connected by bounded queues. The read loop of process() is the parse stage.
+  The plan stage owns the droplet rasters and places islands. The emit stage formats and writes all output in order, waiting for islands to be placed.
+  Output lines are passed to the emit stage in batches.
+  """
+  def __init__(self, out: typing.Any, queueSize: int = PIPELINE_QUEUE_SIZE, batchSize: int = PIPELINE_BATCH_SIZE):
+    self.out = out
+    self.planner: PipelineStage = PipelineStage(name='plan', queueSize=queueSize)
+    self.writer: PipelineStage = PipelineStage(name='emit', queueSize=queueSize)
+    self.batch: list[str|bytes] = []
+    self.batchSize: int = batchSize
+    self.startTime: float = time.perf_counter()
+    self.parseTime: float = None
+    self.emitWaitTime: float = 0 # emit stage waiting for islands to be placed
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    try:
+      self.close()
+    except Exception:
+      if exc_type is None:
+        raise
+
+  def write(self, s: str|bytes):
+    self.batch.append(s)
+    if len(self.batch) >= self.batchSize:
+      self.flushBatch()
+
+  def flushBatch(self):
+    if self.batch:
+      batch, self.batch = self.batch, []
+      def writeBatch():
+        for s in batch:
+          self.out.write(s)
+      self.writer.put(writeBatch)
+
+  def later(self, task: typing.Callable[[], None]):
+    # run a task in the emit stage after the output written before it
+    self.flushBatch()
+    self.writer.put(task)
+
+  def plan(self, task: typing.Callable[[], None]):
+    self.planner.put(task)
+
+  def waitForPlan(self, event: threading.Event):
+    startTime = time.perf_counter()
+    self.planner.waitFor(event)
+    self.emitWaitTime += time.perf_counter() - startTime
+
+  def close(self):
+    if self.parseTime is None:
+      self.parseTime = time.perf_counter() - self.startTime
+    self.flushBatch()
+    self.planner.close()
+    self.writer.close()
+
+  def timings(self) -> list[str]:
+    return [
+      f"parse {self.parseTime:.3f}s, blocked {self.planner.blockedTime + self.writer.blockedTime:.3f}s on full queues",
+      self.planner.timings(),
+      f"{self.writer.timings()}, waited {self.emitWaitTime:.3f}s for placement"
+    ]
@@ -0,0 +1,484 @@
+import math, copy, random
+
+import numpy as np
+
+from printing_classes import *
+from constants import *
+from infill import *
+
+def placementRng(ps: PrintState) -> random.Random:
+  """
+  Return the random stream for placing the droplets of the current infill island.
+  With a placement seed each (seed, layer index, island index) gets an independent stream, so the droplets of an island do not depend on the islands placed before it. Without a seed the global random module is used.
+
+  :param ps: PrintState
+  :type ps: PrintState
+  :return: Random stream of the island
+  :rtype: random.Random
+  """
+  if ps.placementSeed is None:
+    return random
+  seedSequence = np.random.SeedSequence(entropy=ps.placementSeed, spawn_key=(ps.layerIndex, ps.islandIndex))
+  return random.Random(int.from_bytes(seedSequence.generate_state(4).tobytes(), byteorder='little'))
+
+def prepareMovementForPlacement(m: Movement):
+  if m.boundingBox.dropletRaster is None: # initialize raster with [1] allocated if needed
+    m.boundingBox.initializeDropletRaster()
+
+  if DEBUG_PREVIEW_ALL_DROPLETS_SUPPORTED:
+    fillBBDropletRasterForDropletBatch(bb=m.boundingBox, droplets=m.dropletMovements)
+
+def placeInitialLayerDroplets(m: Movement, ps: PrintState) -> int:
+  """
+  Reduce and space out the droplets of a movement on the first layer of a bounding box where there is no last layer to support droplets.
+
+  :return: Number of droplets placed
+  :rtype: int
+  """
+  reducedDroplets = reduceDropletsToDensity(droplets=m.dropletMovements, density=m.density if m.density is not None else m.boundingBox.density)
+  ps.infillModifiedDropletsNeededForDensity -= len(reducedDroplets)
+  m.dropletMovements = reducedDroplets
+  fillBBDropletRasterForDropletBatch(bb=m.boundingBox, droplets=reducedDroplets)
+  return len(reducedDroplets)
+
+def placeSupportedPosition(m: Movement, sp: tuple[int, Position], ps: PrintState):
+  # Add to unsorted list of placed supported positions. Sort this when all random position added by the original index
+  # Droplets are created from the sorted positions after placement
+  if m.placedSupportedPositions == None:
+    m.placedSupportedPositions = []
+  m.placedSupportedPositions.append(sp)
+
+  # Fill current layer raster with droplet
+  fillBBDropletRasterForPosition(bb=m.boundingBox, pos=sp[1])
+
+  ps.infillModifiedDropletsNeededForDensity -= 1
+
+def placeDropletsRoundRobin(movements: list[Movement], ps: PrintState, rng: random.Random = random) -> int:
+  """
+  Place droplets in passes over the movements. Each pass places at most one droplet per movement at a random unblocked supported position.
+
+  :param movements: Movements in pass order
+  :type movements: list[Movement]
+  :param ps: PrintState
+  :type ps: PrintState
+  :param rng: Random stream of the island
+  :type rng: random.Random
+  :return: Total number of droplets placed
+  :rtype: int
+  """
+  totalDropletsPlaced = 0
+
+  while ps.infillModifiedDropletsNeededForDensity > 0:
+    dropletsPlaced = 0
+
+    for m in movements:
+      if m.boundingBox: # check if movement needs to be modified because it is in bounding box
+        prepareMovementForPlacement(m)
+
+        if m.boundingBox.dropletRaster[0] is None: #initial layer, reduce and space out drops
+          dropletsPlaced += placeInitialLayerDroplets(m=m, ps=ps)
+        else: # not initial layer, place drops on supported area
+          if len(m.supportedPositions) > 0:
+            # pick random unfilled support position to make droplet for
+            sp = None
+            while sp == None and len(m.supportedPositions) > 0:
+              randomSupportPositionIdx = rng.randint(0,len(m.supportedPositions)-1)
+
+              # check if another placed droplet on this layer would overlap too much with this droplet
+              # blocked mask is the current layer raster dilated by the collision kernel
+              if not isBBDropletRasterPositionBlocked(bb=m.boundingBox, pos=m.supportedPositions[randomSupportPositionIdx][1]):
+                sp = m.supportedPositions[randomSupportPositionIdx]
+                break
+
+              del m.supportedPositions[randomSupportPositionIdx]
+
+            if sp:
+              placeSupportedPosition(m=m, sp=sp, ps=ps)
+              dropletsPlaced += 1
+
+              # Remove position from supported positions
+              del m.supportedPositions[randomSupportPositionIdx]
+
+    totalDropletsPlaced += dropletsPlaced
+
+    # Stop trying to place droplets if we ran out of valid positions
+    if dropletsPlaced == 0:
+      print(f"Ran out of support positions on layer {ps.layerHeight}")
+      break
+
+  return totalDropletsPlaced
+
+def collectSupportedCandidates(movements: list[Movement], ps: PrintState) -> tuple[int, list[Movement], list[list[int]], list[tuple[list[int], list[int]]]]:
+  """
+  Place the first layer droplets of a bounding box and collect the supported position candidates of the other movements.
+
+  :return: Number of first layer droplets placed, movements with supported positions, remaining supported position rows of each movement, and raster X/Y indices of each supported position row
+  :rtype: tuple[int, list[Movement], list[list[int]], list[tuple[list[int], list[int]]]]
+  """
+  dropletsPlaced = 0
+  supportedMovements: list[Movement] = []
+  pools: list[list[int]] = []
+  rasterIndices: list[tuple[list[int], list[int]]] = []
+  for m in movements:
+    if m.boundingBox:
+      prepareMovementForPlacement(m)
+
+      if m.boundingBox.dropletRaster[0] is None: #initial layer, reduce and space out drops
+        dropletsPlaced += placeInitialLayerDroplets(m=m, ps=ps)
+      elif len(m.supportedPositions) > 0:
+        xyResolution = DROPLET_WIDTH*m.boundingBox.dropletRasterResolution
+        supportedMovements.append(m)
+        pools.append(list(m.supportedPositions.rows))
+        rasterIndices.append((np.rint((m.supportedPositions.x-m.boundingBox.origin.X)/xyResolution).astype(np.int64).tolist(), np.rint((m.supportedPositions.y-m.boundingBox.origin.Y)/xyResolution).astype(np.int64).tolist()))
+  return dropletsPlaced, supportedMovements, pools, rasterIndices
+
+def placeDropletsPooled(movements: list[Movement], ps: PrintState, fairness: bool = PLACEMENT_POOLED_FAIRNESS, rng: random.Random = random) -> int:
+  """
+  Place droplets from the supported positions of all movements of the island pooled together.
+  Candidates are drawn at random and swap-removed in O(1) so every candidate is looked at most once. Raster indices of all candidates are computed up front.
+  Without fairness the island is placed in a single pass over one pool until the droplets needed for density are placed, so movements get droplets in proportion to their supported positions.
+  With fairness each movement keeps its own pool and passes place at most one droplet per movement like placeDropletsRoundRobin, but without the O(n) removals.
+
+  :param movements: Movements in pass order
+  :type movements: list[Movement]
+  :param ps: PrintState
+  :type ps: PrintState
+  :param fairness: Place at most one droplet per movement per pass
+  :type fairness: bool
+  :param rng: Random stream of the island
+  :type rng: random.Random
+  :return: Total number of droplets placed
+  :rtype: int
+  """
+  if ps.infillModifiedDropletsNeededForDensity <= 0:
+    return 0
+
+  totalDropletsPlaced, supportedMovements, pools, rasterIndices = collectSupportedCandidates(movements=movements, ps=ps)
+
+  def drawUnblocked(i: int, pool: list[int]) -> int|None:
+    # swap-remove random candidates from the pool until one is not blocked
+    m = supportedMovements[i]
+    rasterX, rasterY = rasterIndices[i]
+    while pool:
+      k = rng.randint(0, len(pool)-1)
+      row = pool[k]
+      pool[k] = pool[-1]
+      pool.pop()
+      if not isBBDropletRasterIndexBlocked(bb=m.boundingBox, rasterX=rasterX[row], rasterY=rasterY[row]):
+        return row
+    return None
+
+  def place(i: int, row: int):
+    m = supportedMovements[i]
+    placeSupportedPosition(m=m, sp=(int(m.supportedPositions.index[row]), m.supportedPositions.position(row)), ps=ps)
+
+  if fairness:
+    active = [i for i in range(len(supportedMovements))]
+    while ps.infillModifiedDropletsNeededForDensity > 0 and active:
+      dropletsPlaced = 0
+      for i in active:
+        row = drawUnblocked(i, pools[i])
+        if row is not None:
+          place(i, row)
+          dropletsPlaced += 1
+      totalDropletsPlaced += dropletsPlaced
+      active = [i for i in active if pools[i]]
+      if dropletsPlaced == 0:
+        break
+  else:
+    # one pool of (movement, row) candidates for the island
+    pool = [(i, row) for i in range(len(supportedMovements)) for row in pools[i]]
+    for p in pools:
+      p.clear()
+    while ps.infillModifiedDropletsNeededForDensity > 0 and pool:
+      k = rng.randint(0, len(pool)-1)
+      i, row = pool[k]
+      pool[k] = pool[-1]
+      pool.pop()
+      rasterX, rasterY = rasterIndices[i]
+      if isBBDropletRasterIndexBlocked(bb=supportedMovements[i].boundingBox, rasterX=rasterX[row], rasterY=rasterY[row]):
+        continue
+      place(i, row)
+      totalDropletsPlaced += 1
+    for i, row in pool:
+      pools[i].append(row)
+
+  # remaining candidates stay with their movements
+  for m, p in zip(supportedMovements, pools):
+    m.supportedPositions.rows = p
+
+  if ps.infillModifiedDropletsNeededForDensity > 0:
+    print(f"Ran out of support positions on layer {ps.layerHeight}")
+
+  return totalDropletsPlaced
+
+def blueNoiseSample(x: np.ndarray, y: np.ndarray, priority: np.ndarray, spacing: int) -> np.ndarray:
+  """
+  Pick a maximal subset of raster cells that are all at least spacing apart (Chebyshev distance in raster indices) with a phased grid Poisson-disk sampler.
+  The cells are bucketed into a grid of spacing sized grid cells, which can each hold one pick. Grid cells are visited in 4 phases of alternating grid cells so the grid cells of a phase can not conflict with each other.
+  In each phase every grid cell picks its lowest priority candidate that is not too close to a pick of an earlier phase in the 8 neighboring grid cells.
+
+  :param x: Candidate X raster indices
+  :type x: np.ndarray
+  :param y: Candidate Y raster indices
+  :type y: np.ndarray
+  :param priority: Candidate priority, lower is picked first
+  :type priority: np.ndarray
+  :param spacing: Minimum distance between picks in raster indices
+  :type spacing: int
+  :return: Indices of the picked candidates
+  :rtype: np.ndarray
+  """
+  gx = (x - x.min()) // spacing
+  gy = (y - y.min()) // spacing
+  gridShape = (int(gx.max()) + 1, int(gy.max()) + 1)
+  cell = gx * gridShape[1] + gy
+
+  # pick of each grid cell, -1 if none
+  pickedX = np.full(gridShape[0] * gridShape[1], -1, dtype=np.int64)
+  pickedY = np.zeros(gridShape[0] * gridShape[1], dtype=np.int64)
+
+  picked = []
+  for phaseX, phaseY in ((0, 0), (1, 0), (0, 1), (1, 1)):
+    candidates = np.flatnonzero((gx % 2 == phaseX) & (gy % 2 == phaseY))
+
+    # drop candidates too close to picks in the neighboring grid cells
+    ok = np.ones(len(candidates), dtype=bool)
+    cx, cy, cgx, cgy = x[candidates], y[candidates], gx[candidates], gy[candidates]
+    for dx in (-1, 0, 1):
+      for dy in (-1, 0, 1):
+        if dx == 0 and dy == 0:
+          continue
+        nx, ny = cgx + dx, cgy + dy
+        inGrid = (nx >= 0) & (nx < gridShape[0]) & (ny >= 0) & (ny < gridShape[1])
+        neighbor = np.where(inGrid, nx * gridShape[1] + ny, 0)
+        px, py = pickedX[neighbor], pickedY[neighbor]
+        ok &= ~(inGrid & (px >= 0) & (np.maximum(np.abs(cx - px), np.abs(cy - py)) < spacing))
+    candidates = candidates[ok]
+
+    # lowest priority candidate of each grid cell
+    candidates = candidates[np.lexsort((priority[candidates], cell[candidates]))]
+    first = np.ones(len(candidates), dtype=bool)
+    first[1:] = cell[candidates][1:] != cell[candidates][:-1]
+    picks = candidates[first]
+
+    pickedX[cell[picks]] = x[picks]
+    pickedY[cell[picks]] = y[picks]
+    picked.append(picks)
+
+  return np.concatenate(picked)
+
+def placeDropletsBlueNoise(movements: list[Movement], ps: PrintState, rng: random.Random = random) -> int:
+  """
+  Place droplets at blue noise (Poisson-disk) distributed supported positions. Candidates of all movements of the island are sampled as arrays and the picks are mapped back to their movements.
+  Picks are at least the collision kernel side distance + 1 apart so they can not collide with each other. The spacing is increased with a binary search to the largest spacing that still gives the droplets needed for density, which spreads the droplets evenly over the supported area.
+  Each bounding box raster is sampled separately with its share of the droplets needed.
+
+  :param movements: Movements
+  :type movements: list[Movement]
+  :param ps: PrintState
+  :type ps: PrintState
+  :param rng: Random stream of the island
+  :type rng: random.Random
+  :return: Total number of droplets placed
+  :rtype: int
+  """
+  if ps.infillModifiedDropletsNeededForDensity <= 0:
+    return 0
+
+  totalDropletsPlaced, supportedMovements, pools, rasterIndices = collectSupportedCandidates(movements=movements, ps=ps)
+
+  minimumSpacing = int((DROPLET_RASTER_COLLISION_SEARCH_KERNEL_SIZE-1)/2) + 1
+  npRng = np.random.default_rng(rng.getrandbits(64))
+
+  # candidates grouped by the bounding box raster they are placed in. Copies of a bounding box share the raster.
+  groups: dict[int, list[int]] = {}
+  for i, m in enumerate(supportedMovements):
+    groups.setdefault(id(m.boundingBox.dropletRasterBlocked), []).append(i)
+  remainingCandidates = sum(len(p) for p in pools)
+
+  for group in groups.values():
+    if ps.infillModifiedDropletsNeededForDensity <= 0:
+      break
+
+    movementIndex = np.concatenate([np.full(len(pools[i]), i, dtype=np.int64) for i in group])
+    row = np.concatenate([np.array(pools[i], dtype=np.int64) for i in group])
+    x = np.concatenate([np.array(rasterIndices[i][0], dtype=np.int64)[pools[i]] for i in group])
+    y = np.concatenate([np.array(rasterIndices[i][1], dtype=np.int64)[pools[i]] for i in group])
+    groupCandidates = len(row)
+    if groupCandidates == 0:
+      continue
+
+    # share of the droplets needed by candidate count, the last group gets the rest
+    target = math.ceil(ps.infillModifiedDropletsNeededForDensity * groupCandidates / remainingCandidates)
+    remainingCandidates -= groupCandidates
+
+    # one candidate per raster cell that is not blocked by droplets already on this layer
+    bb = supportedMovements[group[0]].boundingBox
+    collisionSideDist = minimumSpacing - 1
+    blockedX, blockedY = x + collisionSideDist, y + collisionSideDist
+    inBlocked = (blockedX >= 0) & (blockedX < bb.dropletRasterBlocked.shape[0]) & (blockedY >= 0) & (blockedY < bb.dropletRasterBlocked.shape[1])
+    free = ~(inBlocked & bb.dropletRasterBlocked[np.clip(blockedX, 0, bb.dropletRasterBlocked.shape[0]-1), np.clip(blockedY, 0, bb.dropletRasterBlocked.shape[1]-1)])
+    candidates = np.flatnonzero(free)
+    if len(candidates) == 0:
+      continue
+    _, unique = np.unique((x[candidates] - x.min()) * (np.ptp(y) + 1) + y[candidates] - y.min(), return_index=True)
+    candidates = candidates[unique]
+    priority = npRng.permutation(len(candidates))
+
+    def sample(spacing: int) -> np.ndarray:
+      return candidates[blueNoiseSample(x=x[candidates], y=y[candidates], priority=priority, spacing=spacing)]
+
+    # largest spacing that still gives the target
+    picks = sample(minimumSpacing)
+    low, high = minimumSpacing, max(minimumSpacing, int(max(np.ptp(x[candidates]), np.ptp(y[candidates]))) + 1)
+    while len(picks) > target and low < high:
+      spacing = (low + high + 1) // 2
+      spacingPicks = sample(spacing)
+      if len(spacingPicks) >= target:
+        low, picks = spacing, spacingPicks
+      else:
+        high = spacing - 1
+
+    # drop extra picks at random
+    if len(picks) > target:
+      picks = picks[npRng.permutation(len(picks))[:target]]
+
+    # map picks back to their movements
+    placedRows: dict[int, set[int]] = {}
+    def place(k: int):
+      nonlocal totalDropletsPlaced
+      i, r = int(movementIndex[k]), int(row[k])
+      m = supportedMovements[i]
+      placeSupportedPosition(m=m, sp=(int(m.supportedPositions.index[r]), m.supportedPositions.position(r)), ps=ps)
+      placedRows.setdefault(i, set()).add(r)
+      totalDropletsPlaced += 1
+    for k in picks.tolist():
+      place(k)
+    groupPlaced = len(picks)
+
+    # the spacing square is wider than the collision kernel corners so fill up closer than the spacing if short
+    if len(picks) < target:
+      pickedCandidates = np.zeros(groupCandidates, dtype=bool)
+      pickedCandidates[picks] = True
+      for k in candidates[np.argsort(priority)].tolist():
+        if ps.infillModifiedDropletsNeededForDensity <= 0 or groupPlaced >= target:
+          break
+        if not pickedCandidates[k] and not isBBDropletRasterIndexBlocked(bb=bb, rasterX=int(x[k]), rasterY=int(y[k])):
+          place(k)
+          groupPlaced += 1
+
+    for i, rows in placedRows.items():
+      pools[i] = [r for r in pools[i] if r not in rows]
+
+  # remaining candidates stay with their movements
+  for m, p in zip(supportedMovements, pools):
+    m.supportedPositions.rows = p
+
+  if ps.infillModifiedDropletsNeededForDensity > 0:
+    print(f"Ran out of support positions on layer {ps.layerHeight}")
+
+  return totalDropletsPlaced
+
+def getInfillRequirements(imq: list[Movement], ps: PrintState):
+  """Plan infill by calculating infill droplet count needed for target density and finding supported locations. 
+  Droplet counts are calculated from the movement length. Movements are only split into droplets when those droplets are written out (first raster layer or previewing all droplets).
+
+  :param imq: Infill movement queue
+  :type imq: list[Movement]
+  :param ps: PrintState
+  :type ps: PrintState
+  """  
+  # Average density along movements in bounding boxes with a density field, batched by bounding box
+  densityFieldMovements: dict[BoundingBox, list[Movement]] = {}
+  for m in imq:
+    if m.boundingBox and m.boundingBox.densityField is not None:
+      densityFieldMovements.setdefault(m.boundingBox.layerGeometrySource, []).append(m)
+  for bb, movements in densityFieldMovements.items():
+    for m, density in zip(movements, densitiesAlongMovements(bb=bb, movements=movements, height=ps.layerHeight).tolist()):
+      m.density = max(density, MINIMUM_DENSITY_FIELD_DENSITY)
+
+  for m in imq:
+    if m.boundingBox:
+      density = m.density if m.density is not None else m.boundingBox.geometryAtHeight(height=ps.layerHeight).density
+
+      # Get supported locations if previous layer raster exists. An earlier island on the first layer of the bounding box initializes the raster without a previous layer.
+      hasLastLayer = m.boundingBox.dropletRaster is not None and m.boundingBox.dropletRaster[0] is not None
+      if hasLastLayer and DEBUG_PREVIEW_ALL_DROPLETS_SUPPORTED == False:
+        dropletCount = planMovementDroplets(m=m, singleDropletWidthResolution=False)
+        ps.infillModifiedDropletsOriginal += dropletCount
+        ps.infillModifiedDropletsNeededForDensity += reducedDropletCountForDensity(numDroplets=dropletCount, density=density)
+
+        m.supportedPositions = findSupportedLocationsBatch(m=m)
+        ps.infillModifiedDropletsSupportedAvailable += len(m.supportedPositions)
+      else:
+        m.dropletMovements = splitMovementToDroplets(m=m, singleDropletWidthResolution=False if hasLastLayer else True)
+
+        ps.infillModifiedDropletsOriginal += len(m.dropletMovements)
+        ps.infillModifiedDropletsNeededForDensity += reducedDropletCountForDensity(numDroplets=len(m.dropletMovements), density=density)
+
+def placeInfill(imq: list[Movement], ps: PrintState) -> int:
+  """Place infill into print space. Modified the queued movements to set the correct droplets.
+
+  :param imq: Infill movement queue
+  :type imq: list[Movement]
+  :param ps: PrintState
+  :type ps: PrintState
+  :return: Total number of droplets placed
+  :rtype: int
+  """  
+  sortedMovements = copy.copy(imq)
+  sortedMovements.sort(key=lambda x: len(x.supportedPositions))
+
+  rng = placementRng(ps=ps)
+  if PLACEMENT_ENGINE == PLACEMENT_ENGINE_POOLED:
+    totalDropletsPlaced = placeDropletsPooled(movements=sortedMovements, ps=ps, fairness=PLACEMENT_POOLED_FAIRNESS, rng=rng)
+  elif PLACEMENT_ENGINE == PLACEMENT_ENGINE_BLUE_NOISE:
+    totalDropletsPlaced = placeDropletsBlueNoise(movements=sortedMovements, ps=ps, rng=rng)
+  else:
+    totalDropletsPlaced = placeDropletsRoundRobin(movements=sortedMovements, ps=ps, rng=rng)
+
+  # Compare the original random index stored in tuple
+  #def compareSupportedPositionsRandomIdx(move1: tuple[int, Movement], move2: tuple[int, Movement]):
+  #  return move1[0] - move2[0]
+
+  # Sort all Movements' placedSupportedPositions and replace dropletMovements
+  for m in imq:
+    if m.placedSupportedPositions:
+      m.placedSupportedPositions.sort(key=lambda x:x[0])
+      m.dropletMovements = DropletBatch.fromPositions(positions=[sp[1] for sp in m.placedSupportedPositions], dropletE=m.dropletE, movement=m)
+      m.placedSupportedPositions = None # remove reference to previously sorted array
+
+  return totalDropletsPlaced
+
+def reorderMovementsByZOffset(imq: list[Movement]):
+  imq.sort(reverse=True, key=lambda x:x.boundingBox.offsetZ if x.boundingBox else -1)
+
+def placeIsland(imq: list[Movement], ps: PrintState):
+  """Plan and place the droplets of a queued infill island and order its movements for output.
+
+  :param imq: Infill movement queue
+  :type imq: list[Movement]
+  :param ps: PrintState
+  :type ps: PrintState
+  """
+  ps.infillModifiedDropletsOriginal = 0
+  ps.infillModifiedDropletsNeededForDensity = 0
+  ps.infillModifiedDropletsSupportedAvailable = 0
+  ps.infillModifiedDropletsPlaced = 0
+
+  # the island may have been read ahead of the raster updates of earlier islands and layers
+  for m in imq:
+    if m.boundingBox:
+      m.boundingBox.syncDropletRaster()
+
+  print(f"getting infill requirements on layer height {ps.layerHeight}")
+  getInfillRequirements(imq, ps)
+  print(f"infill on layer height {ps.layerHeight} requires {ps.infillModifiedDropletsNeededForDensity}/{ps.infillModifiedDropletsOriginal} droplets for density. Found {ps.infillModifiedDropletsSupportedAvailable} available support locations.")
+  print(f"placing infill on layer height {ps.layerHeight}")
+  totalDropletsPlaced = placeInfill(imq=imq, ps=ps)
+  ps.infillModifiedDropletsPlaced = totalDropletsPlaced
+  print(f"infill on layer height {ps.layerHeight} placed {totalDropletsPlaced} droplets and still requires {ps.infillModifiedDropletsNeededForDensity} droplets")
+
+  print(f"reordering movements by Z offset") 
+  reorderMovementsByZOffset(imq=imq)
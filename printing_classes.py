@@ -1,4 +1,7 @@
-import enum, math, gc, copy
+import enum, math, copy
+
+import numpy as np
+
 from constants import *
 
 class StatusQueueItem:
@@ -26,6 +29,29 @@ class Position:
 
     return self.X == other.X and self.Y == other.Y and self.Z == other.Z and self.E == other.E
 
+def summedAreaTable(raster: np.ndarray) -> np.ndarray:
+  """
+  Return the summed-area table (integral image) of a raster. The table is padded with a leading row and column of zeros so that table[x][y] is the sum of raster[:x, :y].
+
+  :param raster: 2D raster
+  :type raster: np.ndarray
+  :return: Summed-area table of shape (raster.shape[0]+1, raster.shape[1]+1)
+  :rtype: np.ndarray
+  """
+  table = np.zeros((raster.shape[0]+1, raster.shape[1]+1), dtype=np.int32)
+  np.cumsum(raster, axis=0, dtype=np.int32, out=table[1:, 1:])
+  np.cumsum(table[1:, 1:], axis=1, out=table[1:, 1:])
+  return table
+
+# Bounding box values at one layer height
+class BoundingBoxLayerGeometry:
+  def __init__(self, origin: Position, size: Position, density: float, insetPercentage: float, offsetZ: float):
+    self.origin: Position = origin # effective origin and size after the sides fill in
+    self.size: Position = size
+    self.density: float = density
+    self.insetPercentage: float = insetPercentage # percentage of the inset still applied during density ramp up
+    self.offsetZ: float = offsetZ
+
 # Bounding Box
 class BoundingBox:
   def __init__(self, origin: Position, size: Position, density: float = 1):
@@ -40,27 +66,163 @@ class BoundingBox:
 
     #self.dropletOverlap = DROPLET_OVERLAP_PERC #percentage of droplet width
     self.dropletRasterResolution = DROPLET_RASTER_RESOLUTION_PERC
-    self.dropletRaster: list[None|list[list[int]]] = None #[last|current][x][y]
+    self.dropletRaster: list[None|np.ndarray] = None #[last|current][x][y]
+    self.dropletRasterBuffers: tuple[np.ndarray, np.ndarray] = None # preallocated layer buffers that swap between last and current
+    self.dropletRasterSummedArea: np.ndarray = None # summed-area table of the last layer raster [x+1][y+1]
+    self.dropletRasterBlocked: np.ndarray = None # current layer droplets dilated by the collision kernel, padded by the kernel side distance on each side
+    self.dropletRasterPreallocated: tuple[np.ndarray, np.ndarray, np.ndarray] = None # zeroed layer buffers and blocked mask used by initializeDropletRaster instead of allocating, e.g. in shared memory
+
+    # Layer geometry schedule by layer height. Copies made for intersection checking share the schedule and compute missing heights from the original bounding box.
+    self.layerGeometry: dict[float, BoundingBoxLayerGeometry] = {}
+    self.layerGeometrySource: BoundingBox = self
+
+    # Inset masks of the droplet raster by (raster shape, inset distance in raster indices)
+    self.insetMasks: dict[tuple, np.ndarray] = {}
 
+    # Spatially varying start density that replaces density when set. Resampled onto the droplet raster grid once per layer height.
+    self.densityField: 'DensityField' = None
+    self.densityMaps: dict[float, np.ndarray] = {}
 
-  def initializeDropletRasterLayer(self):
-    return [[0 for _ in range(0, round(self.size.Y/(DROPLET_WIDTH*self.dropletRasterResolution)) + 1)] for _ in range(0, round(self.size.X/(DROPLET_WIDTH*self.dropletRasterResolution)) + 1)]
+  def dropletRasterShape(self) -> tuple[int, int]:
+    return (round(self.size.X/(DROPLET_WIDTH*self.dropletRasterResolution)) + 1, round(self.size.Y/(DROPLET_WIDTH*self.dropletRasterResolution)) + 1)
+
+  def dropletRasterBlockedShape(self) -> tuple[int, int]:
+    collisionSideDist = int((DROPLET_RASTER_COLLISION_SEARCH_KERNEL_SIZE-1)/2)
+    shape = self.dropletRasterShape()
+    return (shape[0]+collisionSideDist*2, shape[1]+collisionSideDist*2)
+
+  def initializeDropletRasterLayer(self) -> np.ndarray:
+    return np.zeros(self.dropletRasterShape(), dtype=np.uint8)
     #return [[0 for _ in range(0, math.ceil((1/self.dropletOverlap)/2) + math.ceil(self.size.Y/(DROPLET_WIDTH*self.dropletOverlap)))] for _ in range(0, math.ceil((1/self.dropletOverlap)/2) + math.ceil(self.size.X/(DROPLET_WIDTH*self.dropletOverlap)))]
 
   def initializeDropletRaster(self):
-    self.dropletRaster = [None, self.initializeDropletRasterLayer()]
+    # copies share the raster of the original bounding box, which covers the full extent of every copy
+    if self.layerGeometrySource is not self:
+      if self.layerGeometrySource.dropletRaster is None:
+        self.layerGeometrySource.initializeDropletRaster()
+      self.dropletRaster = self.layerGeometrySource.dropletRaster
+      self.dropletRasterBuffers = self.layerGeometrySource.dropletRasterBuffers
+      self.dropletRasterSummedArea = self.layerGeometrySource.dropletRasterSummedArea
+      self.dropletRasterBlocked = self.layerGeometrySource.dropletRasterBlocked
+      return
+
+    if self.dropletRasterPreallocated is not None:
+      self.dropletRasterBuffers = self.dropletRasterPreallocated[:2]
+      self.dropletRasterBlocked = self.dropletRasterPreallocated[2]
+    else:
+      self.dropletRasterBuffers = (self.initializeDropletRasterLayer(), self.initializeDropletRasterLayer())
+      self.dropletRasterBlocked = np.zeros(self.dropletRasterBlockedShape(), dtype=bool)
+    self.dropletRaster = [None, self.dropletRasterBuffers[0]]
+
+  def syncDropletRaster(self):
+    # copies made before the raster of the original bounding box was initialized or advanced take its current raster
+    source = self.layerGeometrySource
+    if source is not self:
+      self.dropletRaster = source.dropletRaster
+      self.dropletRasterBuffers = source.dropletRasterBuffers
+      self.dropletRasterSummedArea = source.dropletRasterSummedArea
+      self.dropletRasterBlocked = source.dropletRasterBlocked
 
   def freeDropletRaster(self):
     self.dropletRaster = None
+    self.dropletRasterBuffers = None
+    self.dropletRasterSummedArea = None
+    self.dropletRasterBlocked = None
 
   def advanceDropletRasterNextLayer(self):
+    """
+    Make the current layer raster the last layer raster and reuse the other preallocated buffer, cleared in place, as the new current layer raster.
+    The raster list is modified in place so that BoundingBox copies sharing it see the new layer.
+    The summed-area table of the new last layer is built once here because the last layer is not modified after this.
+    """
     if self.dropletRaster:
+      nextLayer = self.dropletRasterBuffers[1] if self.dropletRaster[1] is self.dropletRasterBuffers[0] else self.dropletRasterBuffers[0]
+      nextLayer.fill(0)
       self.dropletRaster[0] = self.dropletRaster[1]
-      gc.collect()
-      self.dropletRaster[1] = self.initializeDropletRasterLayer()
+      self.dropletRaster[1] = nextLayer
+      self.dropletRasterBlocked.fill(False)
+      self.dropletRasterSummedArea = summedAreaTable(self.dropletRaster[0])
+
+  def geometryAtHeight(self, height: float) -> BoundingBoxLayerGeometry:
+    """
+    Return the effective origin, size, density, inset percentage and Z offset at a layer height.
+    Values are computed on first use of a height and read from the schedule after that.
+
+    :param height: Layer height
+    :type height: float
+    :return: Bounding box geometry at the height
+    :rtype: BoundingBoxLayerGeometry
+    """
+    geometry = self.layerGeometry.get(height)
+    if geometry is None:
+      source = self.layerGeometrySource
+      geometry = BoundingBoxLayerGeometry(
+        origin=source.currentBoundingBoxOriginAtHeight(height=height),
+        size=source.currentBoundingBoxSizeAtHeight(height=height),
+        density=source.densityAtLayerHeightForTargetDensity(layerHeight=height),
+        insetPercentage=1 - source.percentThroughRampUpDensityZone(layerHeight=height),
+        offsetZ=source.offsetZ
+      )
+      self.layerGeometry[height] = geometry
+    return geometry
+
+  def precomputeLayerGeometry(self, heights: list[float]):
+    for height in heights:
+      self.geometryAtHeight(height=height)
+
+  def insetMask(self, insetDistIndices: int) -> np.ndarray:
+    """
+    Return the mask of droplet raster indices that are at least the inset distance from the bounding box edge.
+    The mask is one index larger than the raster on the far sides so the far edge index stays inside when there is no inset. The box is the same at every height so the mask only depends on the inset. Mesh regions have a mask for each layer height instead, see MeshBoundingBox.insetMaskAtHeight().
+
+    :param insetDistIndices: Inset distance in raster indices
+    :type insetDistIndices: int
+    :return: Boolean mask indexed [x][y] by raster index
+    :rtype: np.ndarray
+    """
+    shape = self.dropletRaster[0].shape
+    mask = self.insetMasks.get((shape, insetDistIndices))
+    if mask is None:
+      mask = np.zeros((shape[0]+1, shape[1]+1), dtype=bool)
+      mask[max(0, insetDistIndices):shape[0]-insetDistIndices+1, max(0, insetDistIndices):shape[1]-insetDistIndices+1] = True
+      mask.flags.writeable = False
+      self.insetMasks[(shape, insetDistIndices)] = mask
+    return mask
+
+  def densityMapAtHeight(self, height: float) -> np.ndarray:
+    """
+    Return the density at each droplet raster index at a layer height. The density field is the start density and ramps up to the target density like densityAtLayerHeightForTargetDensity.
+    Raster indices are relative to the original bounding box origin.
+
+    :param height: Layer height
+    :type height: float
+    :return: Density indexed [x][y] by raster index
+    :rtype: np.ndarray
+    """
+    densityMap = self.densityMaps.get(height)
+    if densityMap is None:
+      source = self.layerGeometrySource
+      resolution = DROPLET_WIDTH*source.dropletRasterResolution
+      shape = source.dropletRasterShape()
+      x = source.origin.X + np.arange(shape[0]) * resolution
+      y = source.origin.Y + np.arange(shape[1]) * resolution
+      densityMap = source.densityField.sample(x[:, np.newaxis], y[np.newaxis, :], height).astype(np.float32)
+
+      if height >= source.lastLayerHeight():
+        densityMap[:] = source.targetDensity
+      elif height > source.lastStartingDensityLayerHeight():
+        rampUp = source.percentThroughRampUpDensityZone(layerHeight=height)
+        densityMap += rampUp * (source.targetDensity - densityMap)
+
+      densityMap.flags.writeable = False
+      self.densityMaps[height] = densityMap
+    return densityMap
 
   def lastLayerHeight(self) -> float:
     return self.origin.Z+self.size.Z
+
+  def intersectsZRange(self, minZ: float, maxZ: float) -> bool:
+    return maxZ >= self.origin.Z and minZ <= self.lastLayerHeight()
   
   def numLayersToTargetDensity(self) -> float:
     """
@@ -137,11 +299,96 @@ class BoundingBox:
       newBbSize.Y -= (self.size.Y) * min(1,self.percentThroughSideFillInZone(height=height))
       return newBbSize
 
+# Supported droplet locations along a Movement
+class SupportedLocations:
+  """
+  Supported locations found along a Movement stored as parallel arrays instead of Position copies.
+  Behaves like the list of (original interpolated index, Position) tuples that it replaces. Positions are only created for the locations that are looked at.
+  Deleting a location only removes its row from the list of remaining rows.
+  """
+  def __init__(self, index: np.ndarray, x: np.ndarray, y: np.ndarray, template: Position):
+    self.index: np.ndarray = index # original interpolated index
+    self.x: np.ndarray = x
+    self.y: np.ndarray = y
+    self.template: Position = template # Position that Z and misc values are copied from
+    self.rows: list[int] = list(range(len(index))) # remaining rows
+
+  def __len__(self):
+    return len(self.rows)
+
+  def __getitem__(self, i: int) -> tuple[int, Position]:
+    row = self.rows[i]
+    return (int(self.index[row]), self.position(row))
+
+  def __delitem__(self, i: int):
+    del self.rows[i]
+
+  def position(self, row: int) -> Position:
+    pos = copy.copy(self.template)
+    pos.X = float(self.x[row])
+    pos.Y = float(self.y[row])
+    pos.E = 0
+    return pos
+
+# Batch of droplets
+class DropletBatch:
+  """
+  Droplets (extrude only moves) of a Movement stored as contiguous arrays instead of one Movement per droplet.
+  E is the start E of each droplet and EInc is the relative E extruded by each droplet.
+  """
+  def __init__(self, x: np.ndarray, y: np.ndarray, z: np.ndarray, e: np.ndarray, eInc: np.ndarray, movement: 'Movement' = None):
+    self.X: np.ndarray = x
+    self.Y: np.ndarray = y
+    self.Z: np.ndarray = z
+    self.E: np.ndarray = e
+    self.EInc: np.ndarray = eInc
+    self.movement: Movement = movement # source movement the droplets replace
+
+  @classmethod
+  def fromPositions(cls, positions: list[Position], dropletE: float, movement: 'Movement' = None) -> 'DropletBatch':
+    x = np.fromiter((p.X for p in positions), dtype=np.float64, count=len(positions))
+    y = np.fromiter((p.Y for p in positions), dtype=np.float64, count=len(positions))
+    z = np.fromiter((p.Z for p in positions), dtype=np.float64, count=len(positions))
+    e = np.fromiter((p.E for p in positions), dtype=np.float64, count=len(positions))
+    return cls(x=x, y=y, z=z, e=e, eInc=(e + dropletE) - e, movement=movement)
+
+  @property
+  def boundingBox(self) -> BoundingBox:
+    return self.movement.boundingBox if self.movement else None
+
+  def __len__(self):
+    return len(self.X)
+
+  def select(self, indices: np.ndarray) -> 'DropletBatch':
+    return DropletBatch(x=self.X[indices], y=self.Y[indices], z=self.Z[indices], e=self.E[indices], eInc=self.EInc[indices], movement=self.movement)
+
+# Totals of a process() run
+class ProcessStats:
+  def __init__(self, inputFilepath: str, outputFilepath: str):
+    self.inputFilepath: str = inputFilepath
+    self.outputFilepath: str = outputFilepath
+    self.islands: int = 0 # infill islands placed
+    self.dropletsOriginal: int = 0
+    self.dropletsNeeded: int = 0 # droplets needed for density
+    self.dropletsPlaced: int = 0
+    self.elapsed: float = 0 # seconds
+    self.timings: list[str] = [] # pipeline stage timings
+
+  def recordIsland(self, ps: 'PrintState'):
+    self.islands += 1
+    self.dropletsOriginal += ps.infillModifiedDropletsOriginal
+    # droplets still needed are decremented as droplets are placed
+    self.dropletsNeeded += ps.infillModifiedDropletsPlaced + ps.infillModifiedDropletsNeededForDensity
+    self.dropletsPlaced += ps.infillModifiedDropletsPlaced
+
 # State of current Print FILE
 class PrintState:
   def __init__(self):
     self.height: float = -1 
     self.doneLayerCount: int = 0
+    self.layerIndex: int = 0 # layer changes seen, key of the placement random streams
+    self.islandIndex: int = -1 # infill island of the current layer, key of the placement random streams
+    self.placementSeed: int = None # seed of reproducible droplet placement. None uses the global random module.
     self.layerHeight: float = 0
     self.previousLayerHeight: float = 0
     self.layerStart: int = 0
@@ -152,11 +399,15 @@ class PrintState:
     # Infill movements read in but not written out
     self.infillMovementQueue: list[Movement] = None
     self.infillMovementQueueOriginalStartPosition: Position = None
+    self.infillMovementQueueStart: int = 0 # byte offset of the first line of the queued island
+    self.infillMovementQueueGcode: list[str|bytes] = None # output held back while the queue is open
+    self.infillMovementQueueVerbatim: bool = False # queued island has no bounding box segments and can be written as the original lines
 
     # Infill modified droplet stats
     self.infillModifiedDropletsOriginal: int = 0
     self.infillModifiedDropletsNeededForDensity: int = 0
     self.infillModifiedDropletsSupportedAvailable: int = 0
+    self.infillModifiedDropletsPlaced: int = 0
 
     # Movement info
     self.originalPosition: Position = Position() 
@@ -232,21 +483,24 @@ class Movement:
   # For travel and extrude-only movements, X,Y location only uses end position.
   # Droplet is an extrude-only movement.
 
-  def __init__(self, startPos: Position = None, endPos: Position = None, boundingBox: BoundingBox = None, originalGcode: str = None, feature: Feature = None):
+  def __init__(self, startPos: Position = None, endPos: Position = None, boundingBox: BoundingBox = None, originalGcode: bytes = None, feature: Feature = None):
     self.start: Position = startPos #original gcode start. is None if not a travel or printing command
     self.end: Position = endPos #original gcode end
     self.boundingBox: BoundingBox = boundingBox
-    self.originalGcode: str = originalGcode #original gcode only written out for misc gocde
+    self.originalGcode: bytes = originalGcode #original gcode line bytes only written out for misc gocde
     self.feature: Feature = feature # the active feature
     self.supportedPositions: list[tuple[int, Position]] = [] #supported positions underneath from the previous layer. (Original Index, Position)
 
     # E movement for a droplet
     self.dropletE: None
 
+    # Average density along the movement when the bounding box has a density field
+    self.density: float = None
+
     # Droplet movements that replace this move
-    self.dropletMovements: list[Movement] = None
-    # Placed supported position droplet Movements. Initially unsorted. Sort after all placement done.
-    self.supportedPositionMovements: list[tuple[int, Movement]] = None
+    self.dropletMovements: DropletBatch = None
+    # Placed supported position droplet locations. (Original Index, Position) Initially unsorted. Sort after all placement done.
+    self.placedSupportedPositions: list[tuple[int, Position]] = None
 
   # Return if this Movement is actually a Droplet (extrude only move)
   def isDroplet(self):
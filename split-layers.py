@@ -1,95 +1,53 @@
 import re, os, typing, queue, time, datetime, math, enum, copy, random, shutil
 
 from line_ending import *
+from mpf_reader import *
+from layer_index import *
 
-from io import TextIOWrapper
-
-START_GCODE_END = 'PARAM_SETUP'
-
-SPLIT_AFTER_GCODE = 'M1'
-END_GCODE_START = 'G53 G0 Z=$MA_POS_LIMIT_PLUS[Z]-1'
+from io import BufferedWriter
 
 def outFilepathGenerator(outputDirectory: str, i: int):
   return f"{outputDirectory}/{i:d}.mpf"
 
-def startOutput(outputDirectory: str, layer: int, startGcode: str) -> TextIOWrapper:
+def startOutput(outputDirectory: str, layer: int, startGcode: bytes) -> BufferedWriter:
   try:
-    outFile = open(outFilepathGenerator(outputDirectory=outputDirectory, i=layer), mode='w')
+    outFile = open(outFilepathGenerator(outputDirectory=outputDirectory, i=layer), mode='wb')
   except PermissionError as e:
     print(f"Failed to open {e}")
 
   outFile.write(startGcode)
   return outFile
 
-def endOutput(outFile: TextIOWrapper, endGcode: str):
+def endOutput(outFile: BufferedWriter, endGcode: bytes):
   outFile.write(endGcode)
+  outFile.close()
 
-def process(inputFilepath: str, outputDirectory: str):
+def process(inputFilepath: str, outputDirectory: str, useLayerIndexCache: bool = LAYER_INDEX_CACHE):
   startTime = time.monotonic()
 
-  lineEndingFlavor = determineLineEndingTypeInFile(inputFilepath)
-  print(f"detected line ending {repr(lineEndingFlavor)}")
-  if lineEndingFlavor == LineEnding.UNKNOWN:
-    lineEndingFlavor = LineEnding.UNIX
-    print('default to unix line ending')
-  lineEnding = lineEndingFlavor.value
-
   try:
-    with open(inputFilepath, mode='r') as f:
-      
-      startGcode = ''
-      startGcodePosition = -1
-      endGcode = ''
-      endGcodePosition = -1
-
-      cl = True
-      if len(startGcode) == 0:
-        while cl:
-          cl = f.readline()
-          startGcode += cl
-          if cl.startswith(START_GCODE_END):
-            startGcodePosition = f.tell()
-            break
+    # Input is memory mapped. Layer byte ranges come from the layer index so each layer is copied in bulk. CRLF line endings are converted to LF.
+    with MappedFile(inputFilepath) as f:
+      index = loadLayerIndex(f, cacheDirectory=layerIndexCacheDirectory() if useLayerIndexCache else None)
 
-      if len(endGcode) == 0:
-        while cl and cl.startswith(END_GCODE_START) == False:
-          cl = f.readline()
-          if f.tell() == 758693:
-            0==0
-        if cl.startswith(END_GCODE_START):
-          endGcodePosition = f.tell() - len(cl) - (len(lineEnding)-1)
-          endGcode += cl
-          while cl:
-            cl = f.readline()
-            endGcode += cl
-        
-      if startGcodePosition == -1:
+      if index.startGcodeEnd == 0:
         print('no start gcode end found')
-      if endGcodePosition == -1:
+      if index.endGcodeStart == len(f):
         print('no end gcode start found')
-      
-      # jump back to after start gcode
-      f.seek(startGcodePosition, os.SEEK_SET)
-
-      layer: int = 0
-
-      outFile = startOutput(outputDirectory=outputDirectory, layer=layer, startGcode=startGcode)
-
-      cl = True
-      while cl and cl != endGcodePosition:
-        cl = f.readline()
-        outFile.write(cl)
 
-        if cl.startswith(SPLIT_AFTER_GCODE) == True:
-          endOutput(outFile=outFile, endGcode=endGcode)
-          
-          print(f"Wrote layer {layer} to file {outFilepathGenerator(outputDirectory=outputDirectory, i=layer)}")
-          layer += 1
+      startGcode = f.read(0, index.startGcodeEnd)
+      endGcode = f.read(index.endGcodeStart, len(f))
 
-          outFile = startOutput(outputDirectory=outputDirectory, layer=layer, startGcode=startGcode)
+      # layers end after their M1 line. The last file has the remaining lines before the end gcode.
+      layers = [(layer.start, layer.end) for layer in index]
+      if not layers or index[-1].m1Offset != -1:
+        layers.append((layers[-1][1] if layers else index.startGcodeEnd, index.endGcodeStart))
 
-      endOutput(outFile=outFile, endGcode=endGcode)
-      print(f"Wrote layer {layer} to file {outFilepathGenerator(outputDirectory=outputDirectory, i=layer)}")
+      for layer, (start, end) in enumerate(layers):
+        outFile = startOutput(outputDirectory=outputDirectory, layer=layer, startGcode=startGcode)
+        outFile.write(f.read(start, end))
+        endOutput(outFile=outFile, endGcode=endGcode)
+        print(f"Wrote layer {layer} to file {outFilepathGenerator(outputDirectory=outputDirectory, i=layer)}")
   except PermissionError as e:
     print(f"Failed to open {e}")
 
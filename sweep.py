@@ -0,0 +1,125 @@
+import argparse, contextlib, datetime, itertools, os, random, tempfile, time
+
+from batch import *
+
+# Constants in MPF_OUTPUT_SUFFIX. They are only used to place droplets and write the output, so every configuration emits the same parsed print.
+SWEEP_CONSTANTS = (
+  'DROPLET_EXTRUSION_MULTIPLIER',
+  'INSET_DROPLET_WIDTH',
+  'MINIMUM_INSET_DROPLET_WIDTH',
+  'DROPLET_RASTER_SUPPORTED_SEARCH_KERNEL_SIZE',
+  'DROPLET_RASTER_SUPPORTED_SEARCH_CORNER_RADIUS',
+  'DROPLET_RASTER_COLLISION_SEARCH_KERNEL_SIZE',
+  'DROPLET_RASTER_COLLISION_SEARCH_CORNER_RADIUS'
+)
+
+def sweepConfigurations(grid: dict[str, list]) -> list[dict]:
+  """
+  Return every combination of the grid values.
+
+  :param grid: Values of each swept constant by name
+  :type grid: dict[str, list]
+  :return: Constant values by name of each configuration
+  :rtype: list[dict]
+  """
+  unknown = [name for name in grid if name not in SWEEP_CONSTANTS]
+  if unknown:
+    raise ValueError(f"{', '.join(unknown)} can not be swept because the input is only parsed once. Sweep {', '.join(SWEEP_CONSTANTS)}")
+  return [dict(zip(grid, values)) for values in itertools.product(*grid.values())]
+
+def sweepJobs(inputFilepath: str, configurations: list[dict], outputDirectory: str = None, overrides: dict = None) -> list[dict]:
+  """
+  Return a job config for each configuration. Output filenames follow MPF_OUTPUT_FILE, the input filename followed by MPF_OUTPUT_SUFFIX of the configuration.
+  """
+  jobs = []
+  outputFilepaths: dict[str, dict] = {}
+  for configuration in configurations:
+    job = {'input': inputFilepath, 'constants': {**(overrides or {}), **configuration}}
+    if outputDirectory:
+      job['outputDirectory'] = outputDirectory
+    outputFilepath = jobOutputFilepath(job=job, suffix=constantsNamespace(overrides=job['constants'])['MPF_OUTPUT_SUFFIX'])
+    if outputFilepath in outputFilepaths:
+      raise ValueError(f"Configurations {outputFilepaths[outputFilepath]} and {configuration} are both written to {outputFilepath}")
+    outputFilepaths[outputFilepath] = configuration
+    jobs.append(job)
+  return jobs
+
+def sweep(inputFilepath: str, jobs: list[dict], regions: list[dict] = None, outputDirectory: str = None, workers: int = BATCH_WORKERS, seed: int = None, overrides: dict = None) -> list[dict]:
+  """
+  Parse an MPF file once and emit it with the constants of each job in a pool of worker processes.
+  The parsed print is saved to a temporary file that each worker loads. Every job uses the same placement seed.
+
+  :param inputFilepath: Input MPF file path
+  :type inputFilepath: str
+  :param jobs: Job configs from sweepJobs()
+  :type jobs: list[dict]
+  :param regions: Density region configs, boundingBoxes of mpf_post_process.py by default
+  :type regions: list[dict]
+  :param outputDirectory: Directory of the temporary parsed print file, the input directory by default
+  :type outputDirectory: str
+  :param workers: Worker processes. 0 uses the CPU count.
+  :type workers: int
+  :param seed: Placement seed. A seed is drawn when None.
+  :type seed: int
+  :param overrides: Constant values of all jobs, used for parsing
+  :type overrides: dict
+  :return: Results of runJob() in job order
+  :rtype: list[dict]
+  """
+  # parsing uses the constants shared by all configurations
+  loadConstants(overrides or {})
+  import mpf_post_process
+  if regions:
+    mpf_post_process.boundingBoxes = [regionFromConfig(region) for region in regions]
+    mpf_post_process.testBoundingBox = mpf_post_process.boundingBoxes[0]
+
+  if seed is None:
+    seed = random.getrandbits(32)
+  print(f"Parsing {inputFilepath} with placement seed {seed}")
+  with open(os.devnull, mode='w') as log, contextlib.redirect_stdout(log):
+    parsedPrint = mpf_post_process.parsePrint(inputFilepath=inputFilepath, seed=seed)
+
+  parsedFile, parsedPrintFilepath = tempfile.mkstemp(suffix='.parsed', dir=outputDirectory or os.path.dirname(os.path.abspath(inputFilepath)))
+  os.close(parsedFile)
+  try:
+    parsedPrint.save(parsedPrintFilepath)
+    print(f"Parsed in {parsedPrint.elapsed:.2f}s, emitting {len(jobs)} configurations")
+    return runBatch(jobs=jobs, workers=workers, parsedPrintFilepath=parsedPrintFilepath)
+  finally:
+    os.remove(parsedPrintFilepath)
+
+def parseGridValues(s: str) -> tuple[str, list]:
+  name, _, values = s.partition('=')
+  return name, [parseValue(value) for value in values.split(',')]
+
+def main():
+  parser = argparse.ArgumentParser(description='Parse an MPF file once and post process it with every combination of placement constant values in a pool of worker processes.')
+  parser.add_argument('input', help='MPF file')
+  parser.add_argument('--grid', action='append', default=[], metavar='NAME=VALUE,VALUE', help=f'values of a swept constant, one of {", ".join(SWEEP_CONSTANTS)}')
+  parser.add_argument('--regions', help='region config JSON file')
+  parser.add_argument('--output-dir', help='directory of the output files, default is the input directory')
+  parser.add_argument('--workers', type=int, default=BATCH_WORKERS, help='worker processes, 0 uses the CPU count')
+  parser.add_argument('--seed', type=int, help='placement seed of all configurations, drawn at random by default')
+  parser.add_argument('--set', action='append', default=[], metavar='NAME=VALUE', help='constant value of all configurations')
+  args = parser.parse_args()
+
+  config = readConfig(args.regions) if args.regions else {}
+  grid = dict(parseGridValues(s) for s in args.grid)
+
+  overrides = {**config.get('constants', {}), **dict(parseOverride(s) for s in args.set)}
+  try:
+    jobs = sweepJobs(inputFilepath=args.input, configurations=sweepConfigurations(grid), outputDirectory=args.output_dir, overrides=overrides)
+  except ValueError as e:
+    parser.error(str(e))
+
+  startTime = time.monotonic()
+  results = sweep(inputFilepath=args.input, jobs=jobs, regions=config.get('regions'), outputDirectory=args.output_dir, workers=args.workers, seed=args.seed if args.seed is not None else config.get('seed'), overrides=overrides)
+  wallTime = time.monotonic() - startTime
+  printSummary(results=results, wallTime=wallTime)
+  print(f"Completed in {str(datetime.timedelta(seconds=wallTime))}s")
+
+  if any(result['error'] for result in results):
+    sys.exit(1)
+
+if __name__ == '__main__':
+  main()